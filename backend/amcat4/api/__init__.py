@@ -23,10 +23,13 @@ from amcat4.api.server import app_info
 from amcat4.api.snapshots import app_snapshots
 from amcat4.api.users import app_users
 from amcat4.auth.CSRFMiddleware import CSRFMiddleware
-from amcat4.auth.oauth import MAX_AGE_SESSION
+from amcat4.auth.sessions import MAX_AGE_SESSION
 from amcat4.config import get_settings
 from amcat4.connections import amcat_connections
+from amcat4.projects.jobs import ingest_workers
+from amcat4.projects.stats import index_stats_collector
 from amcat4.systemdata.manage import create_or_update_systemdata
+from amcat4.systemdata.reconciler import fields_reconciler
 
 
 @asynccontextmanager
@@ -34,7 +37,8 @@ async def lifespan(app: FastAPI):
     logging.info("Initializing system data...")
     async with amcat_connections():
         await create_or_update_systemdata()
-        yield
+        async with fields_reconciler(), index_stats_collector(), ingest_workers():
+            yield
 
 
 app = FastAPI(
@@ -7,6 +7,7 @@ from fastapi import APIRouter, Body, HTTPException, Query, Request
 from fastapi.responses import JSONResponse
 
 from amcat4.auth.oauth import oauth_callback, oauth_login, oauth_logout, oauth_refresh
+from amcat4.auth.sessions import end_session
 
 app_auth = APIRouter(prefix="", tags=["auth"])
 
@@ -46,7 +47,7 @@ async def logout(
     try:
         return await oauth_logout(request, returnTo)
     except Exception as e:
-        request.session.clear()
+        await end_session(request)
         response = JSONResponse(status_code=500, content={"error": str(e)})
         response.delete_cookie("client_session")
         return response
@@ -57,7 +58,7 @@ async def refresh_token(request: Request):
     try:
         return await oauth_refresh(request)
     except Exception as e:
-        request.session.clear()
+        await end_session(request)
         response = JSONResponse(status_code=500, content={"error": str(e)})
         response.delete_cookie("client_session")
         return response
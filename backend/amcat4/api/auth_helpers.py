@@ -1,17 +1,23 @@
 """Helper methods for authentication and authorization."""
 
+import hashlib
+import json
 import logging
+import time
+from base64 import urlsafe_b64decode
 from datetime import datetime
-from typing import Any
+from typing import Any, Awaitable, Callable
 
-from async_lru import alru_cache
-from authlib.jose import JsonWebToken, jwt
+from authlib.jose import JsonWebKey, JsonWebToken, jwt
+from authlib.jose.errors import BadSignatureError
 from fastapi import Depends, HTTPException, Request, Security
 from fastapi.security import APIKeyCookie, APIKeyHeader
 
+from amcat4.auth.sessions import get_session
+from amcat4.cache import VersionedCache
 from amcat4.config import AuthOptions, get_settings
 from amcat4.connections import http
-from amcat4.models import User
+from amcat4.models import AuthContext
 from amcat4.systemdata.apikeys import get_api_key
 
 api_key_scheme = APIKeyHeader(name="X-API-Key", scheme_name="API Key Header", auto_error=False)
@@ -20,34 +26,74 @@ session_cookie = APIKeyCookie(name="amcat_session", auto_error=False)
 
 
 async def session_cookie_scheme(request: Request, _=Depends(session_cookie)):
-    access_token = request.session.get("access_token")
-    return access_token
+    session = await get_session(request)
+    return session.get("access_token")
 
 
 class InvalidToken(ValueError):
     pass
 
 
-@alru_cache(maxsize=1)
-async def get_middlecat_config(middlecat_url: str) -> dict[str, Any]:
-    r = await http().get(f"{middlecat_url}/api/configuration")
-    r.raise_for_status()
-    return r.json()
+# The keys of the identity provider (the middlecat public key or the OIDC key set) are cached for KEYS_TTL seconds.
+# They are fetched again earlier if a token is signed with another key (e.g. because the provider rotated its keys),
+# but at most once every KEYS_MIN_REFRESH seconds, so invalid tokens cannot make us flood the provider.
+KEYS_TTL = 3600
+KEYS_MIN_REFRESH = 30
 
+_KEYS_CACHE: VersionedCache[str, dict[str, Any]] = VersionedCache(maxsize=16, ttl=KEYS_TTL)
+_KEYS_LOADED: dict[str, float] = {}
 
-@alru_cache(maxsize=1)
-async def get_oidc_jwks() -> str:
+# Verified token claims are cached until the token expires, so the signature of a token is only checked once
+_TOKEN_CACHE: VersionedCache[tuple[str | None, str, str], dict[str, Any]] = VersionedCache(maxsize=10_000, ttl=0)
+
+
+async def get_middlecat_config(middlecat_url: str, refresh: bool = False) -> dict[str, Any]:
+    async def load() -> dict[str, Any]:
+        r = await http().get(f"{middlecat_url}/api/configuration")
+        r.raise_for_status()
+        return r.json()
+
+    return await _cached_keys(f"middlecat:{middlecat_url}", load, refresh)
+
+
+async def get_oidc_jwks(refresh: bool = False) -> dict[str, Any]:
+    """Get the JSON Web Key Set that the OIDC provider signs its tokens with"""
     oidc_url = get_settings().oidc_url
     if oidc_url is None:
         raise InvalidToken("No OIDC configured")
 
-    url = oidc_url + "/.well-known/openid-configuration"
-    r = await http().get(url)
-    r.raise_for_status()
-    jwks_uri = r.json().get("jwks_uri")
-    if jwks_uri is None:
-        raise InvalidToken("OIDC configuration missing jwks_uri")
-    return jwks_uri
+    async def load() -> dict[str, Any]:
+        r = await http().get(oidc_url + "/.well-known/openid-configuration")
+        r.raise_for_status()
+        jwks_uri = r.json().get("jwks_uri")
+        if jwks_uri is None:
+            raise InvalidToken("OIDC configuration missing jwks_uri")
+        r = await http().get(jwks_uri)
+        r.raise_for_status()
+        return r.json()
+
+    return await _cached_keys(f"oidc:{oidc_url}", load, refresh)
+
+
+async def _cached_keys(key: str, loader: Callable[[], Awaitable[dict[str, Any]]], refresh: bool) -> dict[str, Any]:
+    """Get the keys from the cache or loader. If refresh is True, reload them unless they were loaded very recently"""
+    if refresh and time.monotonic() - _KEYS_LOADED.get(key, 0) > KEYS_MIN_REFRESH:
+        _KEYS_CACHE.invalidate(key)
+
+    async def load() -> dict[str, Any]:
+        keys = await loader()
+        _KEYS_LOADED[key] = time.monotonic()
+        return keys
+
+    return await _KEYS_CACHE.get_or_load(key, load)
+
+
+def _token_header(token: str) -> dict[str, Any]:
+    try:
+        header = token.split(".")[0]
+        return json.loads(urlsafe_b64decode(header + "=" * (-len(header) % 4)))
+    except ValueError as e:
+        raise InvalidToken("Malformed token") from e
 
 
 async def verify_middlecat_token(token: str) -> dict[str, Any]:
@@ -55,7 +101,14 @@ async def verify_middlecat_token(token: str) -> dict[str, Any]:
     if not url:
         raise InvalidToken("No middlecat defined, cannot decrypt middlecat token")
     public_key: str = (await get_middlecat_config(url))["public_key"]
-    payload: dict[str, Any] = jwt.decode(token, public_key)
+    try:
+        payload: dict[str, Any] = jwt.decode(token, public_key)
+    except BadSignatureError:
+        # Middlecat may have a new key, so try again with the current key (if it changed)
+        new_public_key: str = (await get_middlecat_config(url, refresh=True))["public_key"]
+        if new_public_key == public_key:
+            raise
+        payload = jwt.decode(token, new_public_key)
 
     if missing := {"email", "clientId", "resource", "exp"} - set(payload.keys()):
         raise InvalidToken(f"Missing keys {missing}")
@@ -75,38 +128,56 @@ async def verify_middlecat_token(token: str) -> dict[str, Any]:
 
 async def verify_oidc_token(token: str) -> dict[str, Any]:
     jwks = await get_oidc_jwks()
+    kid = _token_header(token).get("kid")
+    if kid is not None and kid not in {key.get("kid") for key in jwks.get("keys", [])}:
+        # The provider may have rotated its keys
+        jwks = await get_oidc_jwks(refresh=True)
     rsa_jwt = JsonWebToken(algorithms=["RS256"])
     options: dict = {
         "iss": {"essential": True, "value": get_settings().oidc_url},
         "aud": {"essential": True, "value": get_settings().host},
         "exp": {"essential": True},
     }
-    return rsa_jwt.decode(token, key=jwks, claims_options=options)
+    claims = rsa_jwt.decode(token, key=JsonWebKey.import_key_set(jwks), claims_options=options)
+    claims.validate()
+    return claims
 
 
 async def verify_token(token: str) -> dict[str, Any]:
     """
-    Verifies the given token and returns the payload
+    Verifies the given token and returns the payload.
+    Verified payloads are cached (by the hash of the token) until the token expires.
 
     raises a InvalidToken exception if the token could not be validated
     """
-    if get_settings().oidc_url:
-        return await verify_oidc_token(token)
+    settings = get_settings()
+    key = (settings.oidc_url or settings.middlecat_url, settings.host, hashlib.sha256(token.encode("utf-8")).hexdigest())
+    if (payload := _TOKEN_CACHE.get(key)) is not None:
+        if payload["exp"] > time.time():
+            return payload
+        _TOKEN_CACHE.invalidate(key)
+
+    if settings.oidc_url:
+        payload = await verify_oidc_token(token)
     else:
-        return await verify_middlecat_token(token)
+        payload = await verify_middlecat_token(token)
+    if isinstance(payload.get("exp"), (int, float)):
+        _TOKEN_CACHE.set(key, payload)
+    return payload
 
 
 async def authenticated_user(
     api_key: str | None = Security(api_key_scheme),
     access_token: str | None = Security(session_cookie_scheme),
-) -> User:
+) -> AuthContext:
     """
     Authenticates the user based on the provided middlecat token, oidc token or api key.
+    FastAPI resolves this once per request, so the returned AuthContext memoizes role and field lookups for the request.
     """
     settings = get_settings()
 
     if settings.auth == AuthOptions.no_auth:
-        return User(
+        return AuthContext(
             email="ADMIN",  # special NO_AUTH_USER
             auth_disabled=True,
             auth_method="none",
@@ -115,7 +186,7 @@ async def authenticated_user(
     elif access_token is not None:
         try:
             t = await verify_token(access_token)
-            return User(
+            return AuthContext(
                 email=t["email"],
                 superadmin=t["email"] == settings.admin_email,
                 auth_method="middlecat",
@@ -127,7 +198,7 @@ async def authenticated_user(
     elif api_key is not None:
         try:
             a = await get_api_key(api_key)
-            return User(
+            return AuthContext(
                 email=a.email,
                 superadmin=a.email == settings.admin_email,
                 api_key_name=a.name,
@@ -144,7 +215,7 @@ async def authenticated_user(
                 status_code=401,
                 detail="This instance requires guests to be authenticated. Please provide a valid bearer token",
             )
-        return User(
+        return AuthContext(
             email=None,
             auth_method="none",
         )
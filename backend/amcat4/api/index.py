@@ -5,10 +5,11 @@ import gzip
 import io
 import json
 import zlib
+from datetime import datetime
 from typing import Annotated
 
 from elastic_transport import ApiError
-from elasticsearch import ConflictError, NotFoundError
+from elasticsearch import NotFoundError
 from fastapi import APIRouter, Body, Depends, File, HTTPException, Path, Query, Request, Response, UploadFile, status
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
@@ -16,16 +17,18 @@ from pydantic import BaseModel, Field
 from amcat4.api.auth_helpers import authenticated_user
 from amcat4.api.index_query import FiltersType, QueriesType, _standardize_filters, _standardize_queries
 from amcat4.config import get_settings
+from amcat4.elastic.util import index_scan, index_scan_slices
 from amcat4.models import (
     ContactInfo,
     CreateDocumentField,
-    FieldSpec,
+    DocumentField,
     FieldType,
     GuestRole,
     IndexId,
     ProjectSettings,
     Role,
     RoleEmailPattern,
+    RoleRule,
     Roles,
     User,
 )
@@ -38,24 +41,24 @@ from amcat4.projects.index import (
     clear_project_index,
     create_project_index,
     delete_project_index,
-    index_size_in_bytes,
+    get_project_overview,
     list_unregistered_indices,
     list_user_project_indices,
+    list_user_project_indices_page,
     refresh_index,
     register_project_index,
     update_project_index,
 )
-from amcat4.projects.query import query_documents, reindex
+from amcat4.projects.query import reindex
+from amcat4.projects.stats import get_index_stats
 from amcat4.systemdata.fields import create_fields, list_fields
 from amcat4.systemdata.roles import (
     HTTPException_if_not_project_index_role,
     HTTPException_if_not_server_role,
-    create_project_role,
-    get_project_guest_role,
-    get_user_project_role,
+    bulk_set_roles,
     list_project_roles,
+    role_is_at_least,
     set_project_guest_role,
-    update_project_role,
 )
 from amcat4.systemdata.settings import get_project_image, get_project_settings
 
@@ -114,17 +117,35 @@ class IndexListResponse(BaseModel):
     user_role_match: RoleEmailPattern | None = Field(description="Email pattern that determined the user role")
     folder: str | None = Field(description="Folder for the index")
     image_url: str | None = Field(description="URL of the index thumbnail image")
+    bytes: int | None = Field(default=None, description="Size of the index in bytes (cached)")
+    documents: int | None = Field(
+        default=None,
+        description=(
+            "Number of documents in the index (cached). This is taken from the index statistics, "
+            "so the values of nested fields are counted as separate documents."
+        ),
+    )
+    last_write: datetime | None = Field(
+        default=None,
+        description=(
+            "Best guess of the time of the last change to the documents, or null if not known. "
+            "Changes made through another server process can be noticed up to the statistics interval late."
+        ),
+    )
 
 
 class IndexViewResponse(IndexListResponse):
     guest_role: GuestRole | None = Field(description="Guest role for the index")
     contact: list[ContactInfo] | None = Field(description="Contact info for the index")
-    bytes: int = Field(description="Size of the index in bytes")
+    fields: dict[str, DocumentField] | None = Field(
+        description="Fields of the index, or null if the user does not have METAREADER role on the index"
+    )
 
 
 @app_index.get("/index")
 async def index_list(
     request: Request,
+    response: Response,
     show_all: Annotated[
         bool, Query(..., description="Also show indices user has no role on (requires ADMIN server role)")
     ] = False,
@@ -132,6 +153,25 @@ async def index_list(
     minimal: Annotated[
         bool, Query(..., description="If true, return a dictionary with index ids as keys and roles as values")
     ] = False,
+    search: Annotated[
+        str | None, Query(description="Only list indices whose id, name or description match this search string")
+    ] = None,
+    folder: Annotated[str | None, Query(description="Only list indices in this folder")] = None,
+    per_page: Annotated[
+        int | None,
+        Query(
+            ge=1,
+            le=1000,
+            description=(
+                "Return (at most) this many indices, ordered by id. If there are more indices, the X-Next-Cursor "
+                "response header contains the cursor for the next page. If not given, all indices are returned."
+            ),
+        ),
+    ] = None,
+    cursor: Annotated[str | None, Query(description="Cursor from the X-Next-Cursor header of the previous page")] = None,
+    refresh_stats: Annotated[
+        bool, Query(description="If true, refresh the cached number of documents and size of the indices")
+    ] = False,
     user: User = Depends(authenticated_user),
 ) -> list[IndexListResponse] | dict[IndexId, Role | None]:
     """
@@ -142,10 +182,23 @@ async def index_list(
     if show_all:
         await HTTPException_if_not_server_role(user, Roles.ADMIN)
 
+    if per_page is None:
+        indices = [
+            result async for result in list_user_project_indices(user, show_all, show_archived, search=search, folder=folder)
+        ]
+    else:
+        indices, next_cursor = await list_user_project_indices_page(
+            user, per_page, cursor, show_all, show_archived, search=search, folder=folder
+        )
+        if next_cursor is not None:
+            response.headers["X-Next-Cursor"] = next_cursor
+
+    stats = {} if minimal else await get_index_stats([ix.id for ix, _ in indices], refresh=refresh_stats)
     ix_list: list = []
     ix_dict: dict[IndexId, Role | None] = {}
-    async for ix, role in list_user_project_indices(user, show_all=show_all, show_archived=show_archived):
+    for ix, role in indices:
         image_url = f"{get_settings().host}/api/index/{ix.id}/image/{ix.image.id}" if ix.image else None
+        ix_stats = stats.get(ix.id)
 
         if minimal:
             ix_dict[ix.id] = role.role if role else None
@@ -160,6 +213,9 @@ async def index_list(
                     folder=ix.folder or "",
                     image_url=image_url,
                     user_role_match=role.email if role else None,
+                    bytes=ix_stats.bytes if ix_stats else None,
+                    documents=ix_stats.documents if ix_stats else None,
+                    last_write=ix_stats.last_write if ix_stats else None,
                 )
             )
 
@@ -265,40 +321,42 @@ async def modify_index(
 
 @app_index.get("/index/{ix}")
 async def view_index(
-    request: Request, ix: IndexId = Path(..., description="ID of the index to view"), user: User = Depends(authenticated_user)
+    request: Request,
+    ix: IndexId = Path(..., description="ID of the index to view"),
+    refresh_stats: Annotated[
+        bool, Query(description="If true, refresh the cached number of documents and size of the index")
+    ] = False,
+    user: User = Depends(authenticated_user),
 ) -> IndexViewResponse:
     """
-    Get details of a single index, including the user role. Requires at least OBSERVER role on the index.
+    Get details of a single index, including the user role, the number of documents and (for users with at least
+    METAREADER role) the fields. Requires at least OBSERVER role on the index.
     """
     try:
-        d = await get_project_settings(ix)
-    except NotFoundError:
-        raise HTTPException(status_code=404, detail=f"Index {ix} does not exist")
-    except Exception:
-        raise HTTPException(status_code=500, detail=f"Error reading index {ix} settings")
-
-    await HTTPException_if_not_project_index_role(user, ix, Roles.OBSERVER)
-    role = await get_user_project_role(user, project_index=ix, global_admin=False)
-
-    try:
-        bytes = await index_size_in_bytes(ix)
-    except NotFoundError:
-        raise HTTPException(status_code=404, detail=f"Index {ix} has no corresponding Elasticsearch index")
+        overview = await get_project_overview(user, ix, refresh_stats=refresh_stats)
+    except IndexDoesNotExist as e:
+        raise HTTPException(status_code=404, detail=str(e))
 
+    await HTTPException_if_not_project_index_role(user, ix, Roles.OBSERVER, role=overview.user_role)
+    d, role = overview.settings, overview.project_role
     image_url = f"{get_settings().host}/api/index/{ix}/image/{d.image.id}" if d.image else None
+    show_fields = role_is_at_least(user, overview.user_role.model_copy(), Roles.METAREADER)
 
     return IndexViewResponse(
         id=d.id,
         name=d.name or "",
-        user_role=role.role if role else None,
-        user_role_match=role.email if role else None,
-        guest_role=await get_project_guest_role(d.id),
+        user_role=role.role,
+        user_role_match=role.email,
+        guest_role=overview.guest_role,
         description=d.description or "",
         archived=str(d.archived or ""),
         folder=d.folder or "",
         image_url=image_url,
         contact=d.contact or [],
-        bytes=bytes,
+        bytes=overview.stats.bytes,
+        documents=overview.stats.documents,
+        last_write=overview.stats.last_write,
+        fields=overview.fields if show_fields else None,
     )
 
 
@@ -473,13 +531,9 @@ async def download_index(
                 if role.role != "NONE":
                     yield json.dumps({"_type": "user_role", "email": role.email, "role": role.role}) + "\n"
 
-            # 4. Documents via scroll
-            field_specs = [FieldSpec(name=name) for name in fields]
-            result = await query_documents(ix, fields=field_specs, scroll=True, per_page=500)
-            while result is not None:
-                for doc in result.data:
-                    yield json.dumps({"_type": "document", **doc}) + "\n"
-                result = await query_documents(ix, scroll_id=result.scroll_id)
+            # 4. Documents via (sliced) scroll
+            async for id, doc in index_scan(ix, batchsize=500, source=list(fields), slices=await index_scan_slices(ix)):
+                yield json.dumps({"_type": "document", "_id": id, **doc}) + "\n"
 
         async for line in ndjson_lines():
             chunk = compressor.compress(line.encode())
@@ -534,13 +588,7 @@ async def import_index(
             field_defs = {name: CreateDocumentField.model_validate(f) for name, f in fields.items()}
             await create_fields(ps.id, field_defs)
         has_identifiers = any(f.get("identifier") for f in fields.values())
-        for role in roles:
-            if Roles[role["role"]] == Roles.NONE:
-                continue
-            try:
-                await create_project_role(role["email"], ps.id, Roles[role["role"]])
-            except ConflictError:
-                await update_project_role(role["email"], ps.id, Roles[role["role"]])
+        await _import_roles(ps.id, roles)
         return ps
 
     try:
@@ -609,13 +657,7 @@ async def import_index_metadata(
         if body.fields:
             field_defs = {name: CreateDocumentField.model_validate(f) for name, f in body.fields.items()}
             await create_fields(ps.id, field_defs)
-        for role in body.roles:
-            if Roles[role["role"]] == Roles.NONE:
-                continue
-            try:
-                await create_project_role(role["email"], ps.id, Roles[role["role"]])
-            except ConflictError:
-                await update_project_role(role["email"], ps.id, Roles[role["role"]])
+        await _import_roles(ps.id, body.roles)
     except IndexAlreadyExists as e:
         raise HTTPException(status_code=409, detail=str(e))
     except Exception:
@@ -625,6 +667,15 @@ async def import_index_metadata(
     return {"project_id": ps.id, "n_fields": len(body.fields), "n_roles": len(body.roles)}
 
 
+async def _import_roles(project_id: str, roles: list[dict]) -> None:
+    """Create or update the imported roles on the project (skipping NONE roles)"""
+    rules = [
+        RoleRule(email=r["email"], role_context=project_id, role=r["role"]) for r in roles if r["role"] != Roles.NONE.name
+    ]
+    if failed := [result for result in await bulk_set_roles(rules) if result.result == "error"]:
+        raise ValueError(f"Could not import the role of {failed[0].email}: {failed[0].error}")
+
+
 class DocumentBatchBody(BaseModel):
     documents: list[dict]
 
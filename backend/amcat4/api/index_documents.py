@@ -1,20 +1,31 @@
 """API Endpoints for document management."""
 
-from typing import Annotated, Any, Literal
+import json
+import zlib
+from typing import Annotated, Any, AsyncGenerator, Literal
 
 from elasticsearch import NotFoundError
-from fastapi import APIRouter, Body, Depends, HTTPException, Path, Query, status
+from fastapi import APIRouter, Body, Depends, HTTPException, Path, Query, Request, status
 from pydantic import BaseModel, Field
 
 from amcat4.api.auth_helpers import authenticated_user
+from amcat4.config import get_settings
 from amcat4.models import (
     DocumentFieldDefinition,
     FieldType,
     IndexId,
+    IngestJob,
     Roles,
     User,
 )
-from amcat4.projects.documents import create_or_update_documents, delete_document, fetch_document, update_document
+from amcat4.projects.documents import (
+    create_or_update_documents,
+    delete_document,
+    fetch_document,
+    stream_documents,
+    update_document,
+)
+from amcat4.projects.jobs import IngestQueueFull, enqueue_upload
 from amcat4.systemdata.roles import HTTPException_if_not_project_index_role
 
 app_index_documents = APIRouter(prefix="", tags=["documents"])
@@ -50,6 +61,19 @@ class UploadResult(BaseModel):
     failures: list[dict[str, Any]] = Field(description="List of failures with details")
 
 
+class ChunkResult(BaseModel):
+    """Result of uploading a single chunk of a streaming upload."""
+
+    successes: int = Field(description="Number of successful uploads in this chunk")
+    failures: int = Field(description="Number of failures in this chunk")
+
+
+class StreamUploadResult(UploadResult):
+    """Result of a streaming upload operation."""
+
+    chunks: list[ChunkResult] = Field(description="Results per chunk, in the order in which they were uploaded")
+
+
 @app_index_documents.post("/index/{ix}/documents", status_code=status.HTTP_201_CREATED)
 async def upload_documents(
     ix: Annotated[IndexId, Path(description="The index id")],
@@ -69,6 +93,75 @@ async def upload_documents(
     return UploadResult.model_validate(result)
 
 
+@app_index_documents.post("/index/{ix}/documents/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def upload_documents_job(
+    ix: Annotated[IndexId, Path(description="The index id")],
+    body: Annotated[UploadDocumentsBody, Body(...)],
+    user: User = Depends(authenticated_user),
+) -> IngestJob:
+    """
+    Upload documents to an index in the background. Requires WRITER role on the index.
+
+    Takes the same body as POST /index/{ix}/documents, but returns as soon as the fields are created and the
+    documents are queued. Use GET /task/{id} with the id of the returned job to follow its progress.
+    """
+    await HTTPException_if_not_project_index_role(user, ix, Roles.WRITER)
+
+    try:
+        return await enqueue_upload(ix, body.documents, body.fields, body.operation, email=user.email)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_CONTENT, detail=str(e))
+    except IngestQueueFull as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+
+
+@app_index_documents.post(
+    "/index/{ix}/documents/stream",
+    status_code=status.HTTP_201_CREATED,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {"application/x-ndjson": {"schema": {"type": "string"}}},
+        }
+    },
+)
+async def upload_documents_stream(
+    ix: Annotated[IndexId, Path(description="The index id")],
+    request: Request,
+    user: User = Depends(authenticated_user),
+    operation: Annotated[
+        Literal["index", "upsert", "create", "update"],
+        Query(description="The operation to perform, see POST /index/{ix}/documents"),
+    ] = "index",
+    chunk_size: Annotated[int, Query(description="Number of documents per bulk request", ge=1, le=10000)] = 500,
+    refresh: Annotated[bool, Query(description="If true, wait for ES to refresh before returning")] = False,
+) -> StreamUploadResult:
+    """
+    Upload documents as newline delimited JSON (one document per line), which can be gzip compressed
+    (use Content-Encoding: gzip). Requires WRITER role on the index.
+
+    Unlike POST /index/{ix}/documents, the documents are parsed and uploaded as they come in, so this can be used
+    for very large uploads. Fields need to be created before uploading. Invalid documents and lines that are not
+    valid JSON are reported as failures (with the position of the document in the upload as 'document').
+    If the upload is stopped by an error (e.g. a body that cannot be decompressed, or a document that is larger than
+    the maximum document size), the error response contains the number of documents that were uploaded before the
+    error as 'successes'.
+    """
+    await HTTPException_if_not_project_index_role(user, ix, Roles.WRITER)
+
+    result = StreamUploadResult(successes=0, failures=[], chunks=[])
+    try:
+        async for chunk in stream_documents(ix, _ndjson_documents(request), operation, chunk_size, refresh=refresh):
+            result.successes += chunk["successes"]
+            result.failures += chunk["failures"]
+            result.chunks.append(ChunkResult(successes=chunk["successes"], failures=len(chunk["failures"])))
+    except ValueError as e:
+        detail = dict(message=str(e), successes=result.successes, failures=len(result.failures))
+        code = status.HTTP_413_CONTENT_TOO_LARGE if isinstance(e, DocumentTooLarge) else status.HTTP_400_BAD_REQUEST
+        raise HTTPException(status_code=code, detail=detail)
+    return result
+
+
 @app_index_documents.get("/index/{ix}/documents/{docid}")
 async def get_document(
     ix: Annotated[IndexId, Path(description="The index id")],
@@ -136,3 +229,76 @@ async def remove_document(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Document {ix}/{docid} not found",
         )
+
+
+# Maximum number of bytes that is decompressed at once from a gzipped upload
+DECOMPRESS_CHUNK_SIZE = 65536
+
+
+class DocumentTooLarge(ValueError):
+    pass
+
+
+async def _ndjson_documents(request: Request) -> AsyncGenerator[dict[str, Any] | ValueError, None]:
+    """
+    Parse the (optionally gzipped) request body as newline delimited JSON while it is being received.
+    Lines that are not valid JSON objects are yielded as a ValueError (see stream_documents).
+    Memory use is bounded: the body is decompressed in pieces of at most DECOMPRESS_CHUNK_SIZE bytes, and a line
+    that is longer than settings.upload_max_document_bytes stops the upload with a DocumentTooLarge error.
+    """
+    max_bytes = get_settings().upload_max_document_bytes
+    gzipped = request.headers.get("content-encoding", "").lower() == "gzip"
+    decompressor = zlib.decompressobj(wbits=31) if gzipped else None  # wbits=31 = gzip format
+    buffer = bytearray()
+    line_number = 0
+
+    def parse(line: bytes | bytearray) -> dict[str, Any] | ValueError:
+        try:
+            document = json.loads(line)
+        except ValueError as e:
+            return ValueError(f"Line {line_number} is not valid JSON: {e}")
+        if not isinstance(document, dict):
+            return ValueError(f"Line {line_number} is not a JSON object")
+        return document
+
+    def too_large() -> DocumentTooLarge:
+        return DocumentTooLarge(f"Line {line_number + 1} is larger than the maximum document size ({max_bytes} bytes)")
+
+    async def pieces() -> AsyncGenerator[bytes, None]:
+        nonlocal decompressor
+        async for data in request.stream():
+            if decompressor is None:
+                yield data
+                continue
+            while data:
+                try:
+                    yield decompressor.decompress(data, DECOMPRESS_CHUNK_SIZE)
+                except zlib.error as e:
+                    raise ValueError(f"Could not decompress request body: {e}")
+                data = decompressor.unconsumed_tail
+                if decompressor.eof:
+                    # A gzip body can consist of multiple members (e.g. concatenated .gz files)
+                    data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(wbits=31)
+        if decompressor is not None:
+            yield decompressor.flush()
+
+    async for data in pieces():
+        # The buffer never contains a newline, so only the new data needs to be searched
+        search_from = len(buffer)
+        buffer += data
+        start = 0
+        while (end := buffer.find(b"\n", search_from)) != -1:
+            if end - start > max_bytes:
+                raise too_large()
+            line_number += 1
+            line = buffer[start:end]
+            if line.strip():
+                yield parse(line)
+            start = search_from = end + 1
+        del buffer[:start]
+        if len(buffer) > max_bytes:
+            raise too_large()
+    line_number += 1
+    if buffer.strip():
+        yield parse(buffer)
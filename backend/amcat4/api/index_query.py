@@ -2,15 +2,19 @@
 
 from typing import Annotated, Any, Dict, List, Literal, Optional, Union
 
+from elasticsearch import NotFoundError
 from fastapi import APIRouter, Body, Depends, HTTPException, status
 from pydantic import BaseModel, Field
 
 from amcat4.api.auth_helpers import authenticated_user
+from amcat4.config import TotalHitsMode
+from amcat4.elastic.msearch import run_batched
 from amcat4.models import FieldSpec, FilterSpec, FilterValue, IndexIds, Roles, SortSpec, User
 from amcat4.projects.aggregate import Aggregation, Axis, TopHitsAggregation, query_aggregate
 from amcat4.projects.query import delete_query, query_documents, update_query, update_tag_query
+from amcat4.projects.result_cache import cached_result
 from amcat4.systemdata.fields import HTTPException_if_invalid_field_access, allowed_fieldspecs
-from amcat4.systemdata.roles import HTTPException_if_not_project_index_role
+from amcat4.systemdata.roles import require_project_roles
 
 app_index_query = APIRouter(prefix="/index", tags=["query"])
 
@@ -65,6 +69,17 @@ SortType = Annotated[
     ),
 ]
 
+TotalHitsType = Annotated[
+    TotalHitsMode | None,
+    Field(
+        None,
+        description=(
+            "How to count the total number of hits: exact, bounded (count up to the server threshold), or "
+            "approximate (only count as far as needed, which is cheapest). Defaults to the server setting."
+        ),
+    ),
+]
+
 QueriesType = Annotated[
     str | list[str] | dict[str, str] | None,
     Field(
@@ -103,7 +118,23 @@ class QueryDocumentsBody(BaseModel):
     scroll_id: str | None = Field(
         default=None, description="Scroll ID as returned by a previous query for getting the next batch."
     )
+    pit: str | None = Field(
+        None,
+        description=(
+            "Page through the results using a point in time, which is the most efficient way to page deep "
+            "into large result sets. Specify how long the point in time should be kept alive between requests, "
+            "e.g., '5m'. Results will then contain a cursor that can be used to retrieve the next batch."
+        ),
+    )
+    cursor: str | None = Field(
+        default=None,
+        description=(
+            "Cursor as returned by a previous pit query for getting the next batch. "
+            "The queries, filters, sort and fields should be the same as in the original query."
+        ),
+    )
     highlight: bool = Field(default=False, description="If true, highlight fields.")
+    total_hits: TotalHitsType
 
 
 class AggregationSpec(BaseModel):
@@ -145,6 +176,27 @@ class QueryAggregateBody(BaseModel):
     queries: QueriesType
     filters: FiltersType
     after: Optional[dict[str, Any]] = Field(None, description="After cursor for pagination.")
+    total_hits: TotalHitsType
+
+
+class BatchQueryItem(QueryDocumentsBody):
+    """A document query as part of a batch."""
+
+    type: Literal["query"]
+
+
+class BatchAggregateItem(QueryAggregateBody):
+    """An aggregation as part of a batch."""
+
+    type: Literal["aggregate"]
+
+
+class BatchBody(BaseModel):
+    """Body for running multiple queries and aggregations at once."""
+
+    items: list[Annotated[BatchQueryItem | BatchAggregateItem, Field(discriminator="type")]] = Field(
+        ..., description="Queries (type: query) and aggregations (type: aggregate) to run.", max_length=100
+    )
 
 
 class UpdateTagsBody(BaseModel):
@@ -185,6 +237,9 @@ class QueryMeta(BaseModel):
     page_count: Optional[int] = None
     page: Optional[int] = None
     scroll_id: Optional[str] = None
+    cursor: Optional[str] = None
+    total_count_mode: Optional[TotalHitsMode] = None
+    total_count_relation: Optional[Literal["eq", "gte"]] = None
 
 
 class QueryResultDict(BaseModel):
@@ -233,21 +288,10 @@ async def query_documents_post(
     else:
         fieldspecs = await allowed_fieldspecs(user, indices)
 
-    r = await query_documents(
-        indices,
-        queries=_standardize_queries(body.queries),
-        filters=_standardize_filters(body.filters),
-        fields=fieldspecs,
-        sort=_standardize_sort(body.sort),
-        per_page=body.per_page,
-        page=body.page,
-        scroll_id=body.scroll_id,
-        scroll=body.scroll,
-        highlight=body.highlight,
-    )
-    if r is None:
+    result = await _run_query(indices, body, fieldspecs)
+    if result is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No results")
-    return QueryResultDict(**r.as_dict())
+    return QueryResultDict(**result)
 
 
 @app_index_query.post("/{index}/aggregate", response_model=AggregateResult)
@@ -260,6 +304,119 @@ async def query_aggregate_post(
     Perform an aggregation query on one or more indices. Requires READER or METAREADER role.
     """
     indices = index.split(",")
+    fields_to_check = _aggregate_fieldspecs(body)
+    if fields_to_check:
+        await HTTPException_if_invalid_field_access(indices, user, fields_to_check)
+
+    return await _run_aggregate(indices, body)
+
+
+@app_index_query.post("/{index}/batch")
+async def query_batch_post(
+    index: IndexIds,
+    body: Annotated[BatchBody, Body(...)],
+    user: User = Depends(authenticated_user),
+) -> list[QueryResultDict | AggregateResult]:
+    """
+    Run multiple queries and/or aggregations on one or more indices in a single request.
+    Field access is checked once for all items, and the searches are sent to elasticsearch together.
+    Returns the results in the same order as the items. Scroll and pit queries cannot be batched.
+    """
+    indices = index.split(",")
+
+    fields_to_check: list[FieldSpec] = []
+    need_allowed_fieldspecs = False
+    for item in body.items:
+        if isinstance(item, BatchAggregateItem):
+            fields_to_check += _aggregate_fieldspecs(item)
+        elif item.scroll or item.scroll_id or item.pit or item.cursor:
+            raise ValueError("Scroll and point in time queries cannot be batched")
+        elif fieldspecs := _standardize_fieldspecs(item.fields):
+            fields_to_check += fieldspecs
+        else:
+            need_allowed_fieldspecs = True
+    if fields_to_check:
+        await HTTPException_if_invalid_field_access(indices, user, fields_to_check)
+    default_fieldspecs = await allowed_fieldspecs(user, indices) if need_allowed_fieldspecs else []
+
+    async def run_item(item: BatchQueryItem | BatchAggregateItem) -> QueryResultDict | AggregateResult:
+        if isinstance(item, BatchAggregateItem):
+            return AggregateResult(**await _run_aggregate(indices, item))
+        fieldspecs = _standardize_fieldspecs(item.fields) or default_fieldspecs
+        result = await _run_query(indices, item, fieldspecs)
+        if result is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No results")
+        return QueryResultDict(**result)
+
+    return await run_batched([run_item(item) for item in body.items])
+
+
+async def _run_query(indices: list[str], body: QueryDocumentsBody, fieldspecs: list[FieldSpec]) -> dict | None:
+    """Run a document query (from the result cache if possible). Field access should be checked by the caller."""
+
+    async def run_query() -> dict | None:
+        r = await query_documents(
+            indices,
+            queries=_standardize_queries(body.queries),
+            filters=_standardize_filters(body.filters),
+            fields=fieldspecs,
+            sort=_standardize_sort(body.sort),
+            per_page=body.per_page,
+            page=body.page,
+            scroll_id=body.scroll_id,
+            scroll=body.scroll,
+            pit=body.pit,
+            cursor=body.cursor,
+            highlight=body.highlight,
+            total_hits=body.total_hits,
+        )
+        return None if r is None else r.as_dict()
+
+    try:
+        if body.scroll or body.scroll_id or body.pit or body.cursor or _is_random_sort(body.sort):
+            # Stateful and random results should never be cached
+            return await run_query()
+        # The key contains the effective fieldspecs, so users with different field access do not share results
+        cache_key = dict(body.model_dump(exclude={"fields", "type"}), fields=[f.model_dump() for f in fieldspecs])
+        return await cached_result("query", indices, cache_key, run_query)
+    except NotFoundError:
+        if not body.cursor:
+            raise
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Cursor expired")
+
+
+async def _run_aggregate(indices: list[str], body: QueryAggregateBody) -> dict:
+    """Run an aggregation (from the result cache if possible). Field access should be checked by the caller."""
+
+    async def run_aggregate() -> dict:
+        _axes = [Axis(**x.model_dump()) for x in body.axes] if body.axes else []
+        _aggregations = [a.instantiate() for a in body.aggregations] if body.aggregations else []
+        results = await query_aggregate(
+            indices,
+            _axes,
+            _aggregations,
+            queries=_standardize_queries(body.queries),
+            filters=_standardize_filters(body.filters),
+            after=body.after,
+            total_hits=body.total_hits,
+        )
+
+        return {
+            "meta": {
+                "axes": [axis.asdict() for axis in results.axes],
+                "aggregations": [a.asdict() for a in results.aggregations],
+                "after": results.after,
+                "total_count_mode": results.total_count_mode,
+            },
+            "data": list(results.as_dicts()),
+        }
+
+    # Field access is checked by the caller, so the result does not depend on the user
+    return await cached_result("aggregate", indices, body.model_dump(exclude={"type"}), run_aggregate)
+
+
+def _aggregate_fieldspecs(body: QueryAggregateBody) -> list[FieldSpec]:
+    """The fields used in the axes and aggregations of an aggregation query"""
     fields_to_check = []
 
     if body.axes:
@@ -273,29 +430,7 @@ async def query_aggregate_post(
                 fields_to_check.append(FieldSpec(name=agg.field))
             else:
                 fields_to_check += [FieldSpec(name=f) for f in agg.fields]
-
-    if fields_to_check:
-        await HTTPException_if_invalid_field_access(indices, user, fields_to_check)
-
-    _axes = [Axis(**x.model_dump()) for x in body.axes] if body.axes else []
-    _aggregations = [a.instantiate() for a in body.aggregations] if body.aggregations else []
-    results = await query_aggregate(
-        indices,
-        _axes,
-        _aggregations,
-        queries=_standardize_queries(body.queries),
-        filters=_standardize_filters(body.filters),
-        after=body.after,
-    )
-
-    return {
-        "meta": {
-            "axes": [axis.asdict() for axis in results.axes],
-            "aggregations": [a.asdict() for a in results.aggregations],
-            "after": results.after,
-        },
-        "data": list(results.as_dicts()),
-    }
+    return fields_to_check
 
 
 @app_index_query.post("/{index}/tags_update")
@@ -308,8 +443,7 @@ async def query_update_tags(
     Add or remove tags from documents by query or by id. Requires WRITER role on the index/indices.
     """
     indices = index.split(",")
-    for i in indices:
-        await HTTPException_if_not_project_index_role(user, i, Roles.WRITER)
+    await require_project_roles(user, indices, Roles.WRITER)
 
     ids = body.ids
     if isinstance(ids, (str, int)):
@@ -330,8 +464,7 @@ async def update_by_query(
     Update documents by query. Requires WRITER role on the index/indices.
     """
     indices = index.split(",")
-    for ix in indices:
-        await HTTPException_if_not_project_index_role(user, ix, Roles.WRITER)
+    await require_project_roles(user, indices, Roles.WRITER)
 
     response = await update_query(
         indices, body.field, body.value, _standardize_queries(body.queries), _standardize_filters(body.filters), body.ids
@@ -349,8 +482,7 @@ async def delete_by_query(
     Delete documents by query. Requires WRITER role on the index/indices.
     """
     indices = index.split(",")
-    for ix in indices:
-        await HTTPException_if_not_project_index_role(user, ix, Roles.WRITER)
+    await require_project_roles(user, indices, Roles.WRITER)
     response = await delete_query(indices, _standardize_queries(body.queries), _standardize_filters(body.filters), body.ids)
     return QueryUpdateResponse.model_validate(response)
 
@@ -424,3 +556,8 @@ def _standardize_sort(sort: str | list[str] | list[dict[str, SortSpec]] | None =
             raise ValueError(f"Cannot parse sort: {sort}")
 
     return sortspec
+
+
+def _is_random_sort(sort: str | list[str] | list[dict[str, SortSpec]] | None) -> bool:
+    """Does this sort specification include random ordering ("?")"""
+    return any("?" in field for field in _standardize_sort(sort) or [])
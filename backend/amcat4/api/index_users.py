@@ -4,18 +4,21 @@ from typing import Annotated
 
 from elasticsearch import ConflictError, NotFoundError
 from fastapi import APIRouter, Body, Depends, HTTPException, Path, status
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 
 from amcat4.api.auth_helpers import authenticated_user
 from amcat4.models import (
+    BulkRoleResult,
     IndexId,
     Role,
     RoleEmailPattern,
+    RoleRule,
     Roles,
     User,
 )
 from amcat4.systemdata.roles import (
     HTTPException_if_not_project_index_role,
+    bulk_set_roles,
     create_project_role,
     delete_project_role,
     list_project_roles,
@@ -84,6 +87,30 @@ async def add_project_user(
     return IndexUserResponse(email=body.email, role=body.role)
 
 
+@app_index_users.put("/index/{ix}/users", status_code=status.HTTP_200_OK)
+async def set_project_users(
+    ix: Annotated[IndexId, Path(..., description="ID of the index to set users for")],
+    body: Annotated[list[CreateIndexUserBody], Body(..., description="The users and their (new) roles")],
+    user: User = Depends(authenticated_user),
+) -> list[BulkRoleResult]:
+    """
+    Add many users to an index or update their roles at once (role NONE removes the user).
+    Returns the result per user, in the same order. Requires ADMIN role on the index.
+    """
+    await HTTPException_if_not_project_index_role(user, ix, Roles.ADMIN)
+    results: list[BulkRoleResult | None] = []
+    rules: list[RoleRule] = []
+    for row in body:
+        try:
+            rules.append(RoleRule(email=row.email, role_context=ix, role=row.role))
+            results.append(None)
+        except ValidationError as e:
+            error = e.errors()[0]["msg"]
+            results.append(BulkRoleResult(email=row.email, role_context=ix, role=row.role, result="error", error=error))
+    rule_results = iter(await bulk_set_roles(rules))
+    return [result or next(rule_results) for result in results]
+
+
 @app_index_users.put("/index/{ix}/users/{email}", status_code=status.HTTP_200_OK)
 async def modify_project_user(
     ix: Annotated[IndexId, Path(description="ID of the index to list users for")],
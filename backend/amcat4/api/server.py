@@ -12,8 +12,9 @@ from amcat4.config import get_settings, validate_settings
 from amcat4.connections import es, s3_enabled
 from amcat4.models import ContactInfo, Links, LinksGroup, Roles, ServerSettings, User
 from amcat4.objectstorage.image_processing import create_image_from_url
+from amcat4.projects.jobs import get_job
 from amcat4.projects.query import get_task_status
-from amcat4.systemdata.roles import HTTPException_if_not_server_role
+from amcat4.systemdata.roles import HTTPException_if_not_project_index_role, HTTPException_if_not_server_role
 from amcat4.systemdata.settings import get_server_settings, upsert_server_settings
 
 templates = Jinja2Templates(directory=Path(__file__).resolve().parent.parent.parent / "templates")
@@ -103,6 +104,13 @@ async def change_branding(data: BrandingBody, user: User = Depends(authenticated
 
 
 @app_info.get("/task/{taskId}")
-async def task_status(taskId: str, _user: User = Depends(authenticated_user)):
-    """Get the status of a background task."""
+async def task_status(taskId: str, user: User = Depends(authenticated_user)):
+    """
+    Get the status of a background task: either a background upload (see POST /index/{ix}/documents/jobs),
+    which requires WRITER role on its index, or an elasticsearch task (e.g. a reindex).
+    """
+    job = await get_job(taskId)
+    if job is not None:
+        await HTTPException_if_not_project_index_role(user, job.index, Roles.WRITER)
+        return job
     return await get_task_status(taskId)
@@ -12,6 +12,7 @@ import httpx
 from fastapi import APIRouter, HTTPException, Request
 from fastapi.responses import JSONResponse, RedirectResponse, Response
 
+from amcat4.auth.sessions import MAX_AGE_SESSION, create_session, end_session, get_session, update_session
 from amcat4.config import get_settings
 from amcat4.connections import http
 
@@ -19,8 +20,6 @@ log = logging.getLogger(__name__)
 
 app_auth = APIRouter(prefix="", tags=["auth"])
 
-MAX_AGE_SESSION = 14 * 24 * 60 * 60
-
 MIDDLECAT_URL = get_settings().middlecat_url
 OIDC_URL = get_settings().oidc_url
 OIDC_ID = get_settings().oidc_client_id
@@ -84,7 +83,7 @@ async def oauth_login(request: Request, returnTo: str | None):
     if auth_url is None:
         raise ValueError("Server does not have an authentication provider set up")
 
-    # Persist to encrypted session cookie
+    # Persist to encrypted session cookie (until the session is created in the callback)
     request.session.update({"code_verifier": code_verifier, "state": params["state"], "rd": redirect_back})
 
     query_str = "&".join([f"{k}={v}" for k, v in params.items()])
@@ -133,19 +132,21 @@ async def oauth_callback(request: Request, code: str, state: str):
         log.error("Invalid access token claims: %s", list(claims.keys()))
         raise ValueError("Invalid access token")
 
-    # Create session
-    request.session.update(
+    # Create session (stored server-side, the session cookie only contains its id)
+    redirect_back = request.session.get("rd")
+    await create_session(
+        request,
         {
             "id_token": tokens.get("id_token"),
             "access_token": tokens["access_token"],
             "refresh_token": tokens.get("refresh_token"),
             "exp": claims.get("exp"),
             "user": {"sub": claims.get("sub"), "name": name, "email": email},
-        }
+        },
     )
 
     # Create the RedirectResponse
-    response = RedirectResponse(url=request.session.get("rd") or "/")
+    response = RedirectResponse(url=redirect_back or "/")
 
     # Session data the client should be able to see
     response = set_client_session_cookie(response, exp=exp, email=email)
@@ -154,12 +155,13 @@ async def oauth_callback(request: Request, code: str, state: str):
 
 
 async def oauth_logout(request: Request, returnTo: str | None):
-    refresh_token = request.session.get("refresh_token")
-    id_token = request.session.get("id_token")
+    session = await get_session(request)
+    refresh_token = session.get("refresh_token")
+    id_token = session.get("id_token")
     final_destination = returnTo or get_settings().host
 
     # Local Session Clear
-    request.session.clear()
+    await end_session(request)
 
     # Handle Logic per Provider
     if OIDC_URL and not get_settings().test_mode:
@@ -196,13 +198,15 @@ async def oauth_logout(request: Request, returnTo: str | None):
 
 async def oauth_refresh(request: Request):
 
-    # Check if refresh is actually needed (5-minute buffer)
+    # Check if refresh is actually needed (5-minute buffer). Another worker may have refreshed the tokens already,
+    # so read the stored session rather than a cached copy (a rotated refresh token cannot be used twice)
+    session = await get_session(request, fresh=True)
     now = int(time.time())
-    exp = int(request.session.get("exp", now))
+    exp = int(session.get("exp", now))
     if exp - now > 5 * 60:
         return JSONResponse({"exp": exp})
 
-    refresh_token = request.session.get("refresh_token")
+    refresh_token = session.get("refresh_token")
     if not refresh_token:
         raise ValueError("No refresh token available")
 
@@ -236,12 +240,13 @@ async def oauth_refresh(request: Request):
     claims = decode_claims(new_access_token)
 
     # Update Session
-    request.session.update(
+    await update_session(
+        request,
         {
             "access_token": new_access_token,
             "refresh_token": new_refresh_token,
             "exp": claims.get("exp"),
-        }
+        },
     )
 
     # Update session data the client should be able to see
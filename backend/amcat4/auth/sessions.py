@@ -0,0 +1,172 @@
+"""
+Server-side login sessions.
+
+After logging in, the tokens of a user (access, refresh and id token) and their profile are kept in a session store,
+and the amcat_session cookie only contains an opaque session id. This keeps the cookie (which is sent with every
+request) small, and makes it possible to revoke a session by deleting it from the store.
+
+The default store is the sessions system index, with an in-process cache in front of it. Other stores can be used by
+subclassing SessionStore and passing an instance to set_session_store.
+"""
+
+import hashlib
+import json
+import secrets
+import time
+from abc import ABC, abstractmethod
+from datetime import UTC, datetime
+from typing import Any
+
+from elasticsearch import NotFoundError
+from starlette.requests import Request
+
+from amcat4.cache import VersionedCache
+from amcat4.connections import es
+from amcat4.systemdata.generations import GenerationWatcher
+from amcat4.systemdata.versions import sessions_index_name
+
+# Sessions expire after this many seconds (the same as the max age of the session cookie)
+MAX_AGE_SESSION = 14 * 24 * 60 * 60
+# Expired sessions are removed from the sessions index at most this often (in seconds)
+CLEANUP_INTERVAL = 3600
+
+
+class SessionStore(ABC):
+    """Interface for session stores. Sessions are stored by session id, with their expiry time (in epoch seconds)"""
+
+    @abstractmethod
+    async def get(self, session_id: str, fresh: bool = False) -> dict[str, Any] | None:
+        """Get the data of a session. If fresh is True, bypass any cache (e.g. before updating the session)"""
+
+    @abstractmethod
+    async def set(self, session_id: str, data: dict[str, Any], expires: float) -> None: ...
+
+    @abstractmethod
+    async def delete(self, session_id: str) -> None: ...
+
+
+class ElasticSessionStore(SessionStore):
+    """
+    Store sessions in the sessions system index. Recently used sessions are cached. Deleting or updating a session
+    bumps the "sessions" generation counter, and workers drop their cached sessions when they see that it changed,
+    so a revoked session stops working on all workers and refreshed tokens are used by all workers.
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self._cache: VersionedCache[str, tuple[float, dict[str, Any]]] = VersionedCache(maxsize=maxsize)
+        self._last_cleanup = 0.0
+        self._generation = GenerationWatcher("sessions", self._cache.invalidate)
+
+    async def get(self, session_id: str, fresh: bool = False) -> dict[str, Any] | None:
+        id = _session_doc_id(session_id)
+        await self._generation.check()
+        if fresh or (cached := self._cache.get(id)) is None:
+            generation = self._cache.generation(id)
+            try:
+                doc = (await es().get(index=sessions_index_name(), id=id))["_source"]
+            except NotFoundError:
+                return None
+            cached = (datetime.fromisoformat(doc["expires"]).timestamp(), json.loads(doc["data"]))
+            self._cache.set(id, cached, generation)
+
+        expires, data = cached
+        if expires < time.time():
+            # Expired sessions are removed from the index by _cleanup
+            self._cache.invalidate(id)
+            return None
+        return dict(data)
+
+    async def set(self, session_id: str, data: dict[str, Any], expires: float) -> None:
+        id = _session_doc_id(session_id)
+        doc = dict(
+            email=(data.get("user") or {}).get("email"),
+            data=json.dumps(data),
+            updated=datetime.now(UTC).isoformat(),
+            expires=datetime.fromtimestamp(expires, UTC).isoformat(),
+        )
+        res = await es().index(index=sessions_index_name(), id=id, document=doc)
+        if res["result"] == "updated":
+            # Other workers may have cached the old data (e.g. tokens that were just refreshed)
+            await self._generation.bump()
+        self._cache.invalidate(id)
+        self._cache.set(id, (expires, dict(data)))
+        await self._cleanup()
+
+    async def delete(self, session_id: str) -> None:
+        id = _session_doc_id(session_id)
+        self._cache.invalidate(id)
+        try:
+            await es().delete(index=sessions_index_name(), id=id)
+        except NotFoundError:
+            return
+        await self._generation.bump()
+
+    async def _cleanup(self) -> None:
+        """Remove expired sessions, at most every CLEANUP_INTERVAL seconds"""
+        if time.monotonic() - self._last_cleanup < CLEANUP_INTERVAL:
+            return
+        self._last_cleanup = time.monotonic()
+        query = {"range": {"expires": {"lt": "now"}}}
+        await es().delete_by_query(index=sessions_index_name(), query=query, conflicts="proceed", wait_for_completion=False)
+
+
+_STORE: SessionStore = ElasticSessionStore()
+
+
+def get_session_store() -> SessionStore:
+    return _STORE
+
+
+def set_session_store(store: SessionStore) -> None:
+    global _STORE
+    _STORE = store
+
+
+async def create_session(request: Request, data: dict[str, Any]) -> str:
+    """
+    Store the data in a new session, and replace the contents of the session cookie by its id.
+    Returns the session id.
+    """
+    session_id = secrets.token_urlsafe(32)
+    await get_session_store().set(session_id, data, time.time() + MAX_AGE_SESSION)
+    request.session.clear()
+    request.session["sid"] = session_id
+    return session_id
+
+
+async def get_session(request: Request, fresh: bool = False) -> dict[str, Any]:
+    """
+    Get the data of the current session, or an empty dict if there is none.
+    For sessions that were created before sessions were stored server-side, the data is in the cookie itself.
+    If fresh is True, the session is read from the store rather than from the cache of this worker.
+    """
+    session_id = request.session.get("sid")
+    if session_id is None:
+        return dict(request.session)
+    return await get_session_store().get(session_id, fresh=fresh) or {}
+
+
+async def update_session(request: Request, data: dict[str, Any]) -> None:
+    """Update the current session with the given data"""
+    session_id = request.session.get("sid")
+    if session_id is None:
+        request.session.update(data)
+        return
+    # Read the stored session, so the update is not merged into a stale copy cached by this worker
+    session = await get_session_store().get(session_id, fresh=True)
+    if session is None:
+        raise ValueError("Session has expired or was revoked")
+    await get_session_store().set(session_id, {**session, **data}, time.time() + MAX_AGE_SESSION)
+
+
+async def end_session(request: Request) -> None:
+    """Delete the current session (if any) from the store, and clear the session cookie"""
+    session_id = request.session.get("sid")
+    request.session.clear()
+    if session_id is not None:
+        await get_session_store().delete(session_id)
+
+
+def _session_doc_id(session_id: str) -> str:
+    # Store the hash of the session id, so the sessions index does not contain usable session ids
+    return hashlib.sha256(session_id.encode("utf-8")).hexdigest()
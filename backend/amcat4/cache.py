@@ -0,0 +1,100 @@
+"""
+In-process caches for system data that is read on (almost) every request, such as the field schemas of a project.
+
+Every cache keeps a generation counter per key. Writers call invalidate(key) after changing the underlying data,
+which drops the entry and bumps the generation. A reader that started loading before the invalidation will not
+store its (possibly stale) result, because the generation changed while it was loading.
+
+Note that these caches live in a single process. If the API runs with multiple workers, a write on one worker
+only invalidates the cache of that worker. Entries therefore expire after a TTL (settings.cache_ttl), which bounds
+how long other workers can serve stale data.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+from amcat4.config import get_settings
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class VersionedCache(Generic[K, V]):
+    """
+    A bounded (LRU) cache with per-key generation counters and an optional time to live.
+
+    :param maxsize: The maximum number of keys. The least recently used key is evicted first.
+    :param ttl: Seconds after which an entry expires. If None, use settings.cache_ttl. Use 0 to never expire.
+    :param copy: Optional function to copy values on the way in and out, so callers can safely mutate them.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float | None = None, copy: Callable[[V], V] | None = None):
+        self.maxsize = maxsize
+        self._ttl = ttl
+        self._copy = copy
+        self._entries: OrderedDict[K, tuple[float, int, V]] = OrderedDict()
+        self._generations: dict[K, int] = {}
+        self._global_generation = 0
+        self._counter = 0
+
+    @property
+    def ttl(self) -> float:
+        return get_settings().cache_ttl if self._ttl is None else self._ttl
+
+    def generation(self, key: K) -> int:
+        """
+        The current generation of a key. Pass this to set() to make sure a value loaded before an
+        invalidation is not stored.
+        """
+        return max(self._global_generation, self._generations.get(key, 0))
+
+    def get(self, key: K) -> V | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, generation, value = entry
+        if generation != self.generation(key) or self._expired(stored_at):
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return self._copy(value) if self._copy else value
+
+    def set(self, key: K, value: V, generation: int | None = None) -> bool:
+        """
+        Store a value. If generation is given and the key was invalidated since, the value is
+        not stored. Returns whether the value was stored.
+        """
+        current = self.generation(key)
+        if generation is not None and generation != current:
+            return False
+        self._entries[key] = (time.monotonic(), current, self._copy(value) if self._copy else value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return True
+
+    def invalidate(self, key: K | None = None) -> None:
+        """Drop the entry for this key (or all entries if key is None) and bump its generation"""
+        self._counter += 1
+        if key is None:
+            self._entries.clear()
+            self._generations.clear()
+            self._global_generation = self._counter
+        else:
+            self._entries.pop(key, None)
+            self._generations[key] = self._counter
+
+    async def get_or_load(self, key: K, loader: Callable[[], Awaitable[V]]) -> V:
+        """Get the value for this key, calling (and caching the result of) loader if it is missing or stale"""
+        value = self.get(key)
+        if value is not None:
+            return value
+        generation = self.generation(key)
+        value = await loader()
+        self.set(key, value, generation)
+        return value
+
+    def _expired(self, stored_at: float) -> bool:
+        ttl = self.ttl
+        return ttl > 0 and time.monotonic() - stored_at > ttl
@@ -10,7 +10,7 @@ We read configuration from 2 sources, in order of precedence (higher is more pri
 import functools
 import secrets
 from enum import Enum
-from typing import Annotated, Any
+from typing import Annotated, Any, Literal
 
 import questionary
 from class_doc import extract_docs_from_cls_obj
@@ -20,6 +20,8 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 
 ENV_PREFIX = "amcat4_"
 
+TotalHitsMode = Literal["exact", "bounded", "approximate"]
+
 
 class AuthOptions(str, Enum):
     #: everyone (that can reach the server) can do anything they want
@@ -137,6 +139,147 @@ class Settings(BaseSettings):
         ),
     ] = None
 
+    cache_ttl: Annotated[
+        float,
+        Field(
+            description=(
+                "Seconds that cached system data (e.g. field schemas) may be used before it is reloaded. "
+                "Writes invalidate the cache of the worker that made them immediately, so this only bounds "
+                "how long other workers can see stale data. Use 0 to never expire."
+            ),
+        ),
+    ] = 30
+
+    fields_reconcile_interval: Annotated[
+        float,
+        Field(
+            description=(
+                "Seconds between background sweeps that repair the fields of all projects "
+                "(i.e. sync the fields system index with the elasticsearch mappings). Use 0 to disable sweeps."
+            ),
+        ),
+    ] = 3600
+
+    index_stats_interval: Annotated[
+        float,
+        Field(
+            description=(
+                "Seconds that the statistics of the project indices (number of documents, size) are cached. "
+                "A background task refreshes them at this interval, so listing projects does not need to wait "
+                "for them. Use 0 to always get fresh statistics."
+            ),
+        ),
+    ] = 60
+
+    result_cache_size: Annotated[
+        int,
+        Field(
+            description="Number of query and aggregation results to cache (per worker). Use 0 to disable the cache.",
+        ),
+    ] = 1000
+
+    result_cache_ttl: Annotated[
+        float,
+        Field(
+            description=(
+                "Seconds that a cached query or aggregation result may be used. Writes invalidate the results "
+                "of the worker that made them immediately, and of other workers within a few seconds."
+            ),
+        ),
+    ] = 60
+
+    result_cache_refresh_interval: Annotated[
+        float,
+        Field(
+            description=(
+                "Seconds after a write to an index during which its query and aggregation results are not cached, "
+                "as elasticsearch only makes writes visible after the next refresh. Should be at least the "
+                "refresh_interval of the project indices."
+            ),
+        ),
+    ] = 1
+
+    total_hits_mode: Annotated[
+        TotalHitsMode,
+        Field(
+            description=(
+                "How accurately queries and aggregations count the total number of hits. "
+                "exact: always count all hits; bounded: count up to total_hits_threshold hits; "
+                "approximate: only count as many hits as needed to know whether there is a next page. "
+                "Can be overridden per request."
+            ),
+        ),
+    ] = "exact"
+
+    total_hits_threshold: Annotated[
+        int,
+        Field(
+            description="Maximum number of hits to count when total_hits_mode is bounded",
+        ),
+    ] = 10000
+
+    bulk_max_bytes: Annotated[
+        int,
+        Field(
+            description="Maximum size (in bytes) of the payload of a single bulk request to elasticsearch",
+        ),
+    ] = 10_000_000
+
+    bulk_max_documents: Annotated[
+        int,
+        Field(
+            description="Maximum number of documents in a single bulk request to elasticsearch",
+        ),
+    ] = 5000
+
+    bulk_concurrency: Annotated[
+        int,
+        Field(
+            description="Number of bulk requests that an upload or migration can have in flight at the same time",
+        ),
+    ] = 4
+
+    bulk_max_retries: Annotated[
+        int,
+        Field(
+            description=(
+                "Number of times that documents rejected by elasticsearch because it is overloaded (429) are retried, "
+                "with exponential backoff"
+            ),
+        ),
+    ] = 5
+
+    upload_max_document_bytes: Annotated[
+        int,
+        Field(
+            description="Maximum size (in bytes, after decompression) of a single document in a streaming upload",
+        ),
+    ] = 10_000_000
+
+    scan_max_slices: Annotated[
+        int,
+        Field(
+            description=(
+                "Maximum number of sliced scrolls that are used concurrently to scan a whole index "
+                "(e.g. to download a project or migrate the system index). Indices are scanned with one slice per shard."
+            ),
+        ),
+    ] = 8
+
+    ingest_workers: Annotated[
+        int,
+        Field(
+            description="Number of background uploads (ingest jobs) that are processed at the same time (per worker)",
+        ),
+    ] = 2
+
+    ingest_queue_size: Annotated[
+        int,
+        Field(
+            description="Maximum number of background uploads that can be waiting to be processed (per worker)",
+        ),
+    ] = 100
+
     test_mode: Annotated[
         bool,
         Field(
@@ -1,6 +1,6 @@
 from typing import Dict, Literal, Union
 
-from typing_extensions import TypedDict
+from typing_extensions import NotRequired, TypedDict
 
 
 class ElasticField(TypedDict):
@@ -30,6 +30,9 @@ class ElasticField(TypedDict):
         "dense_vector",
         "geo_point",
     ]
+    # Set both to False for fields that are stored, but never searched, sorted or aggregated on
+    index: NotRequired[bool]
+    doc_values: NotRequired[bool]
 
 
 class ElasticNestedField(TypedDict):
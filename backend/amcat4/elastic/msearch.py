@@ -0,0 +1,131 @@
+"""
+Combine the searches of concurrently running coroutines into multi-search (_msearch) requests.
+
+Code that might run as part of a batch uses es_search instead of es().search. Outside a batch, this simply
+runs the search. Inside run_batched, searches are held back until every coroutine in the batch is either
+finished or waiting for a search, and are then sent to elasticsearch in a single _msearch request.
+Coroutines that need multiple searches (e.g. paginated aggregations) get one round trip per step,
+shared with the other coroutines in the batch.
+"""
+
+import asyncio
+import dataclasses
+from contextvars import ContextVar
+from typing import Any, Awaitable, Sequence, TypeVar
+
+from elastic_transport import ApiResponseMeta
+from elasticsearch import ApiError
+from elasticsearch.exceptions import HTTP_EXCEPTIONS
+
+from amcat4.connections import es
+
+T = TypeVar("T")
+
+# Search arguments that are passed under a different name in the _msearch body
+_RENAMED_ARGUMENTS = {"from_": "from"}
+
+
+class SearchBatch:
+    """Collects the searches of a fixed number of coroutines (see run_batched)"""
+
+    def __init__(self, active: int):
+        self.active = active
+        self.pending: list[tuple[dict, asyncio.Future]] = []
+        self._tasks: set[asyncio.Task] = set()
+
+    async def search(self, kwargs: dict) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((kwargs, future))
+        self.flush_if_ready()
+        return await future
+
+    def done(self) -> None:
+        """Call this when one of the coroutines in the batch is finished"""
+        self.active -= 1
+        self.flush_if_ready()
+
+    def flush_if_ready(self) -> None:
+        """Send the pending searches if no coroutine in the batch can add more searches"""
+        if self.pending and len(self.pending) >= self.active:
+            pending, self.pending = self.pending, []
+            task = asyncio.create_task(_msearch(pending))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+
+_BATCH: ContextVar[SearchBatch | None] = ContextVar("amcat4_search_batch", default=None)
+
+
+async def es_search(**kwargs) -> Any:
+    """
+    Run an elasticsearch search with the same arguments as es().search.
+    Within run_batched, the search is sent together with the searches of the other coroutines.
+    """
+    batch = _BATCH.get()
+    if batch is None:
+        return await es().search(**kwargs)
+    return await batch.search(kwargs)
+
+
+async def run_batched(coroutines: Sequence[Awaitable[T]]) -> list[T]:
+    """
+    Run the coroutines concurrently, sending their searches to elasticsearch in _msearch requests.
+    Returns the results in order. If any coroutine raises an exception, the first exception is raised
+    (after all coroutines are finished).
+    """
+    batch = SearchBatch(active=len(coroutines))
+
+    async def run(coroutine: Awaitable[T]) -> T:
+        try:
+            return await coroutine
+        finally:
+            batch.done()
+
+    token = _BATCH.set(batch)
+    try:
+        results = await asyncio.gather(*(run(c) for c in coroutines), return_exceptions=True)
+    finally:
+        _BATCH.reset(token)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results  # type: ignore
+
+
+async def _msearch(pending: list[tuple[dict, asyncio.Future]]) -> None:
+    searches = []
+    for kwargs, _ in pending:
+        header, body = _msearch_item(kwargs)
+        searches += [header, body]
+    try:
+        result = await es().msearch(searches=searches)
+    except Exception as e:
+        for _, future in pending:
+            if not future.done():
+                future.set_exception(e)
+        return
+    for (_, future), response in zip(pending, result["responses"]):
+        if future.done():
+            continue
+        if "error" in response:
+            future.set_exception(_api_error(response, result.meta))
+        else:
+            future.set_result(response)
+
+
+def _msearch_item(kwargs: dict) -> tuple[dict, dict]:
+    """Convert es().search arguments into an _msearch header and body"""
+    kwargs = dict(kwargs)
+    index = kwargs.pop("index", None)
+    header = {} if index is None else {"index": index if isinstance(index, str) else ",".join(index)}
+    body = {_RENAMED_ARGUMENTS.get(k, k): v for k, v in kwargs.items() if v is not None}
+    return header, body
+
+
+def _api_error(response: dict, meta: ApiResponseMeta) -> ApiError:
+    """Create the exception that es().search would have raised for this _msearch response"""
+    status = response.get("status", 500)
+    error = response["error"]
+    message = error.get("type", "error") if isinstance(error, dict) else str(error)
+    error_class = HTTP_EXCEPTIONS.get(status, ApiError)
+    return error_class(message=message, meta=dataclasses.replace(meta, status=status), body=response)
@@ -1,6 +1,11 @@
-from typing import Any, AsyncGenerator, AsyncIterable, Iterable, Literal, Tuple
+import asyncio
+import logging
+import time
+from contextlib import aclosing
+from typing import Any, AsyncGenerator, AsyncIterable, Iterable, Literal, Mapping, Sequence, Tuple, cast
 
 import elasticsearch.helpers
+from elasticsearch import ApiError
 from elasticsearch.helpers.errors import BulkIndexError
 from pydantic import BaseModel
 
@@ -13,6 +18,15 @@ from amcat4.models import IndexId
 class SystemIndexMapping(BaseModel):
     name: IndexId | Literal[""]
     mapping: ElasticMapping
+    # Indices that were added to a version after its release are created if they are missing
+    # (see systemdata.manage.update_systemdata_mappings), instead of making the version broken
+    create_if_missing: bool = False
+    # Writes only wait for a refresh where a search must see them, and indices that are only read by id
+    # (with realtime get) can be refreshed less often to make writes cheaper
+    refresh_interval: str = "1s"
+    # Indices that only hold short-lived data (e.g. login sessions, job progress) are recreated if their mapping
+    # cannot be updated in place (see systemdata.manage.update_systemdata_mappings)
+    transient: bool = False
 
 
 ## TODO: fix the entire mess with the amcat prefix...
@@ -51,20 +65,20 @@ async def es_upsert(index: str, id: str, doc: dict, refresh: bool = True) -> Non
 
 
 async def es_bulk_create(
-    generator: AsyncGenerator[BulkInsertAction, None], batchsize: int = 1000, overwrite: bool = False
+    generator: AsyncGenerator[BulkInsertAction, None], batchsize: int | None = None, overwrite: bool = False
 ) -> None:
     op_type: Literal["index", "create"] = "index" if overwrite else "create"
     return await es_bulk_action(generator, op_type=op_type, batchsize=batchsize)
 
 
-async def es_bulk_upsert(generator: AsyncGenerator[BulkInsertAction, None], batchsize: int = 1000) -> None:
+async def es_bulk_upsert(generator: AsyncGenerator[BulkInsertAction, None], batchsize: int | None = None) -> None:
     return await es_bulk_action(generator, op_type="update", batchsize=batchsize)
 
 
 async def es_bulk_action(
     generator: AsyncGenerator[BulkInsertAction, None],
     op_type: Literal["index", "create", "update"],
-    batchsize: int = 1000,
+    batchsize: int | None = None,
     refresh: bool = True,
 ) -> None:
     """
@@ -87,39 +101,233 @@ async def es_bulk_action(
         - use "index" to create or overwrite documents
         - use "create" to create documents, fail if they already exist
         - use "update" to create or update documents (i.e. upsert)
-    """
-    actions: list[dict] = []
-    async for item in generator:
-        action: dict = {"_op_type": op_type, "_index": item.index, "_id": item.id}
-
-        if op_type == "update":
-            action["doc"] = item.doc
-            action["doc_as_upsert"] = True
-        else:
-            action = {**item.doc, **action}
-        actions.append(action)
 
-        if len(actions) >= batchsize:
-            await bulk_helper_with_errors(actions, refresh=refresh)
-            actions = []
+    The documents are sent with es_bulk, batchsize limits the number of documents per bulk request.
+    """
 
-    if len(actions) > 0:
-        await bulk_helper_with_errors(actions, refresh=refresh)
+    async def actions() -> AsyncGenerator[dict, None]:
+        async for item in generator:
+            action: dict = {"_op_type": op_type, "_index": item.index, "_id": item.id}
+            if op_type == "update":
+                action["doc"] = item.doc
+                action["doc_as_upsert"] = True
+            else:
+                action = {**item.doc, **action}
+            yield action
+
+    await es_bulk(actions(), refresh=refresh, max_documents=batchsize)
+
+
+class BulkStats(BaseModel):
+    """Throughput statistics of a bulk operation. Bytes and requests include retries."""
+
+    successes: int = 0
+    failures: int = 0
+    requests: int = 0
+    retries: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+
+    @property
+    def documents_per_second(self) -> float:
+        return (self.successes + self.failures) / self.seconds if self.seconds else 0.0
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+
+async def es_bulk_stream(
+    actions: AsyncIterable[dict] | Iterable[dict],
+    refresh: bool | Literal["wait_for"] = False,
+    max_bytes: int | None = None,
+    max_documents: int | None = None,
+    concurrency: int | None = None,
+    max_retries: int | None = None,
+    initial_backoff: float = 1.0,
+    max_backoff: float = 60.0,
+    stats: BulkStats | None = None,
+) -> AsyncGenerator[tuple[bool, dict], None]:
+    """
+    Send the actions (in the format of elasticsearch.helpers.async_bulk) to elasticsearch in bulk requests,
+    and yield (ok, item) for every action, like elasticsearch.helpers.async_streaming_bulk.
+
+    - A request is sent when it reaches max_bytes of payload or max_documents actions, whichever comes first
+    - Up to concurrency requests are in flight at the same time. New actions are only consumed when a request
+      slot is free, so a busy cluster slows down the producer instead of filling up memory
+    - Actions (or whole requests) that elasticsearch rejects with 429 Too Many Requests are retried up to
+      max_retries times, waiting initial_backoff seconds for the first retry and doubling (up to max_backoff)
+      for every next retry. Other errors are reported as failed items and not retried.
+
+    Actions are spread over concurrency lanes by their _id, and the requests of one lane are sent one after the other.
+    So actions on the same document are applied in the order in which they were given (the last write wins), even if
+    they end up in different requests. Actions without _id are spread evenly over the lanes.
+
+    Results are yielded per request as it completes, so not necessarily in the order of the actions.
+    If stats is given, it is updated with the throughput statistics.
+    The defaults for max_bytes, max_documents, concurrency and max_retries are taken from the bulk_* settings.
+    """
+    settings = get_settings()
+    max_bytes = max_bytes or settings.bulk_max_bytes
+    max_documents = max_documents or settings.bulk_max_documents
+    concurrency = concurrency or settings.bulk_concurrency
+    max_retries = settings.bulk_max_retries if max_retries is None else max_retries
+    if stats is None:
+        stats = BulkStats()
+
+    start = time.monotonic()
+    # The request in flight for every lane, and a chunk that waits for its lane to be free
+    running: dict[int, asyncio.Task[list[tuple[bool, dict]]]] = {}
+    waiting: tuple[int, list[list[bytes]]] | None = None
+    try:
+        async with aclosing(_bulk_chunks(actions, max_bytes, max_documents, concurrency)) as chunks:
+            exhausted = False
+            while True:
+                if waiting is None and not exhausted:
+                    waiting = await anext(chunks, None)
+                    exhausted = waiting is None
+                if waiting is not None and waiting[0] not in running:
+                    lane, chunk = waiting
+                    running[lane] = asyncio.create_task(
+                        _send_bulk_chunk(chunk, refresh, max_retries, initial_backoff, max_backoff, stats)
+                    )
+                    waiting = None
+                    continue
+                if not running:
+                    break
+                done, _ = await asyncio.wait(running.values(), return_when=asyncio.FIRST_COMPLETED)
+                for lane, task in list(running.items()):
+                    if task in done:
+                        del running[lane]
+                        for result in task.result():
+                            yield result
+    finally:
+        for task in running.values():
+            task.cancel()
+        await asyncio.gather(*running.values(), return_exceptions=True)
+        stats.seconds += time.monotonic() - start
+        logging.debug(
+            f"Bulk: {stats.successes} ok, {stats.failures} failed in {stats.requests} requests ({stats.retries} retries), "
+            f"{stats.documents_per_second:.0f} docs/s, {stats.bytes_per_second / 1e6:.1f} MB/s"
+        )
 
 
-async def bulk_helper_with_errors(actions: Iterable[dict], **kwargs) -> None:
+async def es_bulk(
+    actions: AsyncIterable[dict] | Iterable[dict], raise_on_error: bool = True, **kwargs
+) -> tuple[BulkStats, list[dict]]:
     """
-    elastic bulk but printing the reason for the first error if any
+    Send the actions to elasticsearch with es_bulk_stream (see there for the other arguments).
+    Returns the statistics and the failed items. If raise_on_error is True, raises a BulkIndexError
+    (including the reason of the first error) after all actions are sent if any of them failed.
     """
-    try:
-        await elasticsearch.helpers.async_bulk(es(), actions, stats_only=False, **kwargs)
+    stats = BulkStats()
+    errors: list[dict] = []
+    async for ok, item in es_bulk_stream(actions, stats=stats, **kwargs):
+        if not ok:
+            errors.append(item)
+    if errors and raise_on_error:
+        raise bulk_index_error(errors)
+    return stats, errors
+
+
+def bulk_index_error(errors: list[dict]) -> BulkIndexError:
+    """Create a BulkIndexError for these failed bulk items, with the reason for the first error in its message"""
+    _, error = list(errors[0].items())[0]
+    reason = error.get("error", {}).get("reason", error)
+    e = BulkIndexError(f"{len(errors)} document(s) failed to index.", errors)
+    e.args = e.args + (f"First error: {reason}",)
+    return e
+
+
+async def _bulk_chunks(
+    actions: AsyncIterable[dict] | Iterable[dict], max_bytes: int, max_documents: int, lanes: int
+) -> AsyncGenerator[tuple[int, list[list[bytes]]], None]:
+    """
+    Serialize the actions and group them into chunks of at most max_bytes and max_documents, and yield (lane, chunk).
+    Every action in a chunk is a list of its serialized lines (the action line and, except for delete, the source).
+    An action that is larger than max_bytes is sent in a chunk of its own.
 
-    except BulkIndexError as e:
-        if e.errors:
-            _, error = list(e.errors[0].items())[0]
-            reason = error.get("error", {}).get("reason", error)
-            e.args = e.args + (f"First error: {reason}",)
-        raise
+    Actions on the same document always go to the same lane, and never twice into the same chunk (so that retrying
+    the rejected actions of a chunk cannot undo a later action on the same document).
+    """
+    serializer = es().transport.serializers.get_serializer("application/json")
+    chunks: list[list[list[bytes]]] = [[] for _ in range(lanes)]
+    sizes = [0] * lanes
+    ids: list[set[tuple[str | None, str]]] = [set() for _ in range(lanes)]
+    n = 0
+
+    async def iterate() -> AsyncGenerator[dict, None]:
+        if isinstance(actions, AsyncIterable):
+            async for action in actions:
+                yield action
+        else:
+            for action in actions:
+                yield action
+
+    async for action in iterate():
+        header, body = elasticsearch.helpers.expand_action(action)
+        meta = next(iter(header.values()))
+        key = (meta.get("_index"), meta["_id"]) if meta.get("_id") is not None else None
+        lane = hash(key) % lanes if key else n % lanes
+        n += 1
+        lines = [serializer.dumps(header)]
+        if body is not None:
+            lines.append(body if isinstance(body, bytes) else serializer.dumps(body))
+        action_size = sum(len(line) + 1 for line in lines)
+        chunk = chunks[lane]
+        if chunk and (sizes[lane] + action_size > max_bytes or len(chunk) >= max_documents or key in ids[lane]):
+            yield lane, chunk
+            chunks[lane], sizes[lane], ids[lane] = [], 0, set()
+        chunks[lane].append(lines)
+        sizes[lane] += action_size
+        if key:
+            ids[lane].add(key)
+    for lane, chunk in enumerate(chunks):
+        if chunk:
+            yield lane, chunk
+
+
+async def _send_bulk_chunk(
+    chunk: list[list[bytes]],
+    refresh: bool | Literal["wait_for"],
+    max_retries: int,
+    initial_backoff: float,
+    max_backoff: float,
+    stats: BulkStats,
+) -> list[tuple[bool, dict]]:
+    """Send a chunk in a bulk request, retrying rejected (429) actions with exponential backoff"""
+    results: list[tuple[bool, dict]] = []
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            stats.retries += 1
+            await asyncio.sleep(min(max_backoff, initial_backoff * 2 ** (attempt - 1)))
+        operations = [line for lines in chunk for line in lines]
+        stats.requests += 1
+        stats.bytes += sum(len(line) + 1 for line in operations)
+        try:
+            # The client sends already serialized (bytes) lines as they are
+            response = await es().bulk(operations=cast(Sequence[Mapping[str, Any]], operations), refresh=refresh)
+        except ApiError as e:
+            if e.meta.status == 429 and attempt < max_retries:
+                continue
+            raise
+        rejected = []
+        for lines, item in zip(chunk, response["items"]):
+            op_type, result = next(iter(item.items()))
+            status = result.get("status", 500)
+            if status == 429 and attempt < max_retries:
+                rejected.append(lines)
+                continue
+            ok = 200 <= status < 300
+            if ok:
+                stats.successes += 1
+            else:
+                stats.failures += 1
+            results.append((ok, {op_type: result}))
+        chunk = rejected
+        if not chunk:
+            break
+    return results
 
 
 async def index_scan(
@@ -130,10 +338,14 @@ async def index_scan(
     source: list[str] | None = None,
     exclude_source: list[str] | None = None,
     scroll: str = "5m",
+    slices: int | None = None,
 ) -> AsyncIterable[tuple[str, dict]]:
     """
     Scan an index in batches of the given size. Yields documents one by one (batching behind the scenes).
     Helpers scan is much faster without sorting (which sets preserve_order to TRUE), so avoid it if you can.
+
+    If slices > 1, the index is scanned with that many sliced scrolls concurrently, which is much faster
+    for large indices. Documents are then yielded in no particular order, so this cannot be combined with sort.
     """
 
     query_body: dict[str, Any] = {}
@@ -145,6 +357,16 @@ async def index_scan(
         query_body["_source_includes"] = source
     if exclude_source is not None:
         query_body["_source_excludes"] = exclude_source
+
+    if slices is not None and slices > 1:
+        if sort is not None:
+            raise ValueError("Cannot sort the results of a sliced index scan")
+        # Use aclosing to make sure the slices are stopped if the caller stops iterating
+        async with aclosing(_sliced_index_scan(index, query_body, slices, batchsize, scroll)) as docs:
+            async for id, doc in docs:
+                yield id, doc
+        return
+
     async for hit in elasticsearch.helpers.async_scan(
         es(),
         index=index,
@@ -156,6 +378,57 @@ async def index_scan(
         yield hit["_id"], hit["_source"]
 
 
+async def index_scan_slices(index: str) -> int:
+    """
+    The number of slices to scan a whole index with (see index_scan): one per primary shard, up to
+    settings.scan_max_slices. Elastic recommends not to use more slices than shards, as that makes a scroll slower.
+    """
+    settings = await es().indices.get_settings(index=index, name="index.number_of_shards")
+    shards = max(int(s["settings"]["index"]["number_of_shards"]) for s in settings.values())
+    return max(1, min(shards, get_settings().scan_max_slices))
+
+
+async def _sliced_index_scan(
+    index: str, query_body: dict[str, Any], slices: int, batchsize: int, scroll: str
+) -> AsyncGenerator[tuple[str, dict], None]:
+    """
+    Run the sliced scrolls concurrently, merging their documents through a bounded queue.
+    Each slice puts None on the queue when it is done, or the exception if it failed.
+    """
+    queue: asyncio.Queue[tuple[str, dict] | Exception | None] = asyncio.Queue(maxsize=batchsize)
+
+    async def scan_slice(slice_id: int) -> None:
+        try:
+            async for hit in elasticsearch.helpers.async_scan(
+                es(),
+                index=index,
+                query={**query_body, "slice": {"id": slice_id, "max": slices}},
+                scroll=scroll,
+                size=batchsize,
+            ):
+                await queue.put((hit["_id"], hit["_source"]))
+            await queue.put(None)
+        except Exception as e:
+            await queue.put(e)
+
+    tasks = [asyncio.create_task(scan_slice(i)) for i in range(slices)]
+    try:
+        running = slices
+        while running:
+            item = await queue.get()
+            if item is None:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        # Stop the other slices (e.g. on error, or if the caller stops iterating), which also clears their scrolls
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
 async def batched_index_scan(
     index: str,
     batchsize: int = 1000,
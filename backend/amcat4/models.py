@@ -1,8 +1,8 @@
 from datetime import UTC, datetime
 from enum import IntEnum
-from typing import Annotated, Any, Literal, Union
+from typing import Annotated, Any, Hashable, Literal, Union
 
-from pydantic import BaseModel, EmailStr, Field, model_validator
+from pydantic import BaseModel, EmailStr, Field, PrivateAttr, model_validator
 from typing_extensions import Self
 
 _IX = r"[a-z0-9][a-z0-9_-]*"
@@ -49,6 +49,16 @@ class RoleRule(BaseModel):
         return self
 
 
+class BulkRoleResult(BaseModel):
+    """The result of setting one role rule with bulk_set_roles"""
+
+    email: str
+    role_context: str
+    role: str
+    result: Literal["created", "updated", "deleted", "not_found", "error"]
+    error: str | None = None
+
+
 ###################### USER AND API KEY SPECIFICATIONS ##########################
 
 
@@ -84,6 +94,26 @@ class User(BaseModel):
     auth_method: AuthMethod = "none"
 
 
+class AuthContext(User):
+    """
+    The user of a single API request (created by the authenticated_user dependency), which memoizes the role rules
+    and field settings that are looked up for it (see systemdata.roles and systemdata.fields). It can be used
+    anywhere a User is expected, and repeated authorization checks within the request then cost no lookups.
+    Memoized values are stored with the cache generation they were loaded at, so changes made during the request
+    (e.g. creating a role) are still seen.
+    """
+
+    _memo: dict[Hashable, tuple[int, Any]] = PrivateAttr(default_factory=dict)
+
+    def memoized(self, key: Hashable, generation: int) -> Any | None:
+        """Get the memoized value for this key, or None if it is missing or has a different generation"""
+        entry = self._memo.get(key)
+        return entry[1] if entry is not None and entry[0] == generation else None
+
+    def memoize(self, key: Hashable, generation: int, value: Any) -> None:
+        self._memo[key] = (generation, value)
+
+
 ######################## DOCUMENT FIELD SPECIFICATIONS #########################
 
 FieldType = Literal[
@@ -304,6 +334,25 @@ class ProjectSettings(BaseModel):
     archived: datetime | None = None
 
 
+class IndexStats(BaseModel):
+    """Statistics of a project index (see projects.stats)"""
+
+    documents: int  # Lucene documents, i.e. including the documents of nested fields
+    bytes: int
+    last_write: datetime | None = None  # when a write to the index was first noticed, or None if none was noticed
+
+
+class ProjectOverview(BaseModel):
+    """Everything needed to show a project to a user (see projects.index.get_project_overview)"""
+
+    settings: ProjectSettings
+    user_role: RoleRule  # the role of the user, counting the server ADMIN role (use this for authorization)
+    project_role: RoleRule  # the role of the user on the project itself
+    guest_role: GuestRole
+    fields: dict[str, DocumentField]
+    stats: IndexStats
+
+
 class ServerSettings(BaseModel):
     name: str | None = None
     description: str | None = None
@@ -357,3 +406,25 @@ class ObjectStorage(BaseModel):
     content_type: AllowedContentType | None = None
     registered: datetime | None = None
     last_synced: datetime | None = None
+
+
+####################### INGEST JOBS #########################
+
+
+class IngestJob(BaseModel):
+    """Status of a background upload (see projects.jobs)"""
+
+    id: str = Field(description="The id of the job, use GET /task/{id} to get its status")
+    index: IndexId
+    email: str | None = Field(default=None, description="The user that started the upload")
+    operation: Literal["index", "upsert", "create", "update"]
+    status: Literal["queued", "running", "completed", "failed"] = "queued"
+    total: int = Field(description="Number of documents in the upload")
+    successes: int = Field(default=0, description="Number of documents uploaded successfully so far")
+    failures: int = Field(default=0, description="Number of documents that failed so far")
+    errors: list[dict[str, Any]] = Field(default_factory=list, description="Details of the first failures")
+    message: str | None = Field(default=None, description="The reason that the job failed")
+    created: datetime = Field(default_factory=lambda: datetime.now(UTC))
+    started: datetime | None = None
+    finished: datetime | None = None
+    updated: datetime | None = Field(default=None, description="When the status of the job was last stored")
@@ -2,15 +2,15 @@
 Aggregate queries
 """
 
-import copy
 from datetime import datetime, timezone
 from typing import Any, AsyncGenerator, Dict, Iterable, List, Literal, Mapping, Sequence, Tuple, Union
 
-from amcat4.connections import es
+from amcat4.config import TotalHitsMode, get_settings
+from amcat4.elastic.msearch import es_search, run_batched
 from amcat4.models import DocumentField, FilterSpec, SortSpec
 from amcat4.projects.date_mappings import interval_mapping
-from amcat4.projects.query import build_body
-from amcat4.systemdata.fields import list_fields
+from amcat4.projects.query import build_body, track_total_hits
+from amcat4.systemdata.fields import list_fields_many
 
 
 def _combine_mappings(mappings):
@@ -158,12 +158,14 @@ class AggregateResult:
         data: List[tuple],
         count_column: str = "n",
         after: dict | None = None,
+        total_count_mode: TotalHitsMode | None = None,
     ):
         self.axes = axes
         self.data = data
         self.aggregations = aggregations
         self.count_column = count_column
         self.after = after
+        self.total_count_mode = total_count_mode
 
     def as_dicts(self) -> Iterable[dict]:
         """Return the results as a sequence of {axis1, ..., n} dicts"""
@@ -175,18 +177,22 @@ class AggregateResult:
 
 
 async def _bare_aggregate(
-    index: str | list[str], queries, filters, aggregations: Sequence[Aggregation | TopHitsAggregation]
+    index: str | list[str],
+    queries,
+    filters,
+    aggregations: Sequence[Aggregation | TopHitsAggregation],
+    total_hits: TotalHitsMode | None = None,
 ) -> Tuple[int, dict]:
     """
-    Aggregate without sources/group_by.
+    Aggregate without sources/group_by. The doc count and aggregations are retrieved in a single search.
     Returns a tuple of doc count and aggregegations (doc_count, {metric: value})
     """
     body = build_body(queries=queries, filters=filters) if filters or queries else {}
     index = index if isinstance(index, str) else ",".join(index)
-    client = es()
-    aresult = await client.search(index=index, size=0, aggregations=aggregation_dsl(aggregations), **body)
-    cresult = await client.count(index=index, **body)
-    return cresult["count"], aresult["aggregations"]
+    if aggregations:
+        body["aggregations"] = aggregation_dsl(aggregations)
+    result = await es_search(index=index, size=0, track_total_hits=track_total_hits(total_hits), **body)
+    return result["hits"]["total"]["value"], result.get("aggregations", {})
 
 
 async def _elastic_aggregate(
@@ -214,8 +220,7 @@ async def _elastic_aggregate(
     if filters or queries:
         q = build_body(queries=queries, filters=filters)
         kargs["query"] = q["query"]
-    client = es()
-    result = await client.search(
+    result = await es_search(
         index=index if isinstance(index, str) else ",".join(index),
         size=0,
         aggregations=aggr,
@@ -225,18 +230,54 @@ async def _elastic_aggregate(
     if failure := result.get("_shards", {}).get("failures"):
         raise Exception(f"Error on running aggregate search: {failure}")
 
-    buckets = result["aggregations"]["aggs"]["buckets"]
-    after_key = result["aggregations"]["aggs"].get("after_key")
+    return _composite_rows(result["aggregations"]["aggs"], axes, aggregations)
 
+
+async def _filters_aggregate(
+    index: str | list[str],
+    queries: dict[str, str],
+    filters: dict[str, FilterSpec] | None,
+    aggregations: list[Aggregation | TopHitsAggregation],
+) -> dict[str, list]:
+    """
+    Aggregate by query (without other axes) in a single search, using a filters aggregation with one bucket per query.
+    Returns a dict of {label: rows}, where the rows do not contain the query label.
+    """
+    byquery: Dict[str, Any] = {
+        "filters": {"filters": {label: build_body(queries={label: query})["query"] for label, query in queries.items()}}
+    }
+    if aggregations:
+        byquery["aggregations"] = aggregation_dsl(aggregations)
+    body = build_body(filters=filters) if filters else {}
+    result = await es_search(
+        index=index if isinstance(index, str) else ",".join(index),
+        size=0,
+        track_total_hits=False,
+        aggregations={"byquery": byquery},
+        **body,
+    )
+    if failure := result.get("_shards", {}).get("failures"):
+        raise Exception(f"Error on running aggregate search: {failure}")
+
+    buckets = result["aggregations"]["byquery"]["buckets"]
+    return {
+        label: [(bucket["doc_count"],) + tuple(a.get_value(bucket) for a in aggregations)] for label, bucket in buckets.items()
+    }
+
+
+def _composite_rows(
+    composite: dict, axes: list[Axis], aggregations: list[Aggregation | TopHitsAggregation]
+) -> Tuple[list, dict | None]:
+    """Get the rows and after_key from a composite aggregation result"""
     rows = []
-    for bucket in buckets:
+    for bucket in composite["buckets"]:
         row = tuple(axis.get_value(bucket["key"]) for axis in axes)
         row += (bucket["doc_count"],)
         if aggregations:
             row += tuple(a.get_value(bucket) for a in aggregations)
         rows.append(row)
 
-    return rows, after_key
+    return rows, composite.get("after_key")
 
 
 async def _aggregate_results(
@@ -246,64 +287,68 @@ async def _aggregate_results(
     filters: dict[str, FilterSpec] | None,
     aggregations: List[Aggregation | TopHitsAggregation],
     after: dict[str, Any] | None = None,
+    total_hits: TotalHitsMode | None = None,
 ) -> AsyncGenerator[Tuple[list, dict | None], None]:
     if not axes or len(axes) == 0:
         # Path 1
         # No axes, so return aggregations (or total count) only
-        if aggregations:
-            count, results = await _bare_aggregate(index, queries, filters, aggregations)
-            rows = [(count,) + tuple(a.get_value(results) for a in aggregations)]
-        else:
-            client = es()
-            result = await client.count(
-                index=index if isinstance(index, str) else ",".join(index), **build_body(queries=queries, filters=filters)
-            )
-            rows = [(result["count"],)]
+        count, results = await _bare_aggregate(index, queries, filters, aggregations, total_hits)
+        rows = [(count,) + tuple(a.get_value(results) for a in aggregations)]
         yield rows, None
 
     elif any(ax.field == "_query" for ax in axes):
         # Path 2
-        # We cannot run the aggregation for multiple queries at once, so we loop over queries
-        # and recursively call _aggregate_results with one query at a time (which then uses path 3).
+        # Aggregate by query. Without other axes, this is a single filters aggregation (one bucket per query).
+        # Otherwise, we get the first page of a composite aggregation for every query in a single _msearch,
+        # and paginate each query separately. The after cursor then contains the query label to continue
+        # from (plus the composite after key for that query).
         if queries is None:
             raise ValueError("Queries must be specified when aggregating by query")
-        # Strip off _query axis and run separate aggregation for each query
+        # Strip off _query axis, and insert the query label into the rows at the right position
         i = [ax.field for ax in axes].index("_query")
         _axes = axes[:i] + axes[(i + 1) :]
+        sources = [axis.query() for axis in _axes]
+        runtime_mappings = _combine_mappings(axis.runtime_mappings() for axis in _axes)
+
+        labels = list(queries.keys())
+        first_after = None
+        if after is not None and "_query" in after:
+            if after["_query"] not in queries:
+                raise ValueError(f"Unknown query label in after: {after['_query']}")
+            labels = labels[labels.index(after["_query"]) :]
+            first_after = {k: v for k, v in after.items() if k != "_query"} or None
+
+        async def query_page(label: str, after_key: dict | None) -> Tuple[list, dict | None]:
+            return await _elastic_aggregate(
+                index, sources, _axes, {label: queries[label]}, filters, aggregations, runtime_mappings, after_key
+            )
 
-        query_items = list(queries.items())
-        for label, query in query_items:
-            last_query = label == query_items[-1][0]
-
-            if after is not None and "_query" in after:
-                # after is a dict with the aggregation values from which to continue
-                # pagination. Since we loop over queries, we add the _query value.
-                # Then after continuing from the right query, we remove this _query
-                # key so that the after dict is as elastic expects it
-                if after.get("_query") != label:
-                    continue
-                after.pop("_query", None)
-
-            async for rows, after_buckets in _aggregate_results(
-                index, _axes, {label: query}, filters, aggregations, after=after
-            ):
-                after_buckets = copy.deepcopy(after_buckets)
-
-                # insert label into the right position on the result tuple
-                rows = [result_tuple[:i] + (label,) + result_tuple[i:] for result_tuple in rows]
+        pages: dict[str, Tuple[list, dict | None]]
+        if _axes:
+            first_pages = await run_batched(
+                [query_page(label, first_after if n == 0 else None) for n, label in enumerate(labels)]
+            )
+            pages = dict(zip(labels, first_pages))
+        else:
+            label_rows = await _filters_aggregate(index, {label: queries[label] for label in labels}, filters, aggregations)
+            pages = {label: (label_rows[label], None) for label in labels}
 
-                if after_buckets is None:
-                    # if there are no buckets left for this query, we check if this is the last query.
-                    # If not, we need to return the _query value to ensure pagination continues from this query
-                    if not last_query:
-                        after_buckets = {"_query": label}
+        for n, label in enumerate(labels):
+            rows, after_key = pages[label]
+            while True:
+                rows = [result_tuple[:i] + (label,) + result_tuple[i:] for result_tuple in rows]
+                if after_key is not None:
+                    # There are buckets left for this query, so continue from here
+                    after_buckets = {**after_key, "_query": label}
+                elif n < len(labels) - 1:
+                    # This query is done, so continue from the start of the next query
+                    after_buckets = {"_query": labels[n + 1]}
                 else:
-                    # if there are buckets left, we add the _query value to ensure pagination continues from this query
-                    after_buckets["_query"] = label
+                    after_buckets = None
                 yield rows, after_buckets
-
-            # after only applies to the first query
-            after = None
+                if after_key is None:
+                    break
+                rows, after_key = await query_page(label, after_key)
 
     else:
         # Path 3
@@ -327,6 +372,7 @@ async def query_aggregate(
     queries: dict[str, str] | None = None,
     filters: dict[str, FilterSpec] | None = None,
     after: dict[str, Any] | None = None,
+    total_hits: TotalHitsMode | None = None,
 ) -> AggregateResult:
     """
     Conduct an aggregate query.
@@ -339,6 +385,8 @@ async def query_aggregate(
     :param queries: Optional query string
     :param filters: if not None, a dict of filters: {field: {'value': value}} or
                     {field: {'range': {'gte/gt/lte/lt': value, 'gte/gt/..': value, ..}}
+    :param total_hits: How to count the total number of hits if there are no axes (exact, bounded or approximate).
+                       If None, use settings.total_hits_mode. Approximate counts are bounded by the threshold.
     :return: a pair of (Axis, results), where results is a sequence of tuples
     """
     if axes and sum([x.field == "_query" for x in axes[1:]]) > 1:
@@ -346,15 +394,14 @@ async def query_aggregate(
 
     all_fields: dict[str, DocumentField] = dict()
     indices = index if isinstance(index, list) else [index]
-    for index in indices:
-        index_fields = await list_fields(index)
+    for index_fields in (await list_fields_many(indices)).values():
         for field_name, field in index_fields.items():
             if field_name not in all_fields:
                 all_fields[field_name] = field
             else:
                 if field.type != all_fields[field_name].type:
                     raise ValueError(f"Type of {field_name} is not the same in all indices")
-        all_fields.update(await list_fields(index))
+        all_fields.update(index_fields)
 
     if not axes:
         axes = []
@@ -370,7 +417,8 @@ async def query_aggregate(
     # we return the data and the last_after cursor. If the user needs to collect the rest,
     # they need to paginate
     stop_after = 1000
-    gen = _aggregate_results(indices, axes, queries, filters, aggregations, after)
+    total_hits = total_hits or get_settings().total_hits_mode
+    gen = _aggregate_results(indices, axes, queries, filters, aggregations, after, total_hits)
     data = list()
     last_after = None
     async for rows, after in gen:
@@ -378,4 +426,4 @@ async def query_aggregate(
         last_after = after
         if len(data) > stop_after:
             break
-    return AggregateResult(axes, aggregations, data, count_column="n", after=last_after)
+    return AggregateResult(axes, aggregations, data, count_column="n", after=last_after, total_count_mode=total_hits)
@@ -1,13 +1,25 @@
+import asyncio
 import hashlib
 import json
 import logging
-from typing import Any, AsyncGenerator, Literal, Mapping
+from typing import Any, AsyncGenerator, AsyncIterable, Literal, Mapping
 
 import elasticsearch.helpers
+from typing_extensions import TypedDict
 
 from amcat4.connections import es
-from amcat4.models import CreateDocumentField, DocumentFieldDefinition, FieldType
-from amcat4.systemdata.fields import coerce_type, create_fields, create_or_verify_tag_field, list_fields
+from amcat4.elastic.util import es_bulk, es_bulk_stream
+from amcat4.models import CreateDocumentField, DocumentField, DocumentFieldDefinition, FieldType
+from amcat4.projects.result_cache import bump_write_generation
+from amcat4.systemdata.fields import coercer, create_fields, create_or_verify_tag_field, list_fields
+
+# Batches of at least this many documents are converted into bulk actions in a worker thread
+THREAD_THRESHOLD = 5000
+
+
+class UploadResult(TypedDict):
+    successes: int
+    failures: list[dict]
 
 
 async def create_or_update_documents(
@@ -17,7 +29,7 @@ async def create_or_update_documents(
     op_type: Literal["index", "create", "update", "upsert"] = "index",
     raise_on_error=False,
     refresh=False,
-):
+) -> UploadResult:
     """
     Upload documents to this index
 
@@ -28,68 +40,182 @@ async def create_or_update_documents(
         'update' (partial update, error if not exists), or 'upsert' (partial update, create if not exists)
     """
     if fields:
-        create_fields_dict: dict[str, CreateDocumentField] = dict()
-        for k, v in fields.items():
-            if isinstance(v, str):
-                create_fields_dict[k] = CreateDocumentField(type=v)
-            else:
-                create_fields_dict[k] = CreateDocumentField(**v.model_dump())
+        await create_upload_fields(index, fields)
 
-        await create_fields(index, create_fields_dict)
-
-    actions = [a async for a in upload_document_es_actions(index, documents, op_type)]
+    actions = await document_es_actions(index, documents, op_type)
     try:
-        successes, failures = await elasticsearch.helpers.async_bulk(
-            es(),
-            actions,
-            stats_only=False,
-            raise_on_error=raise_on_error,
-            refresh="wait_for" if refresh else False,
-        )
+        stats, failures = await es_bulk(actions, raise_on_error=raise_on_error, refresh="wait_for" if refresh else False)
     except elasticsearch.helpers.BulkIndexError as e:
         logging.error("Error on indexing: " + json.dumps(e.errors, indent=2, default=str))
-        if e.errors:
-            _, error = list(e.errors[0].items())[0]
-            reason = error.get("error", {}).get("reason", error)
-            e.args = e.args + (f"First error: {reason}",)
         raise
+    finally:
+        await bump_write_generation(index)
+
+    return UploadResult(successes=stats.successes, failures=failures)
+
+
+async def create_upload_fields(index: str, fields: Mapping[str, FieldType | DocumentFieldDefinition]) -> None:
+    """Create (or verify) the field definitions given with an upload"""
+    create_fields_dict: dict[str, CreateDocumentField] = dict()
+    for k, v in fields.items():
+        if isinstance(v, str):
+            create_fields_dict[k] = CreateDocumentField(type=v)
+        else:
+            create_fields_dict[k] = CreateDocumentField(**v.model_dump())
+
+    await create_fields(index, create_fields_dict)
 
-    return dict(successes=successes, failures=failures)
 
+async def document_es_actions(
+    index: str, documents: list[dict[str, Any]], op_type: Literal["index", "create", "update", "upsert"]
+) -> list[dict]:
+    """
+    Convert the documents into elasticsearch bulk actions. Raises a ValueError for the first invalid document.
+    Large batches are converted in a worker thread, so the event loop can keep serving other requests.
+    """
+    converter = DocumentConverter(index, op_type, await list_fields(index))
+    if len(documents) >= THREAD_THRESHOLD:
+        return await asyncio.to_thread(converter.actions, documents)
+    return converter.actions(documents)
 
-async def upload_document_es_actions(index, documents, op_type) -> AsyncGenerator[dict, None]:
-    field_settings = await list_fields(index)
-    identifiers = [k for k, v in field_settings.items() if v.identifier is True]
-    es_op_type = "update" if op_type in ("update", "upsert") else op_type
-    for document in documents:
+
+async def stream_documents(
+    index: str,
+    documents: AsyncIterable[dict[str, Any] | ValueError],
+    op_type: Literal["index", "create", "update", "upsert"] = "index",
+    chunk_size: int = 500,
+    refresh=False,
+) -> AsyncGenerator[UploadResult, None]:
+    """
+    Upload documents from an async stream, without keeping all documents in memory.
+    Documents are converted and sent to elasticsearch (in bulk requests of at most chunk_size) as they come in.
+    Yields an UploadResult (successes=..., failures=[...]) for every chunk. Invalid documents (e.g. with fields that
+    are not specified) are reported as failures with the (1-based) position of the document in the stream,
+    and do not stop the upload. Documents that could not be parsed can be passed as a ValueError (describing the
+    problem), and are reported as failures in the same way. See create_or_update_documents for the other parameters.
+    """
+    converter = DocumentConverter(index, op_type, await list_fields(index))
+    invalid: list[dict] = []
+
+    async def actions() -> AsyncGenerator[dict, None]:
+        n = 0
+        async for document in documents:
+            n += 1
+            try:
+                if isinstance(document, ValueError):
+                    raise document
+                yield converter.action(document)
+            except ValueError as e:
+                invalid.append(dict(document=n, error=str(e)))
+
+    successes, failures = 0, []
+    try:
+        async for ok, item in es_bulk_stream(actions(), max_documents=chunk_size, refresh="wait_for" if refresh else False):
+            if ok:
+                successes += 1
+            else:
+                failures.append(item)
+            if successes + len(failures) >= chunk_size:
+                yield UploadResult(successes=successes, failures=invalid + failures)
+                successes, failures, invalid[:] = 0, [], []
+    finally:
+        await bump_write_generation(index)
+    if successes or failures or invalid:
+        yield UploadResult(successes=successes, failures=invalid + failures)
+
+
+class DocumentConverter:
+    """
+    Converts uploaded documents into elasticsearch bulk actions.
+
+    The conversion is prepared once per upload from the field settings of the index: the coercion function of
+    every field (see systemdata.fields.coercer) and the sorted identifier fields. Batches of documents are
+    converted field by field, so the work per value is only calling the coercion function of its field.
+    """
+
+    def __init__(
+        self,
+        index: str,
+        op_type: Literal["index", "create", "update", "upsert"],
+        field_settings: Mapping[str, DocumentField],
+    ):
+        self.index = index
+        self.op_type = op_type
+        self.es_op_type = "update" if op_type in ("update", "upsert") else op_type
+        self.coercers = {name: coercer(field.type) for name, field in field_settings.items()}
+        self.identifiers = sorted(name for name, field in field_settings.items() if field.identifier is True)
+        self.id_allowed = not self.identifiers or op_type == "update"
+
+    def action(self, document: dict[str, Any]) -> dict:
+        """Convert a single document into a bulk action"""
         doc = dict()
-        action = {"_op_type": es_op_type, "_index": index}
+        action = {"_op_type": self.es_op_type, "_index": self.index}
 
-        for key in document.keys():
-            if key in field_settings:
-                if document[key] is not None:
-                    doc[key] = coerce_type(document[key], field_settings[key].type)
+        for key, value in document.items():
+            coerce = self.coercers.get(key)
+            if coerce is not None:
+                if value is not None:
+                    doc[key] = coerce(value)
             elif key == "_id":
-                if len(identifiers) > 0 and op_type != "update":
-                    raise ValueError(f"This index uses identifiers ({identifiers}), so you cannot set the _id directly.")
-                action["_id"] = document[key]
+                if not self.id_allowed:
+                    raise ValueError(f"This index uses identifiers ({self.identifiers}), so you cannot set the _id directly.")
+                action["_id"] = value
             else:
                 raise ValueError(f"Field '{key}' is not yet specified")
 
-        if len(identifiers) > 0:
-            action["_id"] = _create_document_id(document, identifiers)
+        return self._finish_action(action, document, doc)
+
+    def actions(self, documents: list[dict[str, Any]]) -> list[dict]:
+        """
+        Convert a batch of documents into bulk actions, one field at a time.
+        Raises a ValueError for the first invalid document.
+        """
+        keys: set[str] = set().union(*documents)
+        fields = keys - {"_id"}
+        if ("_id" in keys and not self.id_allowed) or not fields <= self.coercers.keys():
+            # Convert the documents one by one to raise the error for the first invalid document
+            return [self.action(document) for document in documents]
+
+        docs: list[dict] = [dict() for _ in documents]
+        try:
+            for field in fields:
+                coerce = self.coercers[field]
+                for doc, value in zip(docs, [document.get(field) for document in documents]):
+                    if value is not None:
+                        doc[field] = coerce(value)
+        except ValueError:
+            return [self.action(document) for document in documents]
+
+        actions = []
+        for document, doc in zip(documents, docs):
+            action = {"_op_type": self.es_op_type, "_index": self.index}
+            if "_id" in document:
+                action["_id"] = document["_id"]
+            actions.append(self._finish_action(action, document, doc))
+        return actions
+
+    def document_id(self, document: dict[str, Any]) -> str:
+        """Create the _id for a document from the values of the identifier fields"""
+        if not self.identifiers:
+            raise ValueError("Can only create id if identifiers are specified")
+        id_fields = {k: document[k] for k in self.identifiers if k in document}
+        hash_str = json.dumps(id_fields, sort_keys=True, ensure_ascii=True, default=str).encode("ascii")
+        return hashlib.sha224(hash_str).hexdigest()
+
+    def _finish_action(self, action: dict, document: dict[str, Any], doc: dict) -> dict:
+        if self.identifiers:
+            action["_id"] = self.document_id(document)
             # if no _id is given and no identifiers are used, elasticsearch creates a cool unique one
 
         # https://www.elastic.co/guide/en/elasticsearch/reference/current/docs-bulk.html
-        if op_type in ("update", "upsert"):
+        if self.op_type in ("update", "upsert"):
             if "_id" not in action:
                 raise ValueError("Update requires _id")
             action["doc"] = doc
-            action["doc_as_upsert"] = op_type == "upsert"
+            action["doc_as_upsert"] = self.op_type == "upsert"
         else:
             action = {**doc, **action}
-
-        yield action
+        return action
 
 
 async def fetch_document(index: str, doc_id: str, **kargs) -> dict:
@@ -116,6 +242,7 @@ async def update_document(
     :param get_source: If True, return the updated document source
     """
     await es().update(index=index, id=doc_id, doc=fields, source=get_source, doc_as_upsert=ignore_missing)  # type: ignore
+    await bump_write_generation(index)
 
 
 async def delete_document(index: str, doc_id: str, ignore_missing: bool = False):
@@ -126,6 +253,7 @@ async def delete_document(index: str, doc_id: str, ignore_missing: bool = False)
     :param doc_id: The document id (hash)
     """
     await es().delete(index=index, id=doc_id)
+    await bump_write_generation(index)
 
 
 UPDATE_SCRIPTS = dict(
@@ -177,6 +305,7 @@ async def update_document_tag_by_query(
         params=dict(field=field, tag=tag),
     )
     result = await es().update_by_query(index=index, script=script, **query, refresh=True)
+    await bump_write_generation(index)
     return dict(updated=result["updated"], total=result["total"])
 
 
@@ -194,25 +323,11 @@ async def update_documents_by_query(index: str | list[str], query: dict, field:
             params=dict(field=field, value=value),
         )
     result = await es().update_by_query(index=index, query=query, script=script, refresh=True)
+    await bump_write_generation(index)
     return dict(updated=result["updated"], total=result["total"])
 
 
 async def delete_documents_by_query(index: str | list[str], query: dict):
     result = await es().delete_by_query(index=index, query=query, refresh=True)
+    await bump_write_generation(index)
     return dict(updated=result["deleted"], total=result["total"])
-
-
-def _create_document_id(document: dict, identifiers: list[str]) -> str:
-    """
-    Create the _id for a document.
-    """
-
-    if len(identifiers) == 0:
-        raise ValueError("Can only create id if identifiers are specified")
-
-    id_keys = sorted(set(identifiers) & set(document.keys()))
-    id_fields = {k: document[k] for k in id_keys}
-    hash_str = json.dumps(id_fields, sort_keys=True, ensure_ascii=True, default=str).encode("ascii")
-    m = hashlib.sha224()
-    m.update(hash_str)
-    return m.hexdigest()
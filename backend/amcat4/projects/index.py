@@ -1,23 +1,33 @@
+import asyncio
 import logging
 from datetime import UTC, datetime
 from typing import AsyncIterable, Mapping
 
 from botocore.exceptions import BotoCoreError
+from elasticsearch import NotFoundError
 
 from amcat4.config import get_settings
 from amcat4.connections import es, s3_enabled
 from amcat4.elastic.util import index_scan
-from amcat4.models import CreateDocumentField, FieldType, IndexId, ProjectSettings, RoleRule, Roles, User
+from amcat4.models import CreateDocumentField, FieldType, IndexId, ProjectOverview, ProjectSettings, RoleRule, Roles, User
 from amcat4.objectstorage.multimedia import delete_project_multimedia
-from amcat4.systemdata.fields import create_fields, delete_all_project_fields, list_fields
-from amcat4.systemdata.roles import list_user_project_roles
+from amcat4.projects.result_cache import bump_write_generation, forget_index
+from amcat4.projects.stats import get_index_stats, invalidate_index_stats
+from amcat4.systemdata.fields import (
+    create_fields,
+    delete_all_project_fields,
+    fields_changed,
+    list_and_repair_fields,
+    list_fields,
+)
+from amcat4.systemdata.roles import fetch_user_project_roles, project_access_filter, project_role_ids, resolve_project_roles
 from amcat4.systemdata.settings import (
     create_project_settings,
     delete_project_settings,
     get_project_settings,
     update_project_settings,
 )
-from amcat4.systemdata.versions import settings_index_id, settings_index_name
+from amcat4.systemdata.versions import roles_index_name, settings_index_id, settings_index_name
 
 
 class IndexDoesNotExist(ValueError):
@@ -74,9 +84,10 @@ async def register_project_index(
         raise IndexAlreadyExists(f'Project "{index.id}" is already registered')
 
     await create_project_settings(index, admin_email)
+    invalidate_index_stats(index.id)  # the index may have been remembered as missing
     if mappings:
         await create_fields(index.id, mappings)
-    await list_fields(index.id)  # This will infer field types from the existing mappings
+    await list_and_repair_fields(index.id)  # This will infer field types from the existing mappings
 
 
 async def deregister_project_index(index_id: str):
@@ -101,14 +112,14 @@ async def archive_project_index(index_id: str, archived: bool):
             index=settings_index_name(),
             id=settings_index_id(index_id),
             doc={"project_settings": {"archived": archived_at}},
-            refresh=True,
+            refresh="wait_for",
         )
     else:
         await es().update(
             index=settings_index_name(),
             id=settings_index_id(index_id),
             script={"source": "ctx._source.project_settings.remove('archived')", "lang": "painless"},
-            refresh=True,
+            refresh="wait_for",
         )
 
 
@@ -124,6 +135,8 @@ async def clear_project_index(index_id: str):
             logging.warning(f"Could not delete multimedia for index {index_id}: {e}")
 
     await es().indices.delete(index=index_id)
+    await bump_write_generation(index_id)
+    invalidate_index_stats(index_id)
     await create_es_index(index_id)
     await delete_all_project_fields(index_id)
 
@@ -143,6 +156,9 @@ async def delete_project_index(index_id: str, ignore_missing: bool = False):
 
     _es = es().options(ignore_status=404) if ignore_missing else es()
     await _es.indices.delete(index=index_id)
+    await fields_changed(index_id)
+    await forget_index(index_id)
+    invalidate_index_stats(index_id)
 
     await delete_project_settings(index_id, ignore_missing)
 
@@ -151,14 +167,24 @@ async def list_project_indices(ids: list[str] | None = None, skip_archived: bool
     """
     List all project indices, or only those with the given ids.
     """
-    query = {"bool": {}}
+    exclude_source = ["project_settings.image.base64", "server_settings"]
+
     if ids is not None:
-        query["bool"]["must"] = {"terms": {"_id": ids}}
+        # Get known ids with (realtime) mget, so recent changes are seen without waiting for a refresh
+        docs = (await es().mget(index=settings_index_name(), ids=ids, source_excludes=exclude_source))["docs"] if ids else []
+        for doc in docs:
+            if not doc.get("found") or doc["_id"].startswith("_"):
+                continue
+            project_settings = doc["_source"]["project_settings"]
+            if skip_archived and project_settings.get("archived"):
+                continue
+            yield ProjectSettings.model_validate(project_settings)
+        return
+
+    query = {"bool": {}}
     if skip_archived:
         query["bool"]["must_not"] = {"exists": {"field": "project_settings.archived"}}
 
-    exclude_source = ["project_settings.image.base64", "server_settings"]
-
     async for id, ix in index_scan(settings_index_name(), query=query, exclude_source=exclude_source):
         if id.startswith("_"):
             continue
@@ -177,29 +203,114 @@ async def refresh_index(index: str):
     await es().indices.refresh(index=index)
 
 
+# Fields of the settings documents that are not needed to list projects
+_PROJECT_LIST_EXCLUDE = ["project_settings.image.base64", "server_settings", "access"]
+# Number of projects fetched per request when listing all projects of a user
+_PROJECT_LIST_BATCH = 1000
+
+
 async def list_user_project_indices(
-    user: User, show_all=False, show_archived=False
+    user: User, show_all=False, show_archived=False, search: str | None = None, folder: str | None = None
 ) -> AsyncIterable[tuple[ProjectSettings, RoleRule | None]]:
     """
-    List all indices that a user has any role on.
+    List all indices that a user has any role on, optionally filtered on a search string and/or folder.
     Return both the index and RoleRule that the user matched for that index (can be None if show_all is True)
-    TODO: add pagination and search here
     """
+    after: str | None = None
+    while True:
+        page, after = await list_user_project_indices_page(
+            user, _PROJECT_LIST_BATCH, after, show_all, show_archived, search=search, folder=folder
+        )
+        for result in page:
+            yield result
+        if after is None:
+            return
+
+
+async def list_user_project_indices_page(
+    user: User,
+    per_page: int,
+    after: str | None = None,
+    show_all=False,
+    show_archived=False,
+    search: str | None = None,
+    folder: str | None = None,
+) -> tuple[list[tuple[ProjectSettings, RoleRule | None]], str | None]:
+    """
+    Get a page of the indices that a user has any role on (see list_user_project_indices), ordered by id.
+    Returns the page and the cursor for the next page (or None if this was the last page).
+    The cursor is the id of the last index on this page, and can be passed as after to get the next page.
+
+    The query only selects projects that the user's email patterns have access to, but the user's role on some of
+    these can be too low. As those are skipped, more batches are fetched until the page is full.
+    """
+    query = _user_project_indices_query(user, show_all, show_archived, search, folder)
+    page: list[tuple[ProjectSettings, RoleRule | None]] = []
+    while True:
+        res = await es().search(
+            index=settings_index_name(),
+            query=query,
+            size=per_page,
+            sort=[{"project_settings.id": "asc"}],
+            search_after=[after] if after is not None else None,
+            source_excludes=_PROJECT_LIST_EXCLUDE,
+        )
+        hits = res["hits"]["hits"]
+        project_ids = [hit["_source"]["project_settings"]["id"] for hit in hits]
+        user_roles = await _user_project_indices_roles(user, show_all, project_ids)
+        for hit in hits:
+            after = hit["sort"][0]
+            if result := _user_project_index(user, hit["_source"], user_roles):
+                page.append(result)
+                if len(page) == per_page:
+                    return page, after
+        if len(hits) < per_page:
+            return page, None
+
+
+def _user_project_indices_query(
+    user: User, show_all: bool, show_archived: bool, search: str | None, folder: str | None
+) -> dict:
+    filters: list[dict] = [{"exists": {"field": "project_settings.id"}}]
+    if not show_all:
+        ## show_all is ONLY ALLOWED FOR SERVER ADMINS. make sure to check role before setting this param
+        filters.append(project_access_filter(user))
+    if folder is not None:
+        filters.append({"term": {"project_settings.folder": folder}})
+    query: dict = {"bool": {"filter": filters}}
+    if not show_archived:
+        query["bool"]["must_not"] = {"exists": {"field": "project_settings.archived"}}
+    if search:
+        query["bool"]["must"] = {
+            "bool": {
+                "should": [
+                    {"prefix": {"project_settings.id": search.lower()}},
+                    {"match_phrase_prefix": {"project_settings.name": search}},
+                    {"match": {"project_settings.description": search}},
+                ],
+                "minimum_should_match": 1,
+            }
+        }
+    return query
+
+
+async def _user_project_indices_roles(user: User, show_all: bool, project_ids: list[IndexId]) -> dict[str, RoleRule] | None:
     if show_all:
-        ## ONLY ALLOWED FOR SERVER ADMINS. make sure to check role before setting this param
-        async for index in list_project_indices(skip_archived=not show_archived):
-            yield index, RoleRule(role=Roles.ADMIN.name, role_context=index.id, email=user.email or "*")
-        return
+        return None
+    return await fetch_user_project_roles(user, project_ids, required_role=Roles.OBSERVER)
 
-    project_role_lookup: dict[str, RoleRule] = {}
-    user_indices: list[str] = []
-    roles = await list_user_project_roles(user, required_role=Roles.OBSERVER)
-    for role in roles:
-        project_role_lookup[role.role_context] = role
-        user_indices.append(role.role_context)
 
-    async for index in list_project_indices(ids=user_indices, skip_archived=not show_archived):
-        yield index, project_role_lookup[index.id]
+def _user_project_index(
+    user: User, doc: dict, user_roles: dict[str, RoleRule] | None
+) -> tuple[ProjectSettings, RoleRule] | None:
+    """Get the project settings and user role for a settings document, or None if the user has no role on it"""
+    index = ProjectSettings.model_validate(doc["project_settings"])
+    if user_roles is None:
+        return index, RoleRule(role=Roles.ADMIN.name, role_context=index.id, email=user.email or "*")
+    # The project access can include roles that are too low or restricted for this user
+    if role := user_roles.get(index.id):
+        return index, role
+    return None
 
 
 async def list_unregistered_indices() -> list[str]:
@@ -213,9 +324,38 @@ async def list_unregistered_indices() -> list[str]:
     return sorted(name for name in all_indices.keys() if not name.startswith(prefix) and name not in registered_ids)
 
 
-async def index_size_in_bytes(index_id: IndexId) -> int:
-    response = await es().indices.stats(
-        index=index_id,
-        metric="store",
+async def get_project_overview(user: User, index_id: IndexId, refresh_stats: bool = False) -> ProjectOverview:
+    """
+    Get the settings, the roles of the user and of guests, the fields, and the (cached) statistics of a project.
+    The settings document and the role documents are fetched with a single mget, concurrently with the
+    other lookups. Raises IndexDoesNotExist if the project is not registered or its elasticsearch index does not exist.
+    """
+    docs: list[dict] = [
+        {"_index": settings_index_name(), "_id": settings_index_id(index_id), "_source": {"excludes": _PROJECT_LIST_EXCLUDE}}
+    ]
+    docs += [{"_index": roles_index_name(), "_id": id} for id in project_role_ids(user, index_id)]
+    try:
+        system_docs, fields, stats = await asyncio.gather(
+            es().mget(docs=docs),
+            list_fields(index_id),
+            get_index_stats([index_id], refresh=refresh_stats),
+        )
+    except NotFoundError:
+        raise IndexDoesNotExist(f"Index {index_id} has no corresponding Elasticsearch index")
+
+    settings_doc, *role_docs = system_docs["docs"]
+    if not settings_doc.get("found"):
+        raise IndexDoesNotExist(f"Index {index_id} does not exist")
+    if index_id not in stats:
+        raise IndexDoesNotExist(f"Index {index_id} has no corresponding Elasticsearch index")
+    rules = [RoleRule.model_validate(doc["_source"]) for doc in role_docs if doc.get("found")]
+    user_role, project_role, guest_role = resolve_project_roles(user, index_id, rules)
+
+    return ProjectOverview(
+        settings=ProjectSettings.model_validate(settings_doc["_source"]["project_settings"]),
+        user_role=user_role,
+        project_role=project_role,
+        guest_role=guest_role,
+        fields=fields,
+        stats=stats[index_id],
     )
-    return response["indices"][index_id]["total"]["store"]["size_in_bytes"]
@@ -0,0 +1,198 @@
+"""
+Background uploads (ingest jobs).
+
+Large uploads can take longer than clients (or proxies) are willing to wait. With enqueue_upload, the documents
+are put on a queue and the request can return immediately with the id of the job. A pool of workers in the API
+process (settings.ingest_workers) uploads the queued documents with create_or_update_documents, which also caps
+the bulk load that a single process puts on the cluster. The status of every job (queued, running, completed or
+failed, with the number of successes and failures) is stored in the jobs system index, and can be retrieved with
+get_job (or GET /task/{id}) from any worker.
+
+The documents of queued jobs are only kept in memory. When the server is stopped (see ingest_workers),
+jobs that are still queued or running are marked as failed. If a worker crashes, its jobs cannot be marked,
+so when the server is started, queued or running jobs that were not updated for STALE_JOB_AGE seconds are
+marked as failed (see fail_stale_jobs).
+"""
+
+import asyncio
+import json
+import logging
+import uuid
+from contextlib import asynccontextmanager
+from datetime import UTC, datetime
+from typing import Any, AsyncGenerator, Literal, Mapping
+
+from elasticsearch import NotFoundError
+
+from amcat4.config import get_settings
+from amcat4.connections import es
+from amcat4.models import DocumentFieldDefinition, FieldType, IngestJob
+from amcat4.projects.documents import create_or_update_documents, create_upload_fields
+from amcat4.systemdata.versions import jobs_index_name
+
+# Number of documents that are uploaded between progress updates
+PROGRESS_INTERVAL = 1000
+# Number of failed documents for which the details are stored in the job
+MAX_ERRORS = 10
+# Queued or running jobs that were not updated for this many seconds are assumed to be lost (see fail_stale_jobs)
+STALE_JOB_AGE = 3600
+
+_QUEUE: asyncio.Queue[tuple[IngestJob, list[dict[str, Any]]]] | None = None
+_WORKERS: list[asyncio.Task] = []
+
+
+class IngestQueueFull(Exception):
+    pass
+
+
+async def enqueue_upload(
+    index: str,
+    documents: list[dict[str, Any]],
+    fields: Mapping[str, FieldType | DocumentFieldDefinition] | None = None,
+    op_type: Literal["index", "create", "update", "upsert"] = "index",
+    email: str | None = None,
+) -> IngestJob:
+    """
+    Queue the documents to be uploaded in the background (see create_or_update_documents for the parameters).
+    The fields are created immediately, so invalid field definitions are raised here.
+    Raises IngestQueueFull if there are already settings.ingest_queue_size jobs waiting.
+    """
+    queue = _ingest_queue()
+    if queue.full():
+        raise IngestQueueFull("Too many uploads are waiting to be processed, please try again later")
+    if fields:
+        await create_upload_fields(index, fields)
+
+    job = IngestJob(id=uuid.uuid4().hex, index=index, email=email, operation=op_type, total=len(documents))
+    await _save_job(job)
+    try:
+        queue.put_nowait((job, documents))
+    except asyncio.QueueFull:
+        await _finish_job(job, "failed", "Too many uploads are waiting to be processed")
+        raise IngestQueueFull("Too many uploads are waiting to be processed, please try again later")
+    return job
+
+
+async def get_job(job_id: str) -> IngestJob | None:
+    try:
+        doc = await es().get(index=jobs_index_name(), id=job_id)
+    except NotFoundError:
+        return None
+    source = doc["_source"]
+    return IngestJob.model_validate({**source, "id": job_id, "errors": json.loads(source.get("errors") or "[]")})
+
+
+async def run_job(job: IngestJob, documents: list[dict[str, Any]]) -> None:
+    """Upload the documents of this job, storing the progress after every PROGRESS_INTERVAL documents"""
+    job.status = "running"
+    job.started = datetime.now(UTC)
+    await _save_job(job)
+    try:
+        for i in range(0, len(documents), PROGRESS_INTERVAL):
+            result = await create_or_update_documents(job.index, documents[i : i + PROGRESS_INTERVAL], op_type=job.operation)
+            job.successes += result["successes"]
+            job.failures += len(result["failures"])
+            job.errors += result["failures"][: MAX_ERRORS - len(job.errors)]
+            await _save_job(job)
+    except asyncio.CancelledError:
+        await _finish_job(job, "failed", "The server was stopped before the upload was finished")
+        raise
+    except Exception as e:
+        logging.exception(f"Error in ingest job {job.id}")
+        await _finish_job(job, "failed", str(e))
+    else:
+        await _finish_job(job, "completed")
+
+
+async def stop_ingest_workers() -> None:
+    """Stop the workers, marking the running and queued jobs as failed"""
+    global _QUEUE
+    queue, _QUEUE = _QUEUE, None
+    workers = list(_WORKERS)
+    _WORKERS.clear()
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    while queue is not None and not queue.empty():
+        job, _ = queue.get_nowait()
+        await _finish_job(job, "failed", "The server was stopped before the upload was started")
+
+
+async def fail_stale_jobs(max_age: float = STALE_JOB_AGE) -> int:
+    """
+    Mark queued or running jobs that were not updated in the last max_age seconds as failed, since the worker
+    that had them in memory must have stopped. Returns the number of jobs that were marked.
+    """
+    cutoff = f"now-{int(max_age)}s"
+    not_updated = {
+        "bool": {
+            "should": [
+                {"range": {"updated": {"lt": cutoff}}},
+                # Jobs stored before the updated field was added
+                {"bool": {"must_not": {"exists": {"field": "updated"}}, "filter": {"range": {"created": {"lt": cutoff}}}}},
+            ]
+        }
+    }
+    query = {"bool": {"filter": [{"terms": {"status": ["queued", "running"]}}, not_updated]}}
+    now = datetime.now(UTC).isoformat()
+    script = {
+        "source": "ctx._source.status = 'failed'; ctx._source.message = params.message; "
+        "ctx._source.finished = params.now; ctx._source.updated = params.now",
+        "params": {"message": "The server was stopped before the upload was finished", "now": now},
+    }
+    res = await es().update_by_query(index=jobs_index_name(), query=query, script=script, conflicts="proceed", refresh=True)
+    return res["updated"]
+
+
+@asynccontextmanager
+async def ingest_workers() -> AsyncGenerator[None, None]:
+    """
+    Mark lost jobs as failed (see fail_stale_jobs) when entering this context, and stop the ingest workers when
+    leaving it. Use this in the FastAPI lifespan. (The workers themselves are started when the first job is queued)
+    """
+    try:
+        if n := await fail_stale_jobs():
+            logging.info(f"Marked {n} lost ingest jobs as failed")
+    except Exception:
+        logging.exception("Could not mark lost ingest jobs as failed")
+    try:
+        yield
+    finally:
+        await stop_ingest_workers()
+
+
+def _ingest_queue() -> asyncio.Queue[tuple[IngestJob, list[dict[str, Any]]]]:
+    """Get the queue of the running event loop, starting the workers if needed"""
+    global _QUEUE
+    if _QUEUE is None or any(task.get_loop() is not asyncio.get_running_loop() for task in _WORKERS):
+        settings = get_settings()
+        _QUEUE = asyncio.Queue(maxsize=settings.ingest_queue_size)
+        _WORKERS[:] = [asyncio.create_task(_ingest_worker(_QUEUE)) for _ in range(settings.ingest_workers)]
+    return _QUEUE
+
+
+async def _ingest_worker(queue: asyncio.Queue[tuple[IngestJob, list[dict[str, Any]]]]) -> None:
+    while True:
+        job, documents = await queue.get()
+        try:
+            await run_job(job, documents)
+        except Exception:
+            logging.exception(f"Could not store the status of ingest job {job.id}")
+        finally:
+            # Don't keep the documents in memory while waiting for the next job
+            del documents
+            queue.task_done()
+
+
+async def _finish_job(job: IngestJob, status: Literal["completed", "failed"], message: str | None = None) -> None:
+    job.status = status
+    job.message = message
+    job.finished = datetime.now(UTC)
+    await _save_job(job)
+
+
+async def _save_job(job: IngestJob) -> None:
+    job.updated = datetime.now(UTC)
+    doc = job.model_dump(mode="json", exclude={"id"})
+    doc["errors"] = json.dumps(doc["errors"])
+    await es().index(index=jobs_index_name(), id=job.id, document=doc)
@@ -2,14 +2,21 @@
 All things query
 """
 
+import base64
+import hashlib
+import hmac
+import json
 import logging
 from math import ceil
 from typing import Any, Dict, Literal, Tuple, Union
 
+from amcat4.config import TotalHitsMode, get_settings
 from amcat4.connections import es
+from amcat4.elastic.msearch import es_search
 from amcat4.models import FieldSpec, FieldType, FilterSpec, SortSpec
 from amcat4.projects.date_mappings import mappings
 from amcat4.projects.documents import delete_documents_by_query, update_document_tag_by_query, update_documents_by_query
+from amcat4.projects.result_cache import bump_write_generation
 from amcat4.systemdata.fields import create_fields, list_fields
 
 
@@ -90,6 +97,10 @@ class QueryResult:
         page: int | None = None,
         page_count: int | None = None,
         scroll_id: str | None = None,
+        cursor: str | None = None,
+        pit: bool = False,
+        total_count_mode: TotalHitsMode | None = None,
+        total_count_relation: str | None = None,
     ):
         if n and (page_count is None) and (per_page is not None):
             page_count = ceil(n / per_page)
@@ -99,6 +110,10 @@ class QueryResult:
         self.page_count = page_count
         self.per_page = per_page
         self.scroll_id = scroll_id
+        self.cursor = cursor
+        self.pit = pit
+        self.total_count_mode = total_count_mode
+        self.total_count_relation = total_count_relation
 
     def as_dict(self) -> dict:
         meta: dict[str, int | str | None] = {
@@ -106,8 +121,14 @@ class QueryResult:
             "per_page": self.per_page,
             "page_count": self.page_count,
         }
+        if self.total_count_mode:
+            meta["total_count_mode"] = self.total_count_mode
+            meta["total_count_relation"] = self.total_count_relation
         if self.scroll_id:
             meta["scroll_id"] = self.scroll_id
+        elif self.pit:
+            # cursor is None on the last page
+            meta["cursor"] = self.cursor
         else:
             meta["page"] = self.page
         return dict(meta=meta, results=self.data)
@@ -124,7 +145,10 @@ async def query_documents(
     per_page: int = 10,
     scroll=None,
     scroll_id: str | None = None,
+    pit=None,
+    cursor: str | None = None,
     highlight: bool = False,
+    total_hits: TotalHitsMode | None = None,
     **kwargs,
 ) -> QueryResult | None:
     """
@@ -134,6 +158,8 @@ async def query_documents(
     In normal (paginated) mode, the next batch can be  requested by incrementing the page parameter.
     If the scroll parameter is given, the result will contain a scroll_id which can be used to get the next batch.
     In case there are no more documents to scroll, it will return None
+    If the pit parameter is given, the result will contain a cursor which can be used to get the next batch,
+    by repeating the same query with this cursor. On the last batch, the cursor is None.
     :param index: The name of the index or indexes
     :param fields: List of fields using the FieldSpec syntax. If not specified, only return _id.
                    !We require the fields to be specified for security reasons.
@@ -146,7 +172,16 @@ async def query_documents(
     :param scroll: if not None, will create a scroll request rather than a paginated request. Parmeter should
                    specify the time the context should be kept alive, or True to get the default of 2m.
     :param scroll_id: if not None, should be a previously returned context_id to retrieve a new page of results
+    :param pit: if not None, page with a point in time and search_after rather than from/size. This is the most
+                efficient way to page deep into large result sets. Parameter should specify the time the point in
+                time should be kept alive between requests, or True to get the default of 2m.
+    :param cursor: if not None, should be a previously returned cursor to retrieve the next page of a pit query.
+                   The query, filters, sort and fields should be the same as in the original query.
+                   Cursors are signed, and a cursor from a query on other indices or fields is rejected.
     :param highlight: if True, add <em> tags to query matches in fields
+    :param total_hits: How to count the total number of hits (exact, bounded or approximate, see track_total_hits).
+                       If None, use settings.total_hits_mode. A bounded or approximate total_count is a lower bound
+                       if total_count_relation is 'gte'.
     :param sort: Sort order of results, can be either a single field or a list of fields.
                  In the list, each field is a string or a dict with options, e.g. ["id", {"date": {"order": "desc"}}]
                  (https://www.elastic.co/guide/en/elasticsearch/reference/current/sort-search-results.html)
@@ -170,51 +205,209 @@ async def query_documents(
                     )
                 else:
                     kwargs["sort"].append({k: dict(v)})
+
+    mode = total_hits or get_settings().total_hits_mode
+
+    if pit or cursor:
+        return await _query_documents_pit(
+            index,
+            fields,
+            queries,
+            filters,
+            per_page=per_page,
+            pit=pit,
+            cursor=cursor,
+            highlight=highlight,
+            total_hits=mode,
+            **kwargs,
+        )
+
     if scroll_id:
         result = await es().scroll(scroll_id=scroll_id, scroll=kwargs.get("scroll", "2m"))
         # TODO: check why we return None here instead of just an empty result
         if not result["hits"]["hits"]:
             return None
         n = result["hits"]["total"]["value"]
+        data = _hits_to_documents(result["hits"]["hits"])
+        return QueryResult(data, n=n, scroll_id=result["_scroll_id"])
+
+    body = _search_body(fields, queries, filters, highlight)
+    kwargs["_source"] = _source_fields(fields)
+
+    if not scroll:
+        kwargs["from_"] = page * per_page
+    # In approximate mode we only need to count one hit past the current page to know if there is a next page
+    lower_bound = per_page + 1 if scroll else (page + 1) * per_page + 1
+    kwargs["track_total_hits"] = track_total_hits(mode, lower_bound)
+    result = await es_search(index=index, size=per_page, **body, **kwargs)
+
+    n = result["hits"]["total"]["value"]
+    relation = result["hits"]["total"]["relation"]
+    data = _hits_to_documents(result["hits"]["hits"])
+
+    if scroll:
+        return QueryResult(
+            data,
+            n=n,
+            per_page=per_page,
+            scroll_id=result["_scroll_id"],
+            total_count_mode=mode,
+            total_count_relation=relation,
+        )
     else:
-        h = query_highlight_and_snippets(fields, highlight) if fields is not None else None
-        body = build_body(queries, filters, h)
+        return QueryResult(data, n=n, per_page=per_page, page=page, total_count_mode=mode, total_count_relation=relation)
 
-        # TODO: we might be able to optimize a bit by not getting fields via _source if we
-        #       know we're going to overwrite them with the snippet (highlight) results.
-        #       Is also a bit 'safer' than overwriting the full text if we only allow snippets
-        # fieldnames = [field.name for field in fields if not field.snippet] if fields is not None else ["_id"]
-        fieldnames = [field.name for field in fields] if fields is not None else ["_id"]
-        kwargs["_source"] = fieldnames
 
-        if not scroll:
-            kwargs["from_"] = page * per_page
-        result = await es().search(index=index, size=per_page, **body, **kwargs)
+def track_total_hits(mode: TotalHitsMode | None = None, lower_bound: int | None = None) -> bool | int:
+    """
+    Translate a total hits mode into the elastic track_total_hits parameter.
+    exact counts all hits, bounded counts up to settings.total_hits_threshold hits,
+    and approximate counts up to lower_bound hits (or the threshold if lower_bound is not given).
+    Counting only up to a bound is much cheaper on large indices, since elastic can stop early.
+    """
+    settings = get_settings()
+    mode = mode or settings.total_hits_mode
+    if mode == "exact":
+        return True
+    if mode == "approximate" and lower_bound is not None:
+        return lower_bound
+    return settings.total_hits_threshold
+
+
+async def _query_documents_pit(
+    index: Union[str, list[str]],
+    fields: list[FieldSpec] | None,
+    queries: dict[str, str] | None,
+    filters: dict[str, FilterSpec] | None,
+    *,
+    per_page: int,
+    pit,
+    cursor: str | None,
+    highlight: bool,
+    total_hits: TotalHitsMode,
+    **kwargs,
+) -> QueryResult:
+    """
+    Get a page of results using a point in time (pit) and search_after.
+    The cursor is an opaque string that contains the pit id, the sort values of the last hit and the total count.
+    It is signed and bound to the indices and fields of the query, so a cursor (and its pit) cannot be reused in a query
+    on other indices or fields, for which the user may have different permissions.
+    The pit is closed once the last page has been retrieved.
+    """
+    indices = sorted([index] if isinstance(index, str) else index)
+    fields_key = _fields_key(fields)
+    # With a pit, elastic adds an implicit tiebreaker on _shard_doc, which is also the most efficient sort order
+    sort = kwargs.pop("sort", None) or ["_shard_doc"]
+    if any(isinstance(s, dict) and "_script" in s for s in sort):
+        raise ValueError("Random sort order cannot be used with point in time pagination")
+
+    if cursor:
+        state = _decode_cursor(cursor)
+        if state.get("indices") != indices or state.get("fields") != fields_key:
+            raise ValueError("Cursor does not belong to this query")
+    else:
+        keep_alive = "2m" if (not pit or pit is True) else pit
+        pit_id = (await es().open_point_in_time(index=index, keep_alive=keep_alive))["id"]
+        state = dict(pit_id=pit_id, keep_alive=keep_alive, search_after=None, n=None, relation=None, mode=total_hits)
+        state.update(indices=indices, fields=fields_key)
+
+    body = _search_body(fields, queries, filters, highlight)
+    kwargs["_source"] = _source_fields(fields)
+    if state["search_after"] is not None:
+        kwargs["search_after"] = state["search_after"]
+
+    result = await es().search(
+        pit={"id": state["pit_id"], "keep_alive": state["keep_alive"]},
+        size=per_page,
+        sort=sort,
+        # We only need to count the total number of hits once, and then pass it along in the cursor
+        track_total_hits=track_total_hits(state["mode"], per_page + 1) if state["n"] is None else False,
+        **body,
+        **kwargs,
+    )
+    hits = result["hits"]["hits"]
+    if state["n"] is None:
+        state["n"] = result["hits"]["total"]["value"]
+        state["relation"] = result["hits"]["total"]["relation"]
+    pit_id = result.get("pit_id", state["pit_id"])
+
+    if len(hits) < per_page:
+        await es().options(ignore_status=404).close_point_in_time(id=pit_id)
+        next_cursor = None
+    else:
+        next_cursor = _encode_cursor(dict(state, pit_id=pit_id, search_after=hits[-1]["sort"]))
+
+    return QueryResult(
+        _hits_to_documents(hits),
+        n=state["n"],
+        per_page=per_page,
+        cursor=next_cursor,
+        pit=True,
+        total_count_mode=state["mode"],
+        total_count_relation=state["relation"],
+    )
 
-        n = result["hits"]["total"]["value"]
-        if n == 10000 and not scroll:
-            # Default elastic max on non-scrolled values. I think we should return the actual count,
-            # even if elastic will error (I think) if the user ever retrieves a page > 1000
-            # TODO: can we not hard-code the 10k limit?
-            res = await es().count(index=index, query=body["query"])
-            n = res["count"]
 
+def _search_body(
+    fields: list[FieldSpec] | None, queries: dict[str, str] | None, filters: dict[str, FilterSpec] | None, highlight: bool
+) -> dict:
+    h = query_highlight_and_snippets(fields, highlight) if fields is not None else None
+    return build_body(queries, filters, h)
+
+
+def _source_fields(fields: list[FieldSpec] | None) -> list[str] | Literal[False]:
+    """
+    The fields to retrieve from _source. Fields that are only requested as snippets are not retrieved,
+    since they are filled in from the highlight results. This saves transferring (possibly very long)
+    texts, and makes sure that users with snippet access never get the full text.
+    Returns False if no source fields are needed (an empty list would retrieve all fields).
+    """
+    if fields is None:
+        return ["_id"]
+    source = list(dict.fromkeys(field.name for field in fields if field.snippet is None))
+    return source or False
+
+
+def _hits_to_documents(hits: list[dict]) -> list[dict]:
     data = []
-    for hit in result["hits"]["hits"]:
-        hitdict = dict(_id=hit["_id"], **hit["_source"])
+    for hit in hits:
+        hitdict = dict(_id=hit["_id"], **hit.get("_source", {}))
         hitdict = overwrite_highlight_results(hit, hitdict)
         if "highlight" in hit:
             for key in hit["highlight"].keys():
                 if hit["highlight"][key]:
                     hitdict[key] = " ... ".join(hit["highlight"][key])
         data.append(hitdict)
+    return data
 
-    if scroll_id:
-        return QueryResult(data, n=n, scroll_id=result["_scroll_id"])
-    elif scroll:
-        return QueryResult(data, n=n, per_page=per_page, scroll_id=result["_scroll_id"])
-    else:
-        return QueryResult(data, n=n, per_page=per_page, page=page)
+
+def _fields_key(fields: list[FieldSpec] | None) -> str | None:
+    if fields is None:
+        return None
+    return json.dumps([field.model_dump(mode="json") for field in fields], sort_keys=True)
+
+
+def _cursor_signature(payload: str) -> str:
+    secret = get_settings().cookie_secret.encode("utf-8")
+    return hmac.new(secret, payload.encode("ascii"), hashlib.sha256).hexdigest()
+
+
+def _encode_cursor(state: dict) -> str:
+    payload = base64.urlsafe_b64encode(json.dumps(state).encode("utf-8")).decode("ascii")
+    return f"{payload}.{_cursor_signature(payload)}"
+
+
+def _decode_cursor(cursor: str) -> dict:
+    payload, _, signature = cursor.partition(".")
+    if not hmac.compare_digest(signature, _cursor_signature(payload)):
+        raise ValueError("Invalid cursor")
+    try:
+        state = json.loads(base64.urlsafe_b64decode(payload.encode("ascii")))
+    except ValueError:
+        raise ValueError("Invalid cursor")
+    if not isinstance(state, dict) or not {"pit_id", "keep_alive", "search_after", "n", "relation", "mode"} <= state.keys():
+        raise ValueError("Invalid cursor")
+    return state
 
 
 def query_highlight_and_snippets(fields: list[FieldSpec], highlight_queries: bool = False) -> dict[str, Any]:
@@ -364,7 +557,12 @@ async def reindex(
     if script:
         kwargs["script"] = {"source": script, "lang": "painless"}
 
-    return await es().reindex(**kwargs)
+    # A reindex task that runs in the background keeps writing after we return, so cached results for the
+    # destination can be stale until they expire (settings.result_cache_ttl)
+    await bump_write_generation(destination_index)
+    result = await es().reindex(**kwargs)
+    await bump_write_generation(destination_index)
+    return result
 
 
 async def get_task_status(task_id):
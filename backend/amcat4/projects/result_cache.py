@@ -0,0 +1,143 @@
+"""
+Cache for the results of document queries and aggregations.
+
+Dashboards re-issue the same queries over and over against indices that rarely change. Results are cached
+under a key that consists of the kind of request, the (normalized) request body including the effective
+field specifications, and the current write generation of every index involved. Every document write
+(see projects.documents) bumps the write generation of its index, so a cached result is never served
+after a write to one of its indices by this process.
+
+Writes also bump the "documents" generation counter of the index (see systemdata.generations). Before using
+cached results, workers check the counters of the indices involved, and bump their own write generation of
+an index that was written to by another worker. So only the cached results for that index are dropped.
+
+Elasticsearch only makes writes visible after the next refresh, so results are not cached for indices
+that were written to (or for which a write by another worker was noticed) in the last
+result_cache_refresh_interval seconds.
+"""
+
+import asyncio
+import json
+import math
+import time
+from typing import Any, Awaitable, Callable, Hashable, Sequence, TypeVar
+
+from amcat4.cache import VersionedCache
+from amcat4.config import get_settings
+from amcat4.systemdata.generations import GenerationWatcher
+
+T = TypeVar("T")
+
+# Write generations are taken from a single counter, so a generation is never reused (e.g. for a recreated index)
+_WRITE_COUNTER = 0
+_WRITE_GENERATIONS: dict[str, int] = {}
+# time.monotonic() of the last write to an index through this worker
+_LAST_WRITE: dict[str, float] = {}
+# time.monotonic() of the last time that this worker noticed a write to an index by another worker
+_LAST_OTHER_WRITE: dict[str, float] = {}
+# Watchers of the "documents" generation counter per index
+_GENERATIONS: dict[str, GenerationWatcher] = {}
+_RESULTS: VersionedCache[Hashable, Any] | None = None
+
+
+def _results() -> VersionedCache[Hashable, Any]:
+    global _RESULTS
+    if _RESULTS is None:
+        settings = get_settings()
+        _RESULTS = VersionedCache(maxsize=settings.result_cache_size, ttl=settings.result_cache_ttl)
+    return _RESULTS
+
+
+def _next_write_generation(index: str) -> None:
+    global _WRITE_COUNTER
+    _WRITE_COUNTER += 1
+    _WRITE_GENERATIONS[index] = _WRITE_COUNTER
+
+
+def _other_worker_wrote(index: str) -> None:
+    _next_write_generation(index)
+    _LAST_OTHER_WRITE[index] = time.monotonic()
+
+
+def _generation(index: str) -> GenerationWatcher:
+    if (watcher := _GENERATIONS.get(index)) is None:
+        watcher = GenerationWatcher("documents", lambda: _other_worker_wrote(index), key=index)
+        _GENERATIONS[index] = watcher
+    return watcher
+
+
+async def bump_write_generation(index: str | Sequence[str]) -> None:
+    """
+    Register that documents in these indices have changed, so cached results are no longer used
+    (by this worker immediately, and by other workers after their next generation check)
+    """
+    indices = [index] if isinstance(index, str) else index
+    now = time.monotonic()
+    for ix in indices:
+        _next_write_generation(ix)
+        _LAST_WRITE[ix] = now
+    if get_settings().result_cache_size <= 0:
+        return
+    await asyncio.gather(*(_generation(ix).bump() for ix in set(indices)))
+
+
+async def forget_index(index: str) -> None:
+    """
+    Register that this index was deleted: drop its write generation (so deleted indices do not accumulate in
+    long-running workers) and all cached results (which could otherwise be served for a new index with this name)
+    """
+    await bump_write_generation(index)
+    for state in (_WRITE_GENERATIONS, _LAST_WRITE, _LAST_OTHER_WRITE, _GENERATIONS):
+        state.pop(index, None)
+    clear_result_cache()
+
+
+def write_generation(index: str) -> int:
+    return _WRITE_GENERATIONS.get(index, 0)
+
+
+def last_write(index: str) -> float | None:
+    """time.monotonic() of the last write to this index through this worker, or None if there was none"""
+    return _LAST_WRITE.get(index)
+
+
+def result_cache_key(kind: str, indices: Sequence[str], body: dict) -> Hashable | None:
+    """
+    Create the cache key for a request, or return None if the result should not be cached.
+    The body should contain everything that determines the result, including the effective fieldspecs
+    (so users with different access levels never share a cached result).
+    """
+    settings = get_settings()
+    if settings.result_cache_size <= 0:
+        return None
+    now = time.monotonic()
+    for ix in indices:
+        last = max(_LAST_WRITE.get(ix, -math.inf), _LAST_OTHER_WRITE.get(ix, -math.inf))
+        if now - last < settings.result_cache_refresh_interval:
+            return None
+    generations = tuple((ix, write_generation(ix)) for ix in sorted(set(indices)))
+    return kind, generations, json.dumps(body, sort_keys=True, default=str)
+
+
+async def cached_result(kind: str, indices: Sequence[str], body: dict, loader: Callable[[], Awaitable[T]]) -> T:
+    """
+    Return the cached result for this request, or call loader and cache its result.
+    Results are shared between callers, so they should not be modified.
+    """
+    if get_settings().result_cache_size > 0:
+        await asyncio.gather(*(_generation(ix).check() for ix in set(indices)))
+    key = result_cache_key(kind, indices, body)
+    if key is None:
+        return await loader()
+    cache = _results()
+    if (cached := cache.get(key)) is not None:
+        return cached
+    result = await loader()
+    if result is not None:
+        cache.set(key, result)
+    return result
+
+
+def clear_result_cache() -> None:
+    if _RESULTS is not None:
+        _RESULTS.invalidate()
@@ -0,0 +1,173 @@
+"""
+Cached statistics (number of documents, size and time of the last write) of the project indices.
+
+Getting the statistics of an index from elasticsearch for every project in a project list would be too slow, so the
+statistics of all project indices (as registered in the settings index) are collected with a few indices.stats calls
+and cached in-process. They are refreshed when they are older than settings.index_stats_interval, and the collector
+(see index_stats_collector) refreshes them in the background at that interval, so requests normally do not have to
+wait for them. Indices that do not exist are also remembered for that interval, so requests for them do not each
+cause an indices.stats call.
+
+Elasticsearch does not keep track of when an index was last written to. Instead, the collector compares the
+indexing counters of each index with those of the previous collection, and records when it first noticed a change.
+Writes through this worker are known immediately (see result_cache.last_write), so the last write time is a best
+guess: exact for writes through this worker, and up to index_stats_interval late for writes through other workers.
+"""
+
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from datetime import UTC, datetime, timedelta
+from typing import AsyncGenerator
+
+from elasticsearch import NotFoundError
+
+from amcat4.config import get_settings
+from amcat4.connections import es
+from amcat4.models import IndexStats
+from amcat4.projects.result_cache import last_write
+from amcat4.systemdata.settings import list_project_ids
+
+_STATS: dict[str, IndexStats] = {}
+# Number of index and delete operations per index at the last collection, to notice writes
+_WRITES: dict[str, int] = {}
+# time.monotonic() at which indices were found not to exist
+_MISSING: dict[str, float] = {}
+# time.monotonic() of the last collection of all indices, or None if they were never collected
+_COLLECTED: float | None = None
+# Maximum number of indices per indices.stats call, as the index names are part of the url
+_BATCH_SIZE = 100
+
+_FILTER_PATH = [
+    "indices.*.primaries.docs.count",
+    "indices.*.primaries.indexing.index_total",
+    "indices.*.primaries.indexing.delete_total",
+    "indices.*.total.store.size_in_bytes",
+]
+
+
+async def get_index_stats(indices: list[str], refresh: bool = False) -> dict[str, IndexStats]:
+    """
+    Get the (cached) statistics of the given indices. Indices that do not exist are omitted.
+    If refresh is True, or the cached statistics are too old, the statistics of all indices are refreshed first.
+    Indices that were not seen in the last collection (e.g. new projects) are collected separately.
+    """
+    if refresh or _is_stale():
+        await refresh_index_stats()
+    if missing := [ix for ix in indices if ix not in _STATS and not _known_missing(ix)]:
+        await refresh_index_stats(missing)
+    return {ix: _with_last_write(ix, _STATS[ix]) for ix in indices if ix in _STATS}
+
+
+async def refresh_index_stats(indices: list[str] | None = None) -> None:
+    """Collect the statistics of the given indices (or of all project indices) with indices.stats calls"""
+    global _COLLECTED
+    collected = time.monotonic()
+    requested = indices if indices is not None else await list_project_ids()
+    batches = [requested[i : i + _BATCH_SIZE] for i in range(0, len(requested), _BATCH_SIZE)]
+    results: dict[str, dict] = {}
+    for res in await asyncio.gather(*(_collect(batch) for batch in batches)):
+        results.update(res)
+    stats = {index: _index_stats(index, s) for index, s in results.items()}
+    if indices is None:
+        _STATS.clear()
+        _MISSING.clear()
+        for index in set(_WRITES) - set(stats):
+            del _WRITES[index]
+        _COLLECTED = collected
+    _STATS.update(stats)
+    for index in requested:
+        if index not in stats:
+            _MISSING[index] = collected
+
+
+def invalidate_index_stats(index: str) -> None:
+    """Forget the statistics of this index (e.g. because it was deleted or cleared)"""
+    _STATS.pop(index, None)
+    _WRITES.pop(index, None)
+    _MISSING.pop(index, None)
+
+
+async def run_index_stats_collector(interval: float | None = None) -> None:
+    """Run forever, refreshing the statistics of all indices every interval seconds (default: settings)"""
+    if interval is None:
+        interval = get_settings().index_stats_interval
+    while True:
+        try:
+            await refresh_index_stats()
+        except Exception:
+            logging.exception("Error in index stats collector")
+        await asyncio.sleep(interval)
+
+
+@asynccontextmanager
+async def index_stats_collector() -> AsyncGenerator[None, None]:
+    """
+    Run the index stats collector as a background task while in this context (unless settings.index_stats_interval
+    is 0). Use this in the FastAPI lifespan.
+    """
+    task = asyncio.create_task(run_index_stats_collector()) if get_settings().index_stats_interval > 0 else None
+    try:
+        yield
+    finally:
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+
+async def _collect(indices: list[str]) -> dict[str, dict]:
+    """Get the statistics of the indices in this batch. If some do not exist, the statistics of the others are returned"""
+    try:
+        res = await _indices_stats(indices)
+    except NotFoundError:
+        # indices.stats has no ignore_unavailable, so retry with only the indices that exist
+        resolved = await es().indices.resolve_index(name=",".join(indices), ignore_unavailable=True)
+        existing = [ix["name"] for ix in resolved.get("indices", [])]
+        if not existing:
+            return {}
+        res = await _indices_stats(existing)
+    system_index = get_settings().system_index
+    return {index: s for index, s in res.get("indices", {}).items() if not index.startswith(system_index)}
+
+
+async def _indices_stats(indices: list[str]) -> dict:
+    res = await es().indices.stats(index=",".join(indices), metric=["docs", "store", "indexing"], filter_path=_FILTER_PATH)
+    return res.body
+
+
+def _index_stats(index: str, stats: dict) -> IndexStats:
+    primaries, total = stats.get("primaries", {}), stats.get("total", {})
+    indexing = primaries.get("indexing", {})
+    writes = indexing.get("index_total", 0) + indexing.get("delete_total", 0)
+    last_write = _STATS[index].last_write if index in _STATS else None
+    if index in _WRITES and _WRITES[index] != writes:
+        last_write = datetime.now(UTC)
+    _WRITES[index] = writes
+    return IndexStats(
+        documents=primaries.get("docs", {}).get("count", 0),
+        bytes=total.get("store", {}).get("size_in_bytes", 0),
+        last_write=last_write,
+    )
+
+
+def _with_last_write(index: str, stats: IndexStats) -> IndexStats:
+    """Use the time of the last write through this worker if that is more recent than the collected time"""
+    if (written := last_write(index)) is None:
+        return stats
+    written_at = datetime.now(UTC) - timedelta(seconds=time.monotonic() - written)
+    if stats.last_write is not None and stats.last_write >= written_at:
+        return stats
+    return stats.model_copy(update={"last_write": written_at})
+
+
+def _known_missing(index: str) -> bool:
+    missing = _MISSING.get(index)
+    return missing is not None and time.monotonic() - missing < get_settings().index_stats_interval
+
+
+def _is_stale() -> bool:
+    return _COLLECTED is None or time.monotonic() - _COLLECTED >= get_settings().index_stats_interval
@@ -6,28 +6,54 @@ from typing import AsyncIterable
 from fastapi import HTTPException
 from pydantic import EmailStr
 
+from amcat4.cache import VersionedCache
 from amcat4.connections import es
 from amcat4.elastic.util import index_scan
 from amcat4.models import ApiKey, ApiKeyRestrictions, User
+from amcat4.systemdata.generations import GenerationWatcher
 from amcat4.systemdata.versions.v2 import apikeys_index_name
 
+# API keys are cached by their hash, so that scripted clients don't cause a search for every request.
+# Unknown keys are also cached (briefly), so that trying many invalid keys does not load elasticsearch.
+# Changing or deleting a key invalidates the cache of this worker, and bumps the "apikeys" generation counter
+# so that other workers drop their cache as well.
+UNKNOWN_KEY_TTL = 10
 
-async def get_api_key(api_key: str) -> ApiKey:
-    hashed_key = hash_api_key(api_key)
+_API_KEYS_CACHE: VersionedCache[str, ApiKey] = VersionedCache(maxsize=4096)
+_UNKNOWN_KEYS_CACHE: VersionedCache[str, bool] = VersionedCache(maxsize=4096, ttl=UNKNOWN_KEY_TTL)
 
-    q = {"term": {"hashed_key": hashed_key}}
-    res = await es().search(index=apikeys_index_name(), query=q, size=1)
 
-    if res["hits"]["total"]["value"] == 0:
-        raise KeyError("API key not found")
+async def get_api_key(api_key: str) -> ApiKey:
+    hashed_key = hash_api_key(api_key)
+    await _GENERATION.check()
+
+    doc = _API_KEYS_CACHE.get(hashed_key)
+    if doc is None:
+        if _UNKNOWN_KEYS_CACHE.get(hashed_key):
+            raise KeyError("API key not found")
+        generation = _API_KEYS_CACHE.generation(hashed_key)
+        unknown_generation = _UNKNOWN_KEYS_CACHE.generation(hashed_key)
+        doc = await _load_api_key(hashed_key)
+        if doc is None:
+            _UNKNOWN_KEYS_CACHE.set(hashed_key, True, unknown_generation)
+            raise KeyError("API key not found")
+        _API_KEYS_CACHE.set(hashed_key, doc, generation)
 
-    doc = _apikey_from_elastic(res["hits"]["hits"][0]["_source"])
     if doc.expires_at < datetime.now(tz=UTC):
         raise KeyError("API key has expired")
 
     return doc
 
 
+def invalidate_api_keys_cache() -> None:
+    """Drop all cached (and unknown) API keys of this worker"""
+    _API_KEYS_CACHE.invalidate()
+    _UNKNOWN_KEYS_CACHE.invalidate()
+
+
+_GENERATION = GenerationWatcher("apikeys", invalidate_api_keys_cache)
+
+
 async def list_api_keys(user: User) -> AsyncIterable[tuple[str, ApiKey]]:
     q = {"term": {"email": user.email}}
     async for id, doc in index_scan(index=apikeys_index_name(), query=q):
@@ -48,7 +74,8 @@ async def create_api_key(
         jkt=None,
     )
 
-    doc = await es().index(index=apikeys_index_name(), id=None, document=_apikey_to_elastic(doc), refresh=True)
+    doc = await es().index(index=apikeys_index_name(), id=None, document=_apikey_to_elastic(doc), refresh="wait_for")
+    _UNKNOWN_KEYS_CACHE.invalidate(hash_api_key(api_key))
 
     return doc["_id"], api_key
 
@@ -77,13 +104,15 @@ async def update_api_key(
         doc["hashed_key"] = hash_api_key(new_api_key)
 
     if doc:
-        await es().update(index=apikeys_index_name(), id=api_key_id, doc=doc, refresh=True)
+        await es().update(index=apikeys_index_name(), id=api_key_id, doc=doc, refresh="wait_for")
+        await _api_keys_changed()
 
     return new_api_key
 
 
 async def delete_api_key(api_key_id: str) -> None:
-    await es().delete(index=apikeys_index_name(), id=api_key_id, refresh=True)
+    await es().delete(index=apikeys_index_name(), id=api_key_id, refresh="wait_for")
+    await _api_keys_changed()
 
 
 async def generate_api_key() -> str:
@@ -129,3 +158,16 @@ def _apikey_to_elastic(api_key: ApiKey) -> dict:
         if pr is not None:
             d["restrictions"]["project_roles"] = [dict(project_id=k, role=v) for k, v in pr.items()]
     return d
+
+
+async def _load_api_key(hashed_key: str) -> ApiKey | None:
+    q = {"term": {"hashed_key": hashed_key}}
+    res = await es().search(index=apikeys_index_name(), query=q, size=1)
+    if res["hits"]["total"]["value"] == 0:
+        return None
+    return _apikey_from_elastic(res["hits"]["hits"][0]["_source"])
+
+
+async def _api_keys_changed() -> None:
+    await _GENERATION.bump()
+    invalidate_api_keys_cache()
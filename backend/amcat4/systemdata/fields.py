@@ -10,20 +10,29 @@ We have two types of fields:
 We need to make sure that:
 - When a user sets a field, it needs to be changed in both types: the system index and the mapping
 - If a field only exists in the elastic mapping, we need to add the default Field to the system index.
-  This happens anytime get_fields is called, so that whenever a field is used it is guarenteed to be in the
-  system index
+  Whenever list_fields is called, the fields from the mapping are combined with the system index, so that
+  whenever a field is used it is guaranteed to have settings. Actually writing the missing fields to the
+  system index is done by a background reconciler (see amcat4.systemdata.reconciler), so that reading
+  fields never writes to elastic.
+
+Because the fields are needed on almost every request, the (repaired) fields per index are kept in
+an in-process cache. Any function that writes to the fields system index or the mapping of an index
+needs to call fields_changed afterwards, which also bumps the "fields" generation so other workers drop
+their cached fields.
 """
 
 import datetime
-from typing import Any, AsyncGenerator, Iterable, Mapping, get_args
+from typing import Any, AsyncGenerator, Callable, Iterable, Mapping, get_args
 
 from elasticsearch import NotFoundError
 from fastapi import HTTPException
 from typing_extensions import TypedDict
 
+from amcat4.cache import VersionedCache
 from amcat4.connections import es
 from amcat4.elastic.util import BulkInsertAction, es_bulk_upsert, es_get, index_scan
 from amcat4.models import (
+    AuthContext,
     CreateDocumentField,
     DocumentField,
     DocumentFieldMetareaderAccess,
@@ -36,11 +45,52 @@ from amcat4.models import (
     UpdateDocumentField,
     User,
 )
+from amcat4.systemdata.generations import GenerationWatcher
 from amcat4.systemdata.roles import HTTPException_if_not_project_index_role, list_user_project_roles, role_is_at_least
 from amcat4.systemdata.typemap import infer_field_type, list_allowed_elastic_types
 from amcat4.systemdata.versions import fields_index_id, fields_index_name
 
 
+def _copy_fields(fields: dict[str, DocumentField]) -> dict[str, DocumentField]:
+    return {name: field.model_copy(deep=True) for name, field in fields.items()}
+
+
+# Cache of {index: {field_name: DocumentField}}, as returned by list_fields
+_FIELDS_CACHE: VersionedCache[str, dict[str, DocumentField]] = VersionedCache(maxsize=2048, copy=_copy_fields)
+
+# Indices for which list_fields found the fields system index and the mapping out of sync
+_PENDING_REPAIRS: set[str] = set()
+
+
+def invalidate_fields_cache(index: str | list[str] | None = None) -> None:
+    """
+    Drop the cached fields of this worker for the given index or indices (or for all indices if index is None).
+    Use fields_changed to also notify the other workers.
+    """
+    if index is None:
+        _FIELDS_CACHE.invalidate()
+        return
+    for i in [index] if isinstance(index, str) else index:
+        _FIELDS_CACHE.invalidate(i)
+
+
+_GENERATION = GenerationWatcher("fields", invalidate_fields_cache)
+
+
+async def fields_changed(index: str | list[str]) -> None:
+    """
+    Call this after anything that changes the fields system index or the mapping of an index.
+    Drops the cached fields of this worker, and bumps the generation so other workers drop theirs as well.
+    """
+    await _GENERATION.bump()
+    invalidate_fields_cache(index)
+
+
+def fields_cache_generation(index: str) -> int:
+    """The cache generation for the fields of this index. This changes whenever the fields are changed."""
+    return _FIELDS_CACHE.generation(index)
+
+
 async def delete_all_project_fields(index: str):
     """Delete all field definitions for the given project from the system fields index."""
     await es().delete_by_query(
@@ -48,6 +98,7 @@ async def delete_all_project_fields(index: str):
         body={"query": {"term": {"index": index}}},
         refresh=True,
     )
+    await fields_changed(index)
 
 
 class UpdateFieldMapping(TypedDict):
@@ -150,27 +201,118 @@ async def list_fields(index: str, auto_repair: bool = True) -> dict[str, Documen
     Retrieve the fields settings for this index.
 
     If auto_repair is true, look for both (1) the field settings in the 'fields' system index,
-    and (2) the field mappings in the index itself. If these are not in sync, fix them.
+    and (2) the field mappings in the index itself, and combine them. If these are not in sync,
+    the index is scheduled for repair by the background reconciler (see schedule_fields_repair),
+    so reading the fields never writes to elastic.
+    The result of this (auto_repair) path is cached until the fields of the index are changed.
     """
     if auto_repair:
-        return await list_and_repair_fields(index)
+        await _GENERATION.check()
+        return await _FIELDS_CACHE.get_or_load(index, lambda: _load_fields(index))
     else:
         return await _list_fields(index)
 
 
+async def list_fields_many(indices: list[str]) -> dict[str, dict[str, DocumentField]]:
+    """
+    Like list_fields (with auto_repair), but for multiple indices at once. Returns a {index: fields} dict.
+
+    Indices that are not cached are loaded together, with a single query on the fields system index
+    and a single get_mapping call for all of them.
+    """
+    await _GENERATION.check()
+    fields_per_index: dict[str, dict[str, DocumentField]] = {}
+    missing: list[str] = []
+    for index in indices:
+        cached = _FIELDS_CACHE.get(index)
+        if cached is not None:
+            fields_per_index[index] = cached
+        elif index not in missing:
+            missing.append(index)
+
+    if missing:
+        generations = {index: _FIELDS_CACHE.generation(index) for index in missing}
+        try:
+            system_index_fields = await _list_fields_many(missing)
+        except NotFoundError:
+            system_index_fields = {}
+        mappings = await es().indices.get_mapping(index=",".join(missing))
+        for index in missing:
+            inferred_fields = _infer_fields_from_mapping(mappings[index]["mappings"])
+            fields, update_system_index, update_mapping = _merge_fields(system_index_fields.get(index, {}), inferred_fields)
+            if update_system_index or update_mapping:
+                schedule_fields_repair(index)
+            _FIELDS_CACHE.set(index, fields, generations[index])
+            fields_per_index[index] = fields
+
+    return {index: fields_per_index[index] for index in indices}
+
+
+def schedule_fields_repair(index: str) -> None:
+    """
+    Mark the fields of this index for repair. Repairs are done by the background reconciler
+    (see amcat4.systemdata.reconciler), which calls list_and_repair_fields for all pending indices.
+    """
+    _PENDING_REPAIRS.add(index)
+
+
+def pop_pending_fields_repairs() -> list[str]:
+    """Return (and clear) the indices that were scheduled for repair"""
+    indices = sorted(_PENDING_REPAIRS)
+    _PENDING_REPAIRS.clear()
+    return indices
+
+
 async def list_and_repair_fields(
     index: str,
 ):
-    fields: dict[str, DocumentField] = {}
+    """
+    Like list_fields, but if the fields system index and the mapping are not in sync, fix them right away.
+    This writes to elastic, so it should not be used on the read path (use list_fields instead).
+    """
+    try:
+        system_index_fields = await _list_fields(index)
+    except NotFoundError:
+        system_index_fields = {}
+
+    inferred_fields = await _infer_es_index_fields(index)
+    fields, update_system_index, update_mapping = _merge_fields(system_index_fields, inferred_fields)
+
+    if update_mapping:
+        await _update_index_fields_mappings(index, fields)
+
+    if update_system_index:
+        await _update_fields(index, fields)
+
+    return fields
+
 
+async def _load_fields(index: str) -> dict[str, DocumentField]:
+    """Read-only version of list_and_repair_fields, that schedules a repair instead of writing"""
     try:
         system_index_fields = await _list_fields(index)
     except NotFoundError:
         system_index_fields = {}
 
+    inferred_fields = await _infer_es_index_fields(index)
+    fields, update_system_index, update_mapping = _merge_fields(system_index_fields, inferred_fields)
+    if update_system_index or update_mapping:
+        schedule_fields_repair(index)
+    return fields
+
+
+def _merge_fields(
+    system_index_fields: dict[str, DocumentField], inferred_fields: dict[str, DocumentField]
+) -> tuple[dict[str, DocumentField], bool, bool]:
+    """
+    Combine the fields from the system index with the fields inferred from the elastic mapping.
+    Returns the combined fields, and whether the system index and/or the mapping need to be updated
+    to be in sync: (fields, update_system_index, update_mapping)
+    """
+    fields: dict[str, DocumentField] = {}
+
     # check if all fields in elastic are registered in the system index, and otherwise add them (update_system_index=True)
     update_system_index = False
-    inferred_fields = await _infer_es_index_fields(index)
     for name, inferred_field in inferred_fields.items():
         if name not in system_index_fields:
             update_system_index = True
@@ -195,13 +337,7 @@ async def list_and_repair_fields(
         if name not in inferred_fields.keys():
             update_mapping = True
 
-    if update_mapping:
-        await _update_index_fields_mappings(index, fields)
-
-    if update_system_index:
-        await _update_fields(index, fields)
-
-    return fields
+    return fields, update_system_index, update_mapping
 
 
 async def allowed_fieldspecs(user: User, indices: list[IndexId]) -> list[FieldSpec]:
@@ -214,10 +350,11 @@ async def allowed_fieldspecs(user: User, indices: list[IndexId]) -> list[FieldSp
     roles = await list_user_project_roles(user, project_ids=indices)
     role_dict: dict[str, RoleRule] = {role.role_context: role for role in roles}
 
-    # Note that we NEED to use list_fields and not _list_fields,
+    # Note that we NEED to use list_fields(_many) and not _list_fields,
     # because we need to be certain the es fields are all registered in the system index.
+    fields_per_index = await _user_fields_many(user, indices)
     for index in indices:
-        for field_name, field in (await list_fields(index)).items():
+        for field_name, field in fields_per_index[index].items():
             if field_name not in fields_across_indices:
                 fields_across_indices[field_name] = []
             role = role_dict.get(index)
@@ -233,6 +370,25 @@ async def allowed_fieldspecs(user: User, indices: list[IndexId]) -> list[FieldSp
     return fieldspecs
 
 
+async def _user_fields_many(user: User, indices: list[IndexId]) -> dict[str, dict[str, DocumentField]]:
+    """
+    list_fields_many, but memoized for the rest of the request if user is an AuthContext.
+    The returned fields can be shared, so they should not be modified.
+    """
+    if not isinstance(user, AuthContext):
+        return await list_fields_many(indices)
+    fields_per_index: dict[str, dict[str, DocumentField]] = {}
+    for index in indices:
+        if (fields := user.memoized(("fields", index), fields_cache_generation(index))) is not None:
+            fields_per_index[index] = fields
+    if missing := [index for index in indices if index not in fields_per_index]:
+        generations = {index: fields_cache_generation(index) for index in missing}
+        for index, fields in (await list_fields_many(missing)).items():
+            user.memoize(("fields", index), generations[index], fields)
+            fields_per_index[index] = fields
+    return fields_per_index
+
+
 def get_fieldspec_for_role(user: User, role: RoleRule | None, field_name: str, field: DocumentField) -> FieldSpec | None:
     if not role_is_at_least(user, role, Roles.METAREADER):
         return None
@@ -303,6 +459,7 @@ async def HTTPException_if_invalid_field_access(indices: list[str], user: User,
     roles = await list_user_project_roles(user, project_ids=indices)
     role_dict = {role.role_context: role for role in roles}
 
+    metareader_indices: list[str] = []
     for index in indices:
         role = role_dict.get(index)
         if not role_is_at_least(user, role, Roles.METAREADER):
@@ -310,10 +467,13 @@ async def HTTPException_if_invalid_field_access(indices: list[str], user: User,
                 status_code=403,
                 detail=f"User '{user.email}' does not have permission to access index {index}",
             )
-        if role_is_at_least(user, role, Roles.READER):
-            continue
+        if not role_is_at_least(user, role, Roles.READER):
+            metareader_indices.append(index)
 
-        index_fields = await list_fields(index)
+    # Only for indices where the user is a metareader do we need to check the field settings
+    fields_per_index = await _user_fields_many(user, metareader_indices) if metareader_indices else {}
+    for index in metareader_indices:
+        index_fields = fields_per_index[index]
         for field in fields:
             if field.name not in index_fields:
                 continue
@@ -358,40 +518,55 @@ def coerce_type(value: Any, type: FieldType):
     Coerces values into the respective type in elastic
     based on ES_MAPPINGS and elastic field types
     """
-    if type == "date":
-        if isinstance(value, datetime.date):
-            return value.isoformat()
-        str_value = str(value)
-        try:
-            datetime.datetime.fromisoformat(str_value)
-        except ValueError:
-            raise ValueError(f"Invalid date value: {value!r}. Dates must be valid ISO 8601 with year between 1 and 9999.")
-        return str_value
-    if type == "tag" and isinstance(value, Iterable) and not isinstance(value, str):
+    return coercer(type)(value)
+
+
+def coercer(type: FieldType) -> Callable[[Any], Any]:
+    """
+    Get the function that coerces values of this type (see coerce_type).
+    When converting many values, look this up once per field rather than calling coerce_type for every value.
+    """
+    return _COERCERS.get(type, _keep_value)
+
+
+def _coerce_date(value: Any) -> str:
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    str_value = str(value)
+    try:
+        datetime.datetime.fromisoformat(str_value)
+    except ValueError:
+        raise ValueError(f"Invalid date value: {value!r}. Dates must be valid ISO 8601 with year between 1 and 9999.")
+    return str_value
+
+
+def _coerce_tag(value: Any) -> str | list[str]:
+    if isinstance(value, Iterable) and not isinstance(value, str):
         return [str(val) for val in value]
-    if type in ["text", "tag"]:
-        return str(value)
-    if type in ["boolean"]:
-        return bool(value)
-    if type in ["number"]:
-        return float(value)
-    if type in ["integer"]:
-        return int(value)
+    return str(value)
 
-    # TODO: check coercion / validation for object, vector and geo types
-    if type in ["object"]:
-        return value
-    if type in ["vector"]:
-        return value
-    if type in ["geo_point"]:
-        return value
 
+def _keep_value(value: Any) -> Any:
+    return value
+
+
+_COERCERS: dict[str, Callable[[Any], Any]] = {
+    "date": _coerce_date,
+    "tag": _coerce_tag,
+    "text": str,
+    "boolean": bool,
+    "number": float,
+    "integer": int,
+    # TODO: check coercion / validation for object, vector and geo types
+    "object": _keep_value,
+    "vector": _keep_value,
+    "geo_point": _keep_value,
     # TODO: Perhaps we should check if its a local file path (meaning we use S3), and in
     # that case enforce using a correct extension.
-    if type in ["image", "video", "audio"]:
-        return str(value)
-
-    return value
+    "image": str,
+    "video": str,
+    "audio": str,
+}
 
 
 async def create_or_verify_tag_field(index: str | list[str], field: str):
@@ -402,8 +577,7 @@ async def create_or_verify_tag_field(index: str | list[str], field: str):
     """
     indices = [index] if isinstance(index, str) else index
     add_to_indices: list[str] = []
-    for i in indices:
-        current_fields = await list_fields(i)
+    for i, current_fields in (await list_fields_many(indices)).items():
         if field in current_fields:
             if current_fields[field].type != "tag":
                 raise ValueError(f"Field '{field}' already exists in index '{i}' and is not a tag field")
@@ -414,6 +588,7 @@ async def create_or_verify_tag_field(index: str | list[str], field: str):
         current_fields = await list_fields(i)
         current_fields[field] = _get_default_field("tag")
         await es().indices.put_mapping(index=index, properties={field: {"type": "keyword"}})
+        await fields_changed(index)
         await _update_fields(i, current_fields)
 
 
@@ -496,6 +671,7 @@ async def _update_fields(index: str, fields: dict[str, DocumentField]):
             yield BulkInsertAction(index=fields_index_name(), id=id, doc=field_doc)
 
     await es_bulk_upsert(insert_fields())
+    await fields_changed(index)
 
 
 async def _list_fields(index: str) -> dict[str, DocumentField]:
@@ -503,6 +679,13 @@ async def _list_fields(index: str) -> dict[str, DocumentField]:
     return {doc["name"]: DocumentField.model_validate(doc["settings"]) async for id, doc in docs}
 
 
+async def _list_fields_many(indices: list[str]) -> dict[str, dict[str, DocumentField]]:
+    fields: dict[str, dict[str, DocumentField]] = {index: {} for index in indices}
+    async for id, doc in index_scan(fields_index_name(), query={"terms": {"index": indices}}):
+        fields[doc["index"]][doc["name"]] = DocumentField.model_validate(doc["settings"])
+    return fields
+
+
 async def _get_es_index_fields(index: str) -> AsyncGenerator[tuple[str, dict], None]:
     r = await es().indices.get_mapping(index=index)
     if "properties" in r[index]["mappings"]:
@@ -511,8 +694,13 @@ async def _get_es_index_fields(index: str) -> AsyncGenerator[tuple[str, dict], N
 
 
 async def _infer_es_index_fields(index: str) -> dict[str, DocumentField]:
+    r = await es().indices.get_mapping(index=index)
+    return _infer_fields_from_mapping(r[index]["mappings"])
+
+
+def _infer_fields_from_mapping(mappings: dict) -> dict[str, DocumentField]:
     fields: dict[str, DocumentField] = {}
-    async for name, mapping in _get_es_index_fields(index):
+    for name, mapping in mappings.get("properties", {}).items():
         elastic_type = mapping.get("type", "object")
         nested_props = mapping.get("properties", None)
         type = infer_field_type(elastic_type, nested_props)
@@ -540,4 +728,5 @@ async def _update_index_fields_mappings(index: str, fields: dict[str, DocumentFi
 
     if mapping_updates:
         await es().indices.put_mapping(index=index, properties=mapping_updates)
+        await fields_changed(index)
     await _update_fields(index, fields)
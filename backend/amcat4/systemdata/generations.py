@@ -0,0 +1,94 @@
+"""
+Generation counters for caches of system data.
+
+The caches of system data (e.g. api keys, roles) live in a single worker. Writers bump a generation counter, which
+is stored in the document with id "_generations" in the settings index. Other workers regularly compare the counter
+with the value they saw before, and drop their cache if it changed (see GenerationWatcher).
+
+Counters can also be kept per key (e.g. the "documents" counter per project index). These are stored in their own
+document (with id "_generations:<key>"), so that writers of different keys do not contend for the same document.
+"""
+
+import time
+from typing import Callable
+
+from elasticsearch import NotFoundError
+
+from amcat4.connections import es
+from amcat4.systemdata.versions import settings_index_id, settings_index_name
+
+
+def _generations_id(key: str | None) -> str:
+    return settings_index_id("_generations" if key is None else f"_generations:{key}")
+
+
+async def get_system_generation(name: str, key: str | None = None) -> int:
+    """
+    Get the value of a generation counter. Caches of system data (e.g. api keys) can compare this to the value they
+    saw before to notice changes made by other workers, since writers bump the counter with bump_system_generation.
+    If key is given, get the counter for this key (e.g. an index) rather than the global one.
+    """
+    id = _generations_id(key)
+    try:
+        doc = (await es().get(index=settings_index_name(), id=id, source_includes=[f"generations.{name}"]))["_source"]
+    except NotFoundError:
+        return 0
+    return doc.get("generations", {}).get(name, 0)
+
+
+async def bump_system_generation(name: str, key: str | None = None) -> int:
+    """Increment a generation counter (see get_system_generation), and return its new value"""
+    id = _generations_id(key)
+    script = {
+        "source": "ctx._source.generations[params.name] = ctx._source.generations.getOrDefault(params.name, 0) + 1",
+        "params": {"name": name},
+    }
+    res = await es().update(
+        index=settings_index_name(),
+        id=id,
+        script=script,
+        upsert={"generations": {name: 1}},
+        source_includes=[f"generations.{name}"],
+        retry_on_conflict=10,
+    )
+    return res["get"]["_source"]["generations"][name]
+
+
+# Workers compare generation counters with the value they saw before at most this often (in seconds)
+GENERATION_CHECK_INTERVAL = 2
+
+
+class GenerationWatcher:
+    """
+    Keeps the cache of a worker in sync with a generation counter: on_change (which should drop the cache) is called
+    when the counter was bumped by another worker. Call check before using the cache, which compares the counter
+    at most every GENERATION_CHECK_INTERVAL seconds, and call bump after changing the cached data.
+    If key is given, the counter for this key is watched (see get_system_generation).
+    """
+
+    def __init__(self, name: str, on_change: Callable[[], None], key: str | None = None):
+        self.name = name
+        self.key = key
+        self.on_change = on_change
+        self.generation: int | None = None
+        self.checked = 0.0
+
+    async def check(self) -> None:
+        if time.monotonic() - self.checked < GENERATION_CHECK_INTERVAL:
+            return
+        self.checked = time.monotonic()
+        generation = await get_system_generation(self.name, self.key)
+        if generation != self.generation:
+            self.on_change()
+            self.generation = generation
+
+    async def bump(self) -> None:
+        """
+        Bump the counter, so other workers drop their cache. Bump before invalidating the changed entries of this
+        worker, so entries loaded in the meantime cannot stay in the cache.
+        If another worker bumped the counter since we last saw it, on_change is called as well.
+        """
+        previous, self.generation = self.generation, await bump_system_generation(self.name, self.key)
+        self.checked = time.monotonic()
+        if previous is None or self.generation != previous + 1:
+            self.on_change()
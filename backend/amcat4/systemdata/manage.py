@@ -9,6 +9,8 @@ from amcat4.elastic.util import (
     SystemIndexMapping,
     system_index_name,
 )
+from amcat4.systemdata.generations import bump_system_generation, get_system_generation
+from amcat4.systemdata.roles import rebuild_project_access
 from amcat4.systemdata.versions import LATEST_VERSION, VERSIONS
 
 
@@ -53,9 +55,21 @@ async def create_or_update_systemdata(rm_pending_migrations: bool = True) -> int
         logging.info(f"Syst index at version {active_version}, migrating to version {LATEST_VERSION}")
         await migrate(active_version, LATEST_VERSION)
 
+    await initialize_project_access()
     return LATEST_VERSION
 
 
+async def initialize_project_access() -> None:
+    """
+    The project access field (see roles.project_access_filter) was added to the settings index after v2 was released,
+    so compute it from the roles if that was not done before.
+    """
+    if await get_system_generation("project_access") == 0:
+        logging.info("Computing project access from the project roles")
+        await rebuild_project_access()
+        await bump_system_generation("project_access")
+
+
 async def active_systemdata_status(latest_version: int, rm_pending_migrations: bool = True) -> int | None:
     """
     Find which systemdata version is currently active, and return its version nr.
@@ -125,23 +139,53 @@ async def migrate_to_version(version: int):
 async def create_systemdata_mappings(version: int, migration_pending: bool) -> None:
     indices: list[SystemIndexMapping] = VERSIONS[version].SYSTEM_INDICES
     for index in indices:
-        body = {
-            "dynamic": "strict",
-            "properties": index.mapping,
+        await create_systemdata_index(version, index, migration_pending)
+
+
+async def create_systemdata_index(version: int, index: SystemIndexMapping, migration_pending: bool = False) -> None:
+    body = {
+        "dynamic": "strict",
+        "properties": index.mapping,
+    }
+    if migration_pending:
+        body["_meta"] = {
+            "migration_pending": True,
         }
-        if migration_pending:
-            body["_meta"] = {
-                "migration_pending": True,
-            }
-        index = system_index_name(version, index.name)
-        await es().indices.create(index=index, mappings=body)
+    # System indices are small, so a single shard (with a replica if there are multiple nodes) is plenty
+    settings = {"number_of_shards": 1, "auto_expand_replicas": "0-1", "refresh_interval": index.refresh_interval}
+    await es().indices.create(index=system_index_name(version, index.name), mappings=body, settings=settings)
 
 
 async def update_systemdata_mappings(version: int) -> None:
     indices: list[SystemIndexMapping] = VERSIONS[version].SYSTEM_INDICES
     for index in indices:
         id = system_index_name(version, index.name)
-        await es().indices.put_mapping(index=id, properties=index.mapping)
+        if index.create_if_missing and not await es().indices.exists(index=id):
+            logging.info(f"Creating system index {id}, which was added to version {version}")
+            await create_systemdata_index(version, index)
+        else:
+            try:
+                await es().indices.put_mapping(index=id, properties=index.mapping)
+            except BadRequestError:
+                if not index.transient:
+                    raise
+                # e.g. the sessions data used to be an (analyzed) text field. Field types cannot be changed in place,
+                # but losing the data of a transient index is fine (users just need to log in again)
+                logging.warning(f"Recreating system index {id}, because its mapping cannot be updated in place")
+                await recreate_systemdata_index(version, index)
+                continue
+            await es().indices.put_settings(index=id, settings={"refresh_interval": index.refresh_interval})
+
+
+async def recreate_systemdata_index(version: int, index: SystemIndexMapping) -> None:
+    id = system_index_name(version, index.name)
+    await es().indices.delete(index=id, ignore_unavailable=True)
+    try:
+        await create_systemdata_index(version, index)
+    except BadRequestError as e:
+        # Another worker that started at the same time may have recreated it already
+        if e.error != "resource_already_exists_exception":
+            raise
 
 
 class SystemIndexVersionStatus(BaseModel):
@@ -164,7 +208,8 @@ async def systemdata_version_status(version: int) -> SystemIndexVersionStatus:
         index_status = await check_index_status(index)
 
         if index_status == "missing":
-            status.missing_indices.append(index)
+            if not system_index.create_if_missing:
+                status.missing_indices.append(index)
         else:
             status.does_not_exist = False
             if index_status == "migrating":
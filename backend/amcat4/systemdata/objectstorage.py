@@ -142,7 +142,7 @@ async def refresh_objectstorage(
             )
             yield action
 
-    await es_bulk_upsert(gen(), batchsize=2500)
+    await es_bulk_upsert(gen())
 
     return await _clean_register(index, field=field, min_sync=sync_time)
 
@@ -166,9 +166,13 @@ async def delete_register(index: IndexId, field: str | None = None):
 
 async def delete_objects(index: IndexId, field: str, filepaths: list[str]):
     ids = [objectstorage_index_id(index, field, fp) for fp in filepaths]
-    result = await es().delete_by_query(index=objectstorage_index_name(), query={"ids": {"values": ids}}, refresh=True)
-    print(result)
-    return dict(updated=result["deleted"], total=result["total"])
+    if not ids:
+        return dict(updated=0, total=0)
+    # The ids are known, so delete them in bulk and only wait for the next refresh instead of forcing one
+    operations = [{"delete": {"_index": objectstorage_index_name(), "_id": id}} for id in ids]
+    result = await es().bulk(operations=operations, refresh="wait_for")
+    deleted = sum(1 for item in result["items"] if item["delete"].get("result") == "deleted")
+    return dict(updated=deleted, total=deleted)
 
 
 async def _clean_register(
@@ -0,0 +1,84 @@
+"""
+Background reconciliation of the fields system index with the elasticsearch mappings.
+
+list_fields never writes to elastic. If it finds that the fields system index and the mapping of an index
+are not in sync, it schedules the index for repair (see systemdata.fields.schedule_fields_repair).
+The reconciler picks up these pending repairs within a few seconds, and also periodically sweeps all
+projects (settings.fields_reconcile_interval). Because there is only one reconciler per process,
+concurrent requests can no longer race to repair the same index. If the API runs with multiple workers,
+only the worker that acquires the "fields_sweep" lease does the periodic sweep.
+"""
+
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator
+
+from elasticsearch import NotFoundError
+
+from amcat4.config import get_settings
+from amcat4.systemdata.fields import list_and_repair_fields, pop_pending_fields_repairs
+from amcat4.systemdata.settings import acquire_system_lease, list_project_ids
+
+# How often (in seconds) the reconciler checks for pending repairs
+POLL_INTERVAL = 1.0
+
+
+async def reconcile_fields(indices: list[str] | None = None) -> list[str]:
+    """
+    Repair the fields of the given indices (or of all projects if indices is None).
+    Errors are logged and do not stop the other repairs. Returns the indices that were checked.
+    """
+    if indices is None:
+        indices = await list_project_ids()
+    for index in indices:
+        try:
+            await list_and_repair_fields(index)
+        except NotFoundError:
+            logging.debug(f"Not repairing fields of {index}, because the index does not exist")
+        except Exception:
+            logging.exception(f"Could not repair fields of index {index}")
+    return indices
+
+
+async def run_fields_reconciler(sweep_interval: float | None = None) -> None:
+    """
+    Run forever, repairing pending indices every POLL_INTERVAL seconds, and all projects every sweep_interval
+    seconds (default: settings.fields_reconcile_interval, use 0 to disable sweeps) if no other worker did so.
+    """
+    if sweep_interval is None:
+        sweep_interval = get_settings().fields_reconcile_interval
+    last_sweep = time.monotonic()
+    while True:
+        await asyncio.sleep(POLL_INTERVAL)
+        try:
+            sweep = sweep_interval > 0 and time.monotonic() - last_sweep > sweep_interval
+            if sweep:
+                last_sweep = time.monotonic()
+                # With multiple workers, only one of them needs to sweep
+                sweep = await acquire_system_lease("fields_sweep", sweep_interval)
+            if sweep:
+                pop_pending_fields_repairs()
+                await reconcile_fields()
+            elif pending := pop_pending_fields_repairs():
+                await reconcile_fields(pending)
+        except Exception:
+            logging.exception("Error in fields reconciler")
+
+
+@asynccontextmanager
+async def fields_reconciler() -> AsyncGenerator[None, None]:
+    """
+    Run the fields reconciler as a background task while in this context.
+    Use this in the FastAPI lifespan, after the system data has been created.
+    """
+    task = asyncio.create_task(run_fields_reconciler())
+    try:
+        yield
+    finally:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
@@ -31,14 +31,14 @@ async def update_request(request: AdminPermissionRequest):
         id=id,
         doc=doc,
         doc_as_upsert=True,
-        refresh=True,
+        refresh="wait_for",
     )
 
 
 async def delete_request(request: AdminPermissionRequest):
     doc = _request_to_elastic(request)
     id = requests_index_id(doc["type"], doc["email"], doc["project_id"])
-    await es().delete(index=requests_index_name(), id=id, refresh=True)
+    await es().delete(index=requests_index_name(), id=id, refresh="wait_for")
 
 
 async def list_user_requests(user: User) -> AsyncIterable[AdminPermissionRequest]:
@@ -1,10 +1,27 @@
-from typing import AsyncIterable
+"""
+Roles of users on the server and on projects.
+
+Roles are checked on (almost) every request, so the role rules that can apply to a user (i.e. the rules for their
+email address, their email domain and the guest rules) are cached per user in-process (see _user_role_rules).
+All functions that write to the roles system index need to call roles_changed afterwards, which drops the cached roles
+in this worker and bumps the "roles" generation counter so that other workers drop their cache as well.
+
+To list the projects of a user without collecting all their project ids first, the settings document of each project
+also contains the email patterns that have a role on it ("access", see project_access_filter). Functions that write
+project roles need to update this with _update_project_access.
+"""
+
+from collections import defaultdict
+from typing import AsyncIterable, Iterable
 
 from fastapi import HTTPException
 
+from amcat4.cache import VersionedCache
 from amcat4.connections import es
-from amcat4.elastic.util import index_scan
+from amcat4.elastic.util import bulk_index_error, es_bulk, index_scan
 from amcat4.models import (
+    AuthContext,
+    BulkRoleResult,
     GuestRole,
     IndexId,
     RoleContext,
@@ -13,7 +30,38 @@ from amcat4.models import (
     Roles,
     User,
 )
-from amcat4.systemdata.versions import roles_index_id, roles_index_name
+from amcat4.systemdata.generations import GenerationWatcher
+from amcat4.systemdata.versions import roles_index_id, roles_index_name, settings_index_id, settings_index_name
+
+# Cached role rules per tuple of email patterns (see _role_emails)
+_ROLES_CACHE: VersionedCache[tuple[str, ...], list[RoleRule]] = VersionedCache(maxsize=4096)
+
+
+def invalidate_roles_cache(email: RoleEmailPattern | None = None) -> None:
+    """
+    Drop the cached roles of users that the rules for this email pattern apply to.
+    Changes to domain or guest rules (or email=None) drop all cached roles.
+    """
+    if email is None or email.startswith("*"):
+        _ROLES_CACHE.invalidate()
+    else:
+        _ROLES_CACHE.invalidate(tuple(_role_emails(email)))
+
+
+# Workers drop their cached roles if another worker changed a role
+_GENERATION = GenerationWatcher("roles", invalidate_roles_cache)
+
+
+async def roles_changed(*emails: RoleEmailPattern | None) -> None:
+    """
+    Call after writing to the roles index: drop the cached roles for these email patterns (or all roles if none are
+    given), and bump the "roles" generation counter so other workers drop their cached roles as well.
+    """
+    await _GENERATION.bump()
+    if not emails:
+        invalidate_roles_cache()
+    for email in emails:
+        invalidate_roles_cache(email)
 
 
 def role_is_at_least(user: User, user_role: RoleRule | None, required_role: Roles, ignore_restrictions: bool = False) -> bool:
@@ -57,6 +105,37 @@ async def delete_server_role(email: RoleEmailPattern, ignore_missing: bool = Fal
     await _delete_role(email=email, role_context="_server", ignore_missing=ignore_missing)
 
 
+async def bulk_set_roles(rules: list[RoleRule]) -> list[BulkRoleResult]:
+    """
+    Create or update (or with role NONE: delete) many role rules with a single bulk request.
+    Returns the result for each rule, in the same order. Rules that could not be set have result "error".
+    """
+    if not rules:
+        return []
+    operations: list[dict] = []
+    for rule in rules:
+        meta = {"_index": roles_index_name(), "_id": roles_index_id(rule.email, rule.role_context)}
+        if rule.role == Roles.NONE.name:
+            operations.append({"delete": meta})
+        else:
+            operations += [{"index": meta}, rule.model_dump()]
+    response = await es().bulk(operations=operations, refresh="wait_for")
+    await roles_changed(*{rule.email for rule in rules})
+
+    results = []
+    for rule, item in zip(rules, response["items"]):
+        ((_, item),) = item.items()
+        if error := item.get("error"):
+            result = BulkRoleResult(**rule.model_dump(), result="error", error=error.get("reason") or error.get("type"))
+        else:
+            result = BulkRoleResult(**rule.model_dump(), result=item["result"])
+        results.append(result)
+    # Only the rules that were actually set can change the project access
+    changed = [result for result in results if result.result != "error"]
+    await _update_project_access([(rule.role_context, rule.email, rule.role != Roles.NONE.name) for rule in changed])
+    return results
+
+
 def list_project_roles(
     emails: list[RoleEmailPattern] | None = None,
     project_ids: list[IndexId] | None = None,
@@ -77,8 +156,9 @@ async def list_user_roles(
     role_contexts: list[RoleContext] | None = None,
     required_role: Roles | None = None,
 ) -> list[RoleRule]:
-    all_matches = _list_roles(emails=_user_to_role_emails(user), role_contexts=role_contexts, min_role=required_role)
-    return await _get_user_matches(user, all_matches)
+    rules = await _user_role_rules(user)
+    all_matches = _filter_roles(rules, role_contexts=role_contexts, min_role=required_role)
+    return _get_user_matches(user, all_matches)
 
 
 async def list_user_project_roles(
@@ -91,8 +171,9 @@ async def list_user_project_roles(
     This gives the most exact matching role for each project (guest, domain or full email).
     This does not (!!) take server role into account (see get_user_project_role)
     """
-    all_matches = list_project_roles(emails=_user_to_role_emails(user), project_ids=project_ids, min_role=required_role)
-    return await _get_user_matches(user, all_matches)
+    rules = await _user_role_rules(user)
+    all_matches = _filter_roles(rules, role_contexts=project_ids, min_role=required_role, only_projects=True)
+    return _get_user_matches(user, all_matches)
 
 
 async def get_user_project_role(user: User, project_index: IndexId, global_admin: bool = True) -> RoleRule:
@@ -106,36 +187,88 @@ async def get_user_project_role(user: User, project_index: IndexId, global_admin
 
     returns a RoleRule with Role.NONE if no role exists.
     """
-    # If auth disabled always return the admin role, even if global_admin is False.
-    if user.auth_disabled:
-        assert user.email is not None
-        return RoleRule(email=user.email, role_context=project_index, role=Roles.ADMIN.name)
+    return (await get_user_project_roles(user, [project_index], global_admin=global_admin))[project_index]
+
+
+async def get_user_project_roles(
+    user: User, project_indices: list[IndexId], global_admin: bool = True
+) -> dict[IndexId, RoleRule]:
+    """
+    Get the role for the given user on each of the given projects (see get_user_project_role).
+    The roles on all projects (and the server role) are resolved in a single lookup.
+    """
+    # If auth disabled or the user is a superadmin, we don't need to look up any roles
+    if user.auth_disabled or (global_admin and user.superadmin):
+        return _resolve_project_roles(user, project_indices, [], global_admin)
+
+    # If we need to consider global admin, we fetch the server role together with the project roles
+    role_contexts: list[RoleContext] = [*project_indices, "_server"] if global_admin else list(project_indices)
+    rules = _filter_roles(await _user_role_rules(user), role_contexts=role_contexts)
+    return _resolve_project_roles(user, project_indices, rules, global_admin)
+
+
+async def fetch_user_project_roles(
+    user: User, project_ids: list[IndexId], required_role: Roles | None = None
+) -> dict[IndexId, RoleRule]:
+    """
+    Get the project role of the user on each of the given projects (as list_user_project_roles), for listing projects.
+    Only the rules for these projects are fetched (by id), rather than all rules that apply to the user.
+    Projects on which the user has no (sufficient) role are omitted.
+    """
+    ids = [roles_index_id(email, project_id) for project_id in project_ids for email in _user_to_role_emails(user)]
+    if not ids:
+        return {}
+    docs = (await es().mget(index=roles_index_name(), ids=ids))["docs"]
+    rules = [RoleRule.model_validate(doc["_source"]) for doc in docs if doc.get("found")]
+    matches = _get_user_matches(user, _filter_roles(rules, min_role=required_role, only_projects=True))
+    return {rule.role_context: rule for rule in matches}
+
+
+def project_role_ids(user: User, project_index: IndexId) -> list[str]:
+    """
+    The ids of the documents in the roles index that can determine the role of this user on this project (i.e. the
+    project and server rules for the email patterns of the user). As these include the guest rules ("*"), they also
+    determine the guest role of the project. See resolve_project_roles.
+    """
+    return [roles_index_id(email, context) for context in (project_index, "_server") for email in _user_to_role_emails(user)]
 
+
+def resolve_project_roles(user: User, project_index: IndexId, rules: list[RoleRule]) -> tuple[RoleRule, RoleRule, GuestRole]:
+    """
+    Resolve the roles on a project from the role rules fetched with the ids from project_role_ids.
+    Returns the role of the user (as get_user_project_role), their role on the project itself (with global_admin=False),
+    and the guest role of the project (as get_project_guest_role).
+    """
+    user_emails = _user_to_role_emails(user)
+    user_rules = [rule for rule in rules if rule.email in user_emails]
+    role = _resolve_project_roles(user, [project_index], user_rules, global_admin=True)[project_index]
+    project_role = _resolve_project_roles(user, [project_index], user_rules, global_admin=False)[project_index]
+    guest_rules = [rule for rule in rules if rule.email == "*"]
+    guest_role = _resolve_project_roles(User(email=None), [project_index], guest_rules, global_admin=True)[project_index]
+    return role, project_role, _guest_role(guest_role)
+
+
+def _resolve_project_roles(
+    user: User, project_indices: list[IndexId], rules: Iterable[RoleRule], global_admin: bool
+) -> dict[IndexId, RoleRule]:
+    """Get the role of the user on each project from the role rules that apply to the user (see get_user_project_roles)"""
+    # If auth disabled always return the admin role, even if global_admin is False.
     # If the user is a superadmin, we can directly return ADMIN
-    if global_admin and user.superadmin:
+    if user.auth_disabled or (global_admin and user.superadmin):
         assert user.email is not None
-        return RoleRule(email=user.email, role_context=project_index, role=Roles.ADMIN.name)
-
-    # If we just need the project role, its a simple lookup
-    if not global_admin:
-        project_role = await list_user_roles(user, role_contexts=[project_index])
-        project_role = project_role[0] if project_role else None
+        return {ix: RoleRule(email=user.email, role_context=ix, role=Roles.ADMIN.name) for ix in project_indices}
 
-    # If we need to consider global admin, we fetch both roles in one go
-    # and overwrite the project role if the server role is ADMIN
-    else:
-        user_roles = await list_user_roles(user, role_contexts=[project_index, "_server"])
-        project_role = next((ur for ur in user_roles if ur.role_context == project_index), None)
-        server_role = next((ur for ur in user_roles if ur.role_context == "_server"), None)
+    # If we consider global admin, use the server role instead of the project role if the server role is ADMIN
+    user_roles = {ur.role_context: ur for ur in _get_user_matches(user, rules)}
+    server_role = user_roles.get("_server") if global_admin else None
 
+    roles: dict[IndexId, RoleRule] = {}
+    for ix in project_indices:
         if server_role and server_role.role == Roles.ADMIN.name:
-            project_role = server_role
-            project_role.role_context = project_index
-
-    if project_role:
-        return project_role
-    else:
-        return RoleRule(email="*", role_context=project_index, role="NONE")
+            roles[ix] = server_role.model_copy(update={"role_context": ix})
+        else:
+            roles[ix] = user_roles.get(ix) or RoleRule(email="*", role_context=ix, role="NONE")
+    return roles
 
 
 async def get_user_server_role(user: User) -> RoleRule:
@@ -154,12 +287,22 @@ async def get_user_server_role(user: User) -> RoleRule:
 
 
 async def HTTPException_if_not_project_index_role(
-    user: User, role_context: RoleContext, required_role: Roles, global_admin: bool = True, message: str | None = None
+    user: User,
+    role_context: RoleContext,
+    required_role: Roles,
+    global_admin: bool = True,
+    message: str | None = None,
+    role: RoleRule | None = None,
 ):
     """
     Raise an HTTP Exception if the user does not have the required role for the given context.
+    If the role of the user was already looked up (e.g. with resolve_project_roles), it can be passed as role.
     """
-    role = await get_user_project_role(user, role_context, global_admin=global_admin)
+    if role is None:
+        role = await get_user_project_role(user, role_context, global_admin=global_admin)
+    else:
+        # role_is_at_least applies the API key restrictions to the role in place, so don't change the caller's role
+        role = role.model_copy()
 
     if message:
         detail = f"does not have persmission. {message}"
@@ -172,6 +315,27 @@ async def HTTPException_if_not_project_index_role(
         raise HTTPException(403, f"API key '{user.api_key_name}' {detail}")
 
 
+async def require_project_roles(
+    user: User, project_indices: list[IndexId], required_role: Roles, raise_error: bool = True
+) -> dict[IndexId, bool]:
+    """
+    Check whether the user has the required role on each of the given projects, with a single role lookup.
+    Returns the verdict per project. If raise_error is True (the default), raises a 403 HTTPException
+    naming all projects on which the user (or their API key) does not have the required role.
+    """
+    roles = await get_user_project_roles(user, project_indices)
+    # Check the user roles first, because role_is_at_least applies the API key restrictions to the role in place
+    user_verdicts = {ix: role_is_at_least(user, role, required_role, ignore_restrictions=True) for ix, role in roles.items()}
+    verdicts = {ix: role_is_at_least(user, role, required_role) for ix, role in roles.items()}
+    if raise_error and not all(verdicts.values()):
+        if not all(user_verdicts.values()):
+            who, denied = user.email or "GUEST", [ix for ix, ok in user_verdicts.items() if not ok]
+        else:
+            who, denied = f"API key '{user.api_key_name}'", [ix for ix, ok in verdicts.items() if not ok]
+        raise HTTPException(403, f"{who} does not have {required_role.name} permissions on project(s) {', '.join(denied)}")
+    return verdicts
+
+
 async def HTTPException_if_not_server_role(user: User, required_role: Roles, message: str | None = None):
     """
     Raise an HTTP Exception if the user does not have the required role for the given context.
@@ -199,10 +363,13 @@ async def set_project_guest_role(index_id: IndexId, role: Roles):
 
 async def get_project_guest_role(index_id: IndexId) -> GuestRole:
     """Get the guest role for an index. Note that this returns the Role not RoleRule!"""
-    role = (await get_user_project_role(user=User(email=None), project_index=index_id)).role
-    if role == Roles.ADMIN.name:
+    return _guest_role(await get_user_project_role(user=User(email=None), project_index=index_id))
+
+
+def _guest_role(role: RoleRule) -> GuestRole:
+    if role.role == Roles.ADMIN.name:
         return Roles.WRITER.name  # guests cannot be ADMIN.
-    return role
+    return role.role
 
 
 async def _create_role(email: RoleEmailPattern, role_context: RoleContext, role: Roles):
@@ -215,7 +382,9 @@ async def _create_role(email: RoleEmailPattern, role_context: RoleContext, role:
         raise HTTPException(422, "Cannot create a role with Role.NONE.")
 
     user_role = RoleRule(email=email, role_context=role_context, role=role.name)
-    await es().create(index=roles_index_name(), id=id, document=user_role.model_dump(), refresh=True)
+    await es().create(index=roles_index_name(), id=id, document=user_role.model_dump(), refresh="wait_for")
+    await roles_changed(email)
+    await _update_project_access([(role_context, email, True)])
 
 
 async def _update_role(email: RoleEmailPattern, role_context: RoleContext, role: Roles, ignore_missing: bool = False):
@@ -227,12 +396,75 @@ async def _update_role(email: RoleEmailPattern, role_context: RoleContext, role:
         await _delete_role(email, role_context, ignore_missing=ignore_missing)
 
     user_role = RoleRule(email=email, role_context=role_context, role=role.name)
-    await es().update(index=roles_index_name(), id=id, doc=user_role.model_dump(), doc_as_upsert=ignore_missing, refresh=True)
+    doc = user_role.model_dump()
+    await es().update(index=roles_index_name(), id=id, doc=doc, doc_as_upsert=ignore_missing, refresh="wait_for")
+    await roles_changed(email)
+    await _update_project_access([(role_context, email, role != Roles.NONE)])
 
 
 async def _delete_role(email: RoleEmailPattern, role_context: RoleContext, ignore_missing: bool = False):
     elastic = es().options(ignore_status=404) if ignore_missing else es()
-    await elastic.delete(index=roles_index_name(), id=roles_index_id(email, role_context), refresh=True)
+    await elastic.delete(index=roles_index_name(), id=roles_index_id(email, role_context), refresh="wait_for")
+    await roles_changed(email)
+    await _update_project_access([(role_context, email, False)])
+
+
+def project_access_filter(user: User) -> dict:
+    """
+    Elastic filter for the project settings documents that have a role rule that can apply to this user.
+    Note that this includes rules with a role that is restricted (e.g. by API key restrictions), so the actual role
+    still needs to be checked.
+    """
+    return {"terms": {"access": _user_to_role_emails(user)}}
+
+
+async def rebuild_project_access() -> None:
+    """Recompute the access field of all project settings documents from the roles index"""
+    access: dict[str, set[str]] = defaultdict(set)
+    async for rule in _list_roles(only_projects=True):
+        if rule.role != Roles.NONE.name:
+            access[rule.role_context].add(rule.email)
+
+    async def actions():
+        query = {"exists": {"field": "project_settings.id"}}
+        async for id, doc in index_scan(settings_index_name(), query=query, source=["project_settings.id"]):
+            index = doc["project_settings"]["id"]
+            yield {"_op_type": "update", "_index": settings_index_name(), "_id": id, "doc": {"access": sorted(access[index])}}
+
+    await es_bulk(actions(), refresh="wait_for")
+
+
+_ACCESS_SCRIPT = """
+if (ctx._source.access == null) { ctx._source.access = []; }
+else if (ctx._source.access instanceof String) { ctx._source.access = [ctx._source.access]; }
+ctx._source.access.removeIf(e -> e == params.email);
+if (params.add) { ctx._source.access.add(params.email); }
+"""
+
+
+async def _update_project_access(changes: list[tuple[RoleContext, RoleEmailPattern, bool]]) -> None:
+    """
+    Add (if the bool is True) or remove the email patterns to/from the access field of the project settings.
+    Projects that are not registered (yet) are skipped; create_project_settings adds their existing roles.
+    Raises a BulkIndexError if any other update failed.
+    """
+    operations: list[dict] = []
+    for role_context, email, has_access in changes:
+        if role_context == "_server":
+            continue
+        meta = {"_index": settings_index_name(), "_id": settings_index_id(role_context), "retry_on_conflict": 10}
+        script = {"source": _ACCESS_SCRIPT, "params": {"email": email, "add": has_access}}
+        operations += [{"update": meta}, {"script": script}]
+    if operations:
+        res = await es().bulk(operations=operations, refresh="wait_for")
+        if res["errors"]:
+            errors = [
+                item
+                for item in res["items"]
+                if "error" in item["update"] and item["update"]["error"].get("type") != "document_missing_exception"
+            ]
+            if errors:
+                raise bulk_index_error(errors)
 
 
 async def _list_roles(
@@ -267,15 +499,57 @@ async def _list_roles(
         yield RoleRule.model_validate(user_role)
 
 
+async def _user_role_rules(user: User) -> list[RoleRule]:
+    """
+    Get all role rules (on all contexts) that can apply to this user, from the cache if possible.
+    For an AuthContext, the rules are memoized for the rest of the request.
+    The cached rules are shared, so copy them before changing them (as _get_user_matches does).
+    """
+    await _GENERATION.check()
+    emails = tuple(_user_to_role_emails(user))
+    generation = _ROLES_CACHE.generation(emails)
+    if isinstance(user, AuthContext) and (rules := user.memoized("roles", generation)) is not None:
+        return rules
+
+    async def load() -> list[RoleRule]:
+        return [rule async for rule in _list_roles(emails=list(emails))]
+
+    rules = await _ROLES_CACHE.get_or_load(emails, load)
+    if isinstance(user, AuthContext):
+        user.memoize("roles", generation, rules)
+    return rules
+
+
+def _filter_roles(
+    rules: Iterable[RoleRule],
+    role_contexts: list[RoleContext] | None = None,
+    min_role: Roles | None = None,
+    only_projects: bool = False,
+) -> Iterable[RoleRule]:
+    """Filter role rules in the same way as the query in _list_roles"""
+    for rule in rules:
+        if role_contexts is not None and rule.role_context not in role_contexts:
+            continue
+        if min_role is not None and Roles[rule.role] < min_role:
+            continue
+        if only_projects and rule.role_context == "_server":
+            continue
+        yield rule
+
+
 def _user_to_role_emails(user: User):
     """
     Given a user, return a list of email patterns that should be checked for roles.
     """
+    return _role_emails(user.email)
+
+
+def _role_emails(email: str | None) -> list[str]:
     # If no email is given, only the guest role (*) applies
-    if user.email is None:
+    if email is None:
         return ["*"]
     # Otherwise, check exact email, domain wildcard, and guest role
-    return [user.email, "*@" + user.email.split("@")[-1], "*"]
+    return [email, "*@" + email.split("@")[-1], "*"]
 
 
 def _min_role_query(min_role: Roles):
@@ -293,7 +567,7 @@ def _match_strength(email: RoleEmailPattern) -> int:
         return 3
 
 
-async def _get_user_matches(user: User, role_matches: AsyncIterable[RoleRule]) -> list[RoleRule]:
+def _get_user_matches(user: User, role_matches: Iterable[RoleRule]) -> list[RoleRule]:
     """
     From a list of role matches for an email address, return the correct role for the user.
     - If there are multiple matches, use the strongest match (exact > domain > guest)
@@ -302,7 +576,7 @@ async def _get_user_matches(user: User, role_matches: AsyncIterable[RoleRule]) -
     # use tuples of (strength, RoleRule) for each role context to sort out the strongest matches
     strongest_matches: dict[RoleContext, tuple[int, RoleRule]] = {}
 
-    async for match in role_matches:
+    for match in role_matches:
         context = match.role_context
         strength = _match_strength(match.email)
 
@@ -313,7 +587,8 @@ async def _get_user_matches(user: User, role_matches: AsyncIterable[RoleRule]) -
         else:
             strongest_matches[context] = (strength, match)
 
-    return [match for strength, match in strongest_matches.values()]
+    # Return copies, because the matches can come from the cache and callers may change them
+    return [match.model_copy() for strength, match in strongest_matches.values()]
 
 
 def restrict_role(user: User, role_rule: RoleRule) -> RoleRule:
@@ -1,8 +1,11 @@
+import time
+
 from elasticsearch import NotFoundError
 
 from amcat4.connections import es
+from amcat4.elastic.util import index_scan
 from amcat4.models import ImageObject, IndexId, ProjectSettings, Roles, ServerSettings
-from amcat4.systemdata.roles import create_project_role
+from amcat4.systemdata.roles import create_project_role, list_project_roles, roles_changed
 from amcat4.systemdata.versions import roles_index_name, settings_index_id, settings_index_name
 
 ## PROJECT INDEX SETTINGS
@@ -24,8 +27,10 @@ async def create_project_settings(index_settings: ProjectSettings, admin_email:
     """
     index_id = index_settings.id
     id = settings_index_id(index_settings.id)
-    doc = dict(project_settings=index_settings.model_dump())
-    await es().create(index=settings_index_name(), id=id, document=doc, refresh=True)
+    # Include roles that already exist for this index in the project access (see roles.project_access_filter)
+    access = [rule.email async for rule in list_project_roles(project_ids=[index_id]) if rule.role != Roles.NONE.name]
+    doc = dict(project_settings=index_settings.model_dump(), access=access)
+    await es().create(index=settings_index_name(), id=id, document=doc, refresh="wait_for")
 
     if admin_email:
         await create_project_role(admin_email, index_id, Roles.ADMIN)
@@ -34,14 +39,14 @@ async def create_project_settings(index_settings: ProjectSettings, admin_email:
 async def update_project_settings(index_settings: ProjectSettings, ignore_missing: bool = False):
     id = settings_index_id(index_settings.id)
     doc = dict(project_settings=index_settings.model_dump(exclude_none=True))
-    await es().update(index=settings_index_name(), id=id, doc=doc, doc_as_upsert=ignore_missing, refresh=True)
+    await es().update(index=settings_index_name(), id=id, doc=doc, doc_as_upsert=ignore_missing, refresh="wait_for")
 
 
 async def delete_project_settings(index_id: str, ignore_missing: bool = False):
     if index_id.startswith("_"):  # avoid mistake allowing removal of server settings (_server)
         raise ValueError(f"{index_id} is not a project index")
     try:
-        await es().delete(index=settings_index_name(), id=index_id, refresh=True)
+        await es().delete(index=settings_index_name(), id=index_id, refresh="wait_for")
     except NotFoundError:
         if not ignore_missing:
             raise
@@ -51,6 +56,14 @@ async def delete_project_settings(index_id: str, ignore_missing: bool = False):
         body={"query": {"term": {"role_context": index_id}}},
         refresh=True,
     )
+    await roles_changed()
+
+
+async def list_project_ids() -> list[IndexId]:
+    """List the ids of all registered projects (including archived projects)"""
+    query = {"exists": {"field": "project_settings.id"}}
+    docs = index_scan(settings_index_name(), query=query, source=["project_settings.id"])
+    return [doc["project_settings"]["id"] async for _, doc in docs]
 
 
 async def get_project_image(index_id: IndexId) -> ImageObject | None:
@@ -83,4 +96,28 @@ async def get_server_settings() -> ServerSettings:
 async def upsert_server_settings(server_settings: ServerSettings):
     id = settings_index_id("_server")
     doc = dict(server_settings=server_settings.model_dump(exclude_none=True))
-    await es().update(index=settings_index_name(), id=id, doc=doc, doc_as_upsert=True, refresh=True)
+    # The server settings are only read with (realtime) get, so there is no need to wait for a refresh
+    await es().update(index=settings_index_name(), id=id, doc=doc, doc_as_upsert=True)
+
+
+## LEASES
+
+
+async def acquire_system_lease(name: str, duration: float) -> bool:
+    """
+    Try to acquire a lease for the given number of seconds. Returns True if this worker got the lease, and False if
+    another worker holds it. This can be used to make sure that periodic work (e.g. a sweep over all projects)
+    is only done by one worker. A lease cannot be released, it simply expires.
+    """
+    id = settings_index_id("_leases")
+    script = {
+        "source": (
+            "if (ctx._source.leases == null) { ctx._source.leases = [:] }"
+            "if (ctx._source.leases.getOrDefault(params.name, 0) > params.now) { ctx.op = 'noop' }"
+            "else { ctx._source.leases[params.name] = params.now + params.duration }"
+        ),
+        "params": {"name": name, "now": int(time.time() * 1000), "duration": int(duration * 1000)},
+    }
+    upsert = {"leases": {name: int((time.time() + duration) * 1000)}}
+    res = await es().update(index=settings_index_name(), id=id, script=script, upsert=upsert, retry_on_conflict=10)
+    return res["result"] != "noop"
@@ -10,6 +10,7 @@ from amcat4.elastic.util import (
     SystemIndexMapping,
     es_bulk_create,
     index_scan,
+    index_scan_slices,
     system_index_name,
 )
 from amcat4.objectstorage.image_processing import create_image_from_url
@@ -41,6 +42,14 @@ def objectstorage_index_name() -> str:
     return system_index_name(VERSION, "objectstorage")
 
 
+def jobs_index_name() -> str:
+    return system_index_name(VERSION, "jobs")
+
+
+def sessions_index_name() -> str:
+    return system_index_name(VERSION, "sessions")
+
+
 def settings_index_id(index: str | Literal["_server"]) -> str:
     return index
 
@@ -76,6 +85,8 @@ _image_field = object_field(
 # The settings system index contains both server-wide settings and project settings.
 # The project settings are stored in documents with id equal to the project index name.
 # The server settings are stored in the document with id "_server"
+# The document with id "_generations" contains counters that writers bump so that caches in other workers
+# notice the change (see systemdata.generations)
 # Indices in elastic cannot start with an underscore, so there is no risk of collision.
 settings_mapping: ElasticMapping = dict(
     project_settings=object_field(
@@ -107,6 +118,20 @@ settings_mapping: ElasticMapping = dict(
             href={"type": "keyword"},
         ),
     ),
+    generations=object_field(
+        apikeys={"type": "long"},
+        documents={"type": "long"},
+        fields={"type": "long"},
+        project_access={"type": "long"},
+        sessions={"type": "long"},
+        roles={"type": "long"},
+    ),
+    # The document with id "_leases" contains the expiry time (epoch millis) of leases (see settings.acquire_system_lease)
+    leases=object_field(
+        fields_sweep={"type": "long"},
+    ),
+    # The email patterns that have a role on the project (see systemdata.roles.project_access_filter)
+    access={"type": "keyword"},
 )
 
 
@@ -186,6 +211,33 @@ objectstorage_mapping: ElasticMapping = dict(
 )
 
 
+jobs_mapping: ElasticMapping = dict(
+    index={"type": "keyword"},
+    email={"type": "keyword"},
+    operation={"type": "keyword"},
+    status={"type": "keyword"},  # "queued", "running", "completed", "failed"
+    total={"type": "long"},
+    successes={"type": "long"},
+    failures={"type": "long"},
+    errors={"type": "keyword", "index": False, "doc_values": False},  # the first failed documents, as a JSON string
+    message={"type": "text"},
+    created={"type": "date"},
+    started={"type": "date"},
+    finished={"type": "date"},
+    updated={"type": "date"},
+)
+
+
+# Login sessions (see auth.sessions). The id of a document is the hash of the session id in the cookie
+sessions_mapping: ElasticMapping = dict(
+    email={"type": "keyword"},
+    # the tokens and user info of the session, as a JSON string. It is not indexed, so the tokens cannot be searched
+    data={"type": "keyword", "index": False, "doc_values": False},
+    updated={"type": "date"},
+    expires={"type": "date"},
+)
+
+
 async def check_deprecated_version(index: str):
     """
     The v1 system has a deprecated form of versioning, where the version number was stored in the _global document.
@@ -284,6 +336,10 @@ SYSTEM_INDICES = [
     SystemIndexMapping(name="apikeys", mapping=apikey_mapping),
     SystemIndexMapping(name="requests", mapping=requests_mapping),
     SystemIndexMapping(name="objectstorage", mapping=objectstorage_mapping),
+    SystemIndexMapping(name="jobs", mapping=jobs_mapping, create_if_missing=True, refresh_interval="30s", transient=True),
+    SystemIndexMapping(
+        name="sessions", mapping=sessions_mapping, create_if_missing=True, refresh_interval="30s", transient=True
+    ),
 ]
 
 
@@ -293,7 +349,7 @@ async def migrate():
     await check_deprecated_version(v1_system_index)
 
     async def bulk_generator() -> AsyncGenerator[BulkInsertAction, None]:
-        async for id, doc in index_scan(v1_system_index):
+        async for id, doc in index_scan(v1_system_index, slices=await index_scan_slices(v1_system_index)):
             # The _global document in the v1 index contained server settings, server roles and all requests
             if id == "_global":
                 yield await migrate_server_settings(doc)
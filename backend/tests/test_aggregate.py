@@ -5,7 +5,7 @@ import pytest
 
 from amcat4.api.index_query import _standardize_queries
 from amcat4.models import CreateDocumentField
-from amcat4.projects.aggregate import Aggregation, Axis, query_aggregate
+from amcat4.projects.aggregate import Aggregation, Axis, _aggregate_results, query_aggregate
 from tests.conftest import upload
 from tests.tools import dictset
 
@@ -83,6 +83,28 @@ async def test_byquery(index_docs):
     }
 
 
+@pytest.mark.anyio
+async def test_byquery_pagination(index_many):
+    """Are queries paginated separately, and can we continue from any after cursor?"""
+    axes = [Axis("_query", field_type="_query"), Axis("id", field_type="integer")]
+    queries = {"odd": "odd", "even": "even"}
+
+    async def collect(after=None):
+        return [(rows, after) async for rows, after in _aggregate_results(index_many, axes, queries, None, [], after)]
+
+    pages = await collect()
+    rows = [row for page, _ in pages for row in page]
+    assert [row[0] for row in rows] == ["odd"] * 10 + ["even"] * 10
+    assert {row[1]: row[2] for row in rows if row[0] == "odd"} == {i: 1 for i in range(0, 20, 2)}
+    assert pages[-1][1] is None
+
+    # Continuing from each cursor should give exactly the remaining rows
+    for n, (_, after) in enumerate(pages[:-1]):
+        assert after is not None
+        remaining = [row for page, _ in await collect(dict(after)) for row in page]
+        assert remaining == [row for page, _ in pages[n + 1 :] for row in page]
+
+
 @pytest.mark.anyio
 async def test_metric(index_docs: str):
     """Do metric aggregations (e.g. avg(x)) work?"""
@@ -1,6 +1,8 @@
 import pytest
 
 from amcat4.models import Roles
+from amcat4.systemdata import apikeys, generations
+from amcat4.systemdata.generations import bump_system_generation
 from amcat4.systemdata.roles import create_project_role
 from tests.tools import auth_cookie
 
@@ -120,3 +122,30 @@ async def test_api_key_restrictions(client, index, admin):
     )
     r = next(k for k in res.json() if k["id"] == api_key_id)
     assert r["restrictions"]["server_role"] == "WRITER"
+
+
+@pytest.mark.anyio
+async def test_api_key_cache(client, admin, monkeypatch):
+    body = {"name": "test_key", "expires_at": "2030-01-01T00:00:00Z"}
+    res = await client.post("/api_keys", cookies=auth_cookie(admin), json=body)
+    api_key_id, api_key = res.json()["id"], res.json()["api_key"]
+
+    loads = []
+    load_api_key = apikeys._load_api_key
+    monkeypatch.setattr(apikeys, "_load_api_key", lambda hashed_key: loads.append(hashed_key) or load_api_key(hashed_key))
+
+    ## Known and unknown keys are only looked up once
+    for _ in range(2):
+        assert (await client.get("/users/me", headers={"X-API-KEY": api_key})).status_code == 200
+        assert (await client.get("/users/me", headers={"X-API-KEY": "ak.unknown"})).status_code == 401
+    assert len(loads) == 2
+
+    ## A change made by another worker is noticed through the generation counter
+    await bump_system_generation("apikeys")
+    monkeypatch.setattr(generations, "GENERATION_CHECK_INTERVAL", 0)
+    assert (await client.get("/users/me", headers={"X-API-KEY": api_key})).status_code == 200
+    assert len(loads) == 3
+
+    ## A deleted key can no longer be used
+    await client.delete(f"/api_keys/{api_key_id}", cookies=auth_cookie(admin))
+    assert (await client.get("/users/me", headers={"X-API-KEY": api_key})).status_code == 401
@@ -1,7 +1,17 @@
+import asyncio
+import gzip
+import json
+from datetime import UTC, datetime, timedelta
+
 import pytest
 
-from amcat4.models import Roles
+from amcat4.config import get_settings
+from amcat4.connections import es
+from amcat4.models import IngestJob, Roles
+from amcat4.projects import jobs
+from amcat4.systemdata.fields import create_fields
 from amcat4.systemdata.roles import update_project_role
+from amcat4.systemdata.versions import jobs_index_name
 from tests.tools import adelete, auth_cookie, get_json, post_json, put_json
 
 
@@ -76,3 +86,103 @@ async def test_earliest_valid_date_accepted(client, index, user):
             "fields": {"date": {"type": "date"}},
         },
     )
+
+
+@pytest.mark.anyio
+async def test_documents_stream(client, index, user):
+    """Can we upload documents as (gzipped) ndjson?"""
+    await update_project_role(user, index, Roles.WRITER, ignore_missing=True)
+    await create_fields(index, {"title": "text", "i": "integer"})
+    docs = [{"_id": str(i), "title": f"doc {i}", "i": i} for i in range(5)] + [{"unknown": "field"}]
+    body = "\n".join(json.dumps(doc) for doc in docs).encode("utf-8")
+    url = f"index/{index}/documents/stream?chunk_size=2"
+
+    r = await post_json(client, url, user=user, content=body, headers={"Content-Type": "application/x-ndjson"})
+    assert r["successes"] == 5
+    assert [f["document"] for f in r["failures"]] == [6]
+    assert [c["successes"] for c in r["chunks"]] == [2, 2, 1]
+    assert (await get_json(client, f"index/{index}/documents/3", user=user))["i"] == 3
+
+    headers = {"Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"}
+    r = await post_json(client, url, user=user, content=gzip.compress(body + b"\n"), headers=headers)
+    assert r["successes"] == 5
+    # A body of multiple gzip members (e.g. concatenated .gz files) is read completely
+    lines = body.split(b"\n")
+    content = gzip.compress(b"\n".join(lines[:3]) + b"\n") + gzip.compress(b"\n".join(lines[3:]))
+    r = await post_json(client, url, user=user, content=content, headers=headers)
+    assert r["successes"] == 5
+    assert [f["document"] for f in r["failures"]] == [6]
+
+    # Invalid JSON is reported as a failure, and does not stop the upload
+    r = await post_json(client, url, user=user, content=b'{"title": "x"}\n{invalid\n{"title": "y"}')
+    assert r["successes"] == 2
+    assert [f["document"] for f in r["failures"]] == [2]
+    assert "Line 2" in r["failures"][0]["error"]
+
+    # A body that cannot be decompressed stops the upload, reporting what was uploaded
+    r = await post_json(client, url, user=user, content=b"not gzipped", headers=headers, expected=400)
+    assert r["detail"]["successes"] == 0
+
+
+@pytest.mark.anyio
+async def test_documents_stream_max_size(client, index, user, monkeypatch):
+    """Are documents that are too large rejected without reading them into memory?"""
+    monkeypatch.setattr(get_settings(), "upload_max_document_bytes", 1000)
+    await update_project_role(user, index, Roles.WRITER, ignore_missing=True)
+    await create_fields(index, {"title": "text"})
+    url = f"index/{index}/documents/stream"
+    # A line without a newline is not buffered beyond the maximum
+    r = await post_json(client, url, user=user, content=b'{"title": "x"}\n' + b"x" * 5000, expected=413)
+    assert "Line 2" in r["detail"]["message"]
+    # A small gzipped body that inflates to a huge line (a 'gzip bomb') is stopped while decompressing
+    bomb = gzip.compress(b'{"title": "' + b"x" * 100_000_000 + b'"}')
+    headers = {"Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"}
+    r = await post_json(client, url, user=user, content=bomb, headers=headers, expected=413)
+    assert "maximum document size" in r["detail"]["message"]
+
+
+@pytest.mark.anyio
+async def test_documents_job(client, index, user, monkeypatch):
+    """Can we upload documents in the background and follow the progress?"""
+    monkeypatch.setattr(jobs, "PROGRESS_INTERVAL", 2)
+    await update_project_role(user, index, Roles.WRITER, ignore_missing=True)
+    docs = [{"_id": str(i), "title": f"doc {i}", "i": i} for i in range(5)]
+    body = {"documents": docs, "fields": {"title": "text", "i": "integer"}, "operation": "create"}
+
+    job = await post_json(client, f"index/{index}/documents/jobs", user=user, json=body, expected=202)
+    assert job["status"] == "queued" and job["total"] == 5
+    for _ in range(50):
+        status = await get_json(client, f"task/{job['id']}", user=user)
+        if status["status"] in ("completed", "failed"):
+            break
+        await asyncio.sleep(0.1)
+    assert (status["status"], status["successes"], status["failures"]) == ("completed", 5, 0)
+    assert (await get_json(client, f"index/{index}/documents/3", user=user))["i"] == 3
+
+    # Creating existing documents fails, and is reported in the job
+    job = await post_json(client, f"index/{index}/documents/jobs", user=user, json=body, expected=202)
+    while (status := await get_json(client, f"task/{job['id']}", user=user))["status"] in ("queued", "running"):
+        await asyncio.sleep(0.1)
+    assert (status["successes"], status["failures"], len(status["errors"])) == (0, 5, 5)
+
+    # Only writers can upload and see the status
+    await update_project_role(user, index, Roles.READER)
+    await post_json(client, f"index/{index}/documents/jobs", user=user, json=body, expected=403)
+    await get_json(client, f"task/{job['id']}", user=user, expected=403)
+
+
+@pytest.mark.anyio
+async def test_fail_stale_jobs(index):
+    """Jobs that were lost because their worker stopped are marked as failed"""
+    lost = IngestJob(id="amcat4_unittest_lost_job", index=index, operation="index", total=1, status="running")
+    recent = IngestJob(id="amcat4_unittest_recent_job", index=index, operation="index", total=1)
+    await jobs._save_job(lost)
+    await jobs._save_job(recent)
+    old = (datetime.now(UTC) - timedelta(hours=2)).isoformat()
+    await es().update(index=jobs_index_name(), id=lost.id, doc={"updated": old}, refresh=True)
+
+    assert await jobs.fail_stale_jobs(max_age=3600) >= 1
+    assert (job := await jobs.get_job(lost.id)) is not None and job.status == "failed"
+    assert (job := await jobs.get_job(recent.id)) is not None and job.status == "queued"
+    for job_id in (lost.id, recent.id):
+        await es().delete(index=jobs_index_name(), id=job_id)
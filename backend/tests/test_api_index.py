@@ -1,15 +1,22 @@
+import gzip
+import json
+
 import pytest
 from httpx import AsyncClient
 
 from amcat4.connections import es
-from amcat4.models import Roles
+from amcat4.elastic.util import index_scan_slices
+from amcat4.models import RoleRule, Roles
 from amcat4.systemdata.roles import (
+    bulk_set_roles,
     create_project_role,
     delete_project_role,
     get_project_guest_role,
     set_project_guest_role,
     update_project_role,
 )
+from amcat4.systemdata.versions import settings_index_id, settings_index_name
+from tests.conftest import upload
 from tests.tools import auth_cookie, check, get_json, post_json, put_json
 
 
@@ -215,6 +222,40 @@ async def test_set_get_delete_roles(client: AsyncClient, admin: str, writer: str
     assert user not in users
 
 
+@pytest.mark.anyio
+async def test_bulk_set_roles(client: AsyncClient, admin: str, writer: str, user: str, index: str):
+    body = [{"email": user, "role": "READER"}, {"email": writer, "role": "WRITER"}]
+    await check(await client.put(f"/index/{index}/users", json=body, cookies=auth_cookie(writer)), 403)
+    results = await put_json(client, f"/index/{index}/users", json=body, user=admin)
+    assert [r["result"] for r in results] == ["created", "created"]
+    assert await get_json(client, f"/index/{index}", user=writer)
+
+    # Roles are updated or removed (NONE), and invalid rows are reported without affecting the others
+    body = [{"email": user, "role": "WRITER"}, {"email": "*@example.com", "role": "ADMIN"}, {"email": writer, "role": "NONE"}]
+    results = await put_json(client, f"/index/{index}/users", json=body, user=admin)
+    assert [r["result"] for r in results] == ["updated", "error", "deleted"]
+    users = {u["email"]: u["role"] for u in await get_json(client, f"/index/{index}/users", user=admin) or []}
+    assert users == {user: "WRITER"}
+    await check(await client.get(f"/index/{index}", cookies=auth_cookie(writer)), 403)
+
+
+@pytest.mark.anyio
+async def test_bulk_set_roles_failed_item(index: str, user: str, writer: str, monkeypatch):
+    # Make elasticsearch reject the rule for writer (the roles index has a strict mapping)
+    bulk = es().bulk
+
+    async def bulk_with_invalid_rule(operations, **kwargs):
+        operations = [{**op, "invalid": 1} if op.get("email") == writer else op for op in operations]
+        return await bulk(operations=operations, **kwargs)
+
+    monkeypatch.setattr(es(), "bulk", bulk_with_invalid_rule)
+    results = await bulk_set_roles([RoleRule(email=email, role_context=index, role="READER") for email in (user, writer)])
+    assert results[0].result != "error" and results[1].result == "error"
+    # Only the rule that was written gives access to the project
+    access = (await es().get(index=settings_index_name(), id=settings_index_id(index)))["_source"].get("access")
+    assert user in access and writer not in access
+
+
 @pytest.mark.anyio
 async def test_name_description(client, index, index_name, user, admin):
     # unauthenticated or unauthorized users cannot modify or view an index
@@ -251,7 +292,12 @@ async def test_name_description(client, index, index_name, user, admin):
     await delete_project_role(user, index)
     await check(await client.get(f"/index/{index}", cookies=auth_cookie(user)), 403)
     await set_project_guest_role(index, Roles.METAREADER)
-    assert (await get_json(client, f"/index/{index}", user=user) or {})["name"] == "test"
+    view = await get_json(client, f"/index/{index}", user=user) or {}
+    assert (view["name"], view["guest_role"], view["documents"], view["fields"]) == ("test", "METAREADER", 0, {})
+    # Fields are only shown to users with at least METAREADER role
+    await set_project_guest_role(index, Roles.OBSERVER)
+    assert (await get_json(client, f"/index/{index}", user=user) or {})["fields"] is None
+    await set_project_guest_role(index, Roles.METAREADER)
 
     await check(
         await client.post(
@@ -271,3 +317,18 @@ async def test_name_description(client, index, index_name, user, admin):
     indices = {ix["id"]: ix for ix in await get_json(client, "/index", user=user) or []}
     assert indices[index]["description"] == "ooktest"
     assert indices[index_name]["description"] == "test2"
+
+
+@pytest.mark.anyio
+async def test_download_index(client: AsyncClient, admin: str, index: str):
+    # Indices with multiple shards are downloaded with a sliced scroll per shard
+    await es().indices.delete(index=index)
+    await es().indices.create(index=index, settings={"number_of_shards": 3}, mappings={"dynamic": "strict"})
+    assert await index_scan_slices(index) == 3
+    await upload(index, [{"_id": str(i), "title": f"doc {i}"} for i in range(25)], fields={"title": "text"})
+
+    r = await client.get(f"/index/{index}/download", cookies=auth_cookie(admin))
+    assert r.status_code == 200
+    lines = [json.loads(line) for line in gzip.decompress(r.content).splitlines()]
+    docs = {line["_id"]: line["title"] for line in lines if line["_type"] == "document"}
+    assert docs == {str(i): f"doc {i}" for i in range(25)}
@@ -128,6 +128,32 @@ async def test_bare_aggregate(client, index_docs, user):
     assert r["data"] == [dict(n=4, mini=1)]
 
 
+@pytest.mark.anyio
+async def test_batch(client, index_docs, user):
+    await create_project_role(user, index_docs, Roles.READER)
+    items = [
+        {"type": "query", "queries": "test*", "fields": ["cat"]},
+        {"type": "aggregate", "axes": [{"field": "cat"}]},
+        {"type": "aggregate", "aggregations": [{"field": "i", "function": "avg"}]},
+        {"type": "query", "filters": {"cat": "b"}},
+    ]
+    r = await post_json(client, f"/index/{index_docs}/batch", user=user, expected=200, json={"items": items})
+    assert len(r) == 4
+    assert {int(doc["_id"]) for doc in r[0]["results"]} == {1, 2, 3}
+    assert set(r[0]["results"][0].keys()) == {"_id", "cat"}
+    assert {d["cat"]: d["n"] for d in r[1]["data"]} == {"a": 3, "b": 1}
+    assert r[2]["data"] == [dict(n=4, avg_i=11.25)]
+    assert [int(doc["_id"]) for doc in r[3]["results"]] == [3]
+
+    # Stateful queries cannot be batched
+    scroll_items = [{"type": "query", "scroll": "1m"}]
+    await post_json(client, f"/index/{index_docs}/batch", user=user, expected=400, json={"items": scroll_items})
+
+    # Access is checked for all items
+    await update_project_role(user, index_docs, Roles.NONE)
+    await post_json(client, f"/index/{index_docs}/batch", user=user, expected=403, json={"items": items})
+
+
 @pytest.mark.anyio
 async def test_multiple_index(client, index_docs, index, user):
     await create_project_role(user, index_docs, Roles.READER)
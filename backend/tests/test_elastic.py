@@ -1,20 +1,47 @@
-from datetime import datetime
+import functools
+from datetime import date, datetime
 
 import pytest
+from elasticsearch.helpers import BulkIndexError
 
 from amcat4.connections import es
+from amcat4.elastic.util import BulkStats, es_bulk, es_bulk_stream, index_scan
 from amcat4.models import CreateDocumentField, DocumentField, FieldSpec
 from amcat4.projects.documents import (
+    DocumentConverter,
     create_or_update_documents,
     delete_documents_by_query,
     fetch_document,
+    stream_documents,
     update_document,
     update_document_tag_by_query,
     update_documents_by_query,
 )
 from amcat4.projects.index import refresh_index
 from amcat4.projects.query import query_documents
-from amcat4.systemdata.fields import _update_fields, create_fields, field_values, list_fields
+from amcat4.systemdata import generations
+from amcat4.systemdata.fields import (
+    _update_fields,
+    create_fields,
+    field_values,
+    fields_cache_generation,
+    invalidate_fields_cache,
+    list_and_repair_fields,
+    list_fields,
+    list_fields_many,
+    pop_pending_fields_repairs,
+)
+from amcat4.systemdata.manage import update_systemdata_mappings
+from amcat4.systemdata.reconciler import reconcile_fields
+from amcat4.systemdata.settings import acquire_system_lease
+from amcat4.systemdata.versions import (
+    LATEST_VERSION,
+    jobs_index_name,
+    roles_index_name,
+    sessions_index_name,
+    settings_index_name,
+)
+from amcat4.systemdata.versions.v2 import sessions_mapping
 from tests.conftest import upload
 
 
@@ -70,6 +97,138 @@ async def test_fields(index):
     assert fields["text"].metareader.access == "none"
 
 
+@pytest.mark.anyio
+async def test_fields_cache(index):
+    """Are cached fields safe to mutate, and invalidated when fields change"""
+    await create_fields(index, {"title": "text"})
+    fields = await list_fields(index)
+    fields["title"].type = "keyword"
+    assert (await list_fields(index))["title"].type == "text"
+
+    generation = fields_cache_generation(index)
+    await create_fields(index, {"date": "date"})
+    assert fields_cache_generation(index) != generation
+    assert set((await list_fields(index)).keys()) == {"title", "date"}
+
+
+@pytest.mark.anyio
+async def test_fields_cache_other_worker(index, monkeypatch):
+    """Are cached fields dropped when another worker changes the fields"""
+    monkeypatch.setattr(generations, "GENERATION_CHECK_INTERVAL", 0)
+    await create_fields(index, {"title": "text"})
+    await list_fields(index)
+    generation = fields_cache_generation(index)
+    # Another worker changing the fields only bumps the generation counter
+    await generations.bump_system_generation("fields")
+    assert set((await list_fields(index)).keys()) == {"title"}
+    assert fields_cache_generation(index) != generation
+
+
+@pytest.mark.anyio
+async def test_list_fields_many(index, index_docs):
+    """Can we get the fields of multiple indices at once"""
+    await create_fields(index, {"title": "text"})
+    fields = await list_fields_many([index, index_docs])
+    assert list(fields.keys()) == [index, index_docs]
+    assert fields[index] == await list_fields(index)
+    assert fields[index_docs] == await list_fields(index_docs)
+
+
+@pytest.mark.anyio
+async def test_list_fields_schedules_repair(index):
+    """Reading fields does not write, but schedules a repair for the background reconciler"""
+    await es().indices.put_mapping(index=index, properties={"unregistered": {"type": "keyword"}})
+    invalidate_fields_cache(index)
+    pop_pending_fields_repairs()
+
+    assert "unregistered" in await list_fields(index)
+    assert "unregistered" not in await list_fields(index, auto_repair=False)
+    assert index in pop_pending_fields_repairs()
+
+    await reconcile_fields([index])
+    assert "unregistered" in await list_fields(index, auto_repair=False)
+
+
+@pytest.mark.anyio
+async def test_sliced_index_scan(index_many):
+    docs = {id: doc async for id, doc in index_scan(index_many, batchsize=3)}
+    assert len(docs) == 20
+    sliced = {id: doc async for id, doc in index_scan(index_many, batchsize=3, slices=3)}
+    assert sliced == docs
+    odd = [doc async for _, doc in index_scan(index_many, query={"match": {"text": "odd"}}, slices=2)]
+    assert sorted(doc["id"] for doc in odd) == list(range(0, 20, 2))
+    with pytest.raises(ValueError):
+        [doc async for doc in index_scan(index_many, sort={"id": "asc"}, slices=2)]
+
+
+@pytest.mark.anyio
+async def test_es_bulk(index):
+    await create_fields(index, {"text": "text", "i": "integer"})
+    actions = [{"_index": index, "_id": str(i), "i": i, "text": "x" * 10 * i} for i in range(20)]
+    stats = BulkStats()
+    results = [r async for r in es_bulk_stream(actions, max_bytes=500, concurrency=3, refresh=True, stats=stats)]
+    assert len(results) == 20 and all(ok for ok, _ in results)
+    # Batches are cut by payload size
+    assert stats.successes == 20 and stats.requests > 1 and stats.bytes > 500
+    docs = {id: doc async for id, doc in index_scan(index)}
+    assert {doc["i"] for doc in docs.values()} == set(range(20))
+
+    # Failed items are reported, and raised if raise_on_error
+    create = [{"_op_type": "create", "_index": index, "_id": str(i), "i": i} for i in range(18, 22)]
+    stats, errors = await es_bulk(create, raise_on_error=False, refresh=True)
+    assert (stats.successes, stats.failures, len(errors)) == (2, 2, 2)
+    with pytest.raises(BulkIndexError):
+        await es_bulk(create, refresh=True)
+
+
+@pytest.mark.anyio
+async def test_es_bulk_order(index):
+    await create_fields(index, {"i": "integer", "text": "text"})
+    # The same document is written many times in different (concurrent) requests, and the last write wins
+    actions = [{"_index": index, "_id": str(i % 3), "i": i} for i in range(30)]
+    stats, _ = await es_bulk(actions, max_documents=2, concurrency=4, refresh=True)
+    assert stats.requests >= 15
+    docs = {id: doc async for id, doc in index_scan(index)}
+    assert {id: doc["i"] for id, doc in docs.items()} == {"0": 27, "1": 28, "2": 29}
+    # Also for partial updates of the same document
+    updates = [{"_op_type": "update", "_index": index, "_id": "0", "doc": {"text": str(i)}} for i in range(10)]
+    await es_bulk(updates, max_documents=1, concurrency=4, refresh=True)
+    assert (await fetch_document(index, "0"))["text"] == "9"
+
+    # And for uploads that contain the same document in different chunks
+    async def documents():
+        for i in range(6):
+            yield {"_id": "x", "i": i}
+
+    [_ async for _ in stream_documents(index, documents(), chunk_size=2, refresh=True)]
+    assert (await fetch_document(index, "x"))["i"] == 5
+
+
+@pytest.mark.anyio
+async def test_document_converter():
+    fields = {
+        "title": DocumentField(type="text", elastic_type="text", identifier=True),
+        "date": DocumentField(type="date", elastic_type="date"),
+        "i": DocumentField(type="integer", elastic_type="long"),
+    }
+    converter = DocumentConverter("ix", "index", fields)
+    docs = [{"title": 1, "date": date(2020, 1, 1), "i": "3"}, {"title": "b", "i": None}]
+    actions = converter.actions(docs)
+    # Converting a batch column by column gives the same result as converting the documents one by one
+    assert actions == [converter.action(doc) for doc in docs]
+    assert actions[0]["title"] == "1" and actions[0]["date"] == "2020-01-01" and actions[0]["i"] == 3
+    assert "i" not in actions[1]
+    assert actions[0]["_id"] == converter.action({"i": 5, "title": 1})["_id"] != actions[1]["_id"]
+    # Invalid documents raise the error of the first invalid document
+    with pytest.raises(ValueError, match="Invalid date"):
+        converter.actions([*docs, {"date": "not a date"}, {"unknown": 1}])
+    with pytest.raises(ValueError, match="not yet specified"):
+        converter.actions([*docs, {"unknown": 1}, {"date": "not a date"}])
+    with pytest.raises(ValueError, match="identifiers"):
+        converter.actions([{"_id": "1", "title": "a"}])
+    assert DocumentConverter("ix", "update", fields).actions([{"_id": "1", "i": 1}])[0]["doc"] == {"i": 1}
+
+
 @pytest.mark.anyio
 async def test_values(index):
     """Can we get values for a specific field"""
@@ -271,9 +430,53 @@ async def test_list_fields_skips_repair_for_existing_es_fields(index):
 
     # Dashboard path: must not raise. Pre-fix this raised BadRequestError from ES
     # ("Cannot update parameter [format]").
-    fields = await list_fields(index, auto_repair=True)
+    fields = await list_and_repair_fields(index)
     assert "date" in fields
 
     # The pre-existing date mapping keeps its ES-default format (no explicit format key).
     mapping = (await es().indices.get_mapping(index=index))[index]["mappings"]["properties"]
     assert "format" not in mapping["date"]
+
+
+@pytest.mark.anyio
+async def test_system_index_settings():
+    settings = await es().indices.get_settings(index=[roles_index_name(), jobs_index_name()])
+    roles, jobs = settings[roles_index_name()]["settings"]["index"], settings[jobs_index_name()]["settings"]["index"]
+    assert roles["number_of_shards"] == "1"
+    # Jobs are only read by id, so the index is refreshed less often
+    assert (roles["refresh_interval"], jobs["refresh_interval"]) == ("1s", "30s")
+
+
+@pytest.mark.anyio
+async def test_transient_system_index_recreated():
+    # Sessions used to store their data in an analyzed text field, which cannot be changed in place
+    sessions = sessions_index_name()
+    await es().indices.delete(index=sessions)
+    await es().indices.create(
+        index=sessions, mappings={"dynamic": "strict", "properties": {**sessions_mapping, "data": {"type": "text"}}}
+    )
+    await es().index(index=sessions, id="x", document={"email": "x@example.org", "data": "{}"}, refresh=True)
+    await update_systemdata_mappings(LATEST_VERSION)
+    mapping = (await es().indices.get_mapping(index=sessions))[sessions]["mappings"]["properties"]
+    assert mapping["data"] == {"type": "keyword", "index": False, "doc_values": False}
+    assert (await es().count(index=sessions))["count"] == 0
+
+
+@pytest.mark.anyio
+async def test_system_lease(index):
+    delete_leases = functools.partial(
+        es().options(ignore_status=404).delete, index=settings_index_name(), id="_leases", refresh=True
+    )
+    await delete_leases()
+    try:
+        # Only one worker can hold the lease, until it expires
+        assert await acquire_system_lease("fields_sweep", 60)
+        assert not await acquire_system_lease("fields_sweep", 60)
+        await delete_leases()
+        assert await acquire_system_lease("fields_sweep", 0)
+        assert await acquire_system_lease("fields_sweep", 0)
+    finally:
+        await delete_leases()
+
+    # The reconciler sweeps all registered projects
+    assert index in await reconcile_fields()
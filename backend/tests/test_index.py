@@ -1,19 +1,27 @@
 from typing import List
 
 import pytest
+from fastapi import HTTPException
 
 from amcat4.connections import es
-from amcat4.models import ProjectSettings, Roles, User
+from amcat4.models import AuthContext, ProjectSettings, Roles, UpdateDocumentField, User
+from amcat4.projects import index as project_index
 from amcat4.projects.index import (
+    IndexDoesNotExist,
     clear_project_index,
     create_project_index,
     delete_project_index,
     deregister_project_index,
+    get_project_overview,
     list_project_indices,
     list_user_project_indices,
+    list_user_project_indices_page,
     register_project_index,
 )
-from amcat4.systemdata.fields import list_fields
+from amcat4.projects.stats import get_index_stats, refresh_index_stats
+from amcat4.systemdata import fields, generations, roles
+from amcat4.systemdata.fields import allowed_fieldspecs, list_fields, update_fields
+from amcat4.systemdata.generations import bump_system_generation
 from amcat4.systemdata.roles import (
     create_project_role,
     create_server_role,
@@ -23,11 +31,15 @@ from amcat4.systemdata.roles import (
     get_user_project_role,
     get_user_server_role,
     list_project_roles,
+    list_user_project_roles,
+    rebuild_project_access,
+    require_project_roles,
     set_project_guest_role,
     update_project_role,
     update_server_role,
 )
 from amcat4.systemdata.settings import get_project_settings, update_project_settings
+from tests.conftest import upload
 
 
 async def list_es_indices() -> List[str]:
@@ -102,6 +114,83 @@ async def test_index_roles(index):
     assert (await get_user_project_role(user, index)).role == Roles.NONE.name
 
 
+@pytest.mark.anyio
+async def test_roles_cache(index, monkeypatch):
+    user = User(email="user@example.com")
+    await create_project_role(email="*@example.com", project_id=index, role=Roles.READER)
+    assert (await get_user_project_role(user, index)).role == Roles.READER.name
+
+    # Roles are cached, so repeated lookups do not query elastic
+    loads = []
+    list_roles = roles._list_roles
+    monkeypatch.setattr(roles, "_list_roles", lambda **kwargs: loads.append(kwargs) or list_roles(**kwargs))
+    assert (await get_user_project_role(user, index)).role == Roles.READER.name
+    assert [r.role_context for r in await list_user_project_roles(user)] == [index]
+    assert loads == []
+
+    # A change made by another worker is noticed through the generation counter
+    await bump_system_generation("roles")
+    monkeypatch.setattr(generations, "GENERATION_CHECK_INTERVAL", 0)
+    assert (await get_user_project_role(user, index)).role == Roles.READER.name
+    assert len(loads) == 1
+
+    # Changes to exact, domain and guest rules are seen immediately
+    await create_project_role(email="user@example.com", project_id=index, role=Roles.WRITER)
+    assert (await get_user_project_role(user, index)).role == Roles.WRITER.name
+    await delete_project_role(email="user@example.com", project_id=index)
+    await update_project_role(email="*@example.com", project_id=index, role=Roles.METAREADER)
+    assert (await get_user_project_role(user, index)).role == Roles.METAREADER.name
+    await delete_project_role(email="*@example.com", project_id=index)
+    await set_project_guest_role(index, Roles.READER)
+    assert (await get_user_project_role(user, index)).role == Roles.READER.name
+    await delete_project_index(index)
+    assert (await get_user_project_role(user, index)).role == Roles.NONE.name
+    assert len(loads) == 5
+
+
+@pytest.mark.anyio
+async def test_auth_context(index_docs, monkeypatch):
+    email = "user@example.com"
+    user = AuthContext(email=email)
+    await create_project_role(email=email, project_id=index_docs, role=Roles.READER)
+    assert (await get_user_project_role(user, index_docs)).role == Roles.READER.name
+    specs = await allowed_fieldspecs(user, [index_docs])
+
+    # Role rules and fields are memoized in the context, so repeated checks do not use the caches
+    loads = []
+    monkeypatch.setattr(roles._ROLES_CACHE, "get_or_load", lambda *args: loads.append("roles"))
+    list_fields_many = fields.list_fields_many
+    monkeypatch.setattr(fields, "list_fields_many", lambda indices: loads.append("fields") or list_fields_many(indices))
+    assert (await get_user_project_role(user, index_docs)).role == Roles.READER.name
+    assert await allowed_fieldspecs(user, [index_docs]) == specs
+    assert loads == []
+
+    # But changes made during the request are seen
+    await update_fields(index_docs, {"cat": UpdateDocumentField(client_settings={"x": 1})})
+    await allowed_fieldspecs(user, [index_docs])
+    assert loads == ["fields"]
+    monkeypatch.undo()
+    await update_project_role(email=email, project_id=index_docs, role=Roles.WRITER)
+    assert (await get_user_project_role(user, index_docs)).role == Roles.WRITER.name
+
+
+@pytest.mark.anyio
+async def test_require_project_roles(index, index_docs):
+    email = "user@example.com"
+    user = User(email=email)
+    await create_project_role(email=email, project_id=index, role=Roles.WRITER)
+    await create_project_role(email=email, project_id=index_docs, role=Roles.READER)
+    assert await require_project_roles(user, [index], Roles.WRITER) == {index: True}
+    verdicts = await require_project_roles(user, [index, index_docs], Roles.WRITER, raise_error=False)
+    assert verdicts == {index: True, index_docs: False}
+    with pytest.raises(HTTPException, match=index_docs):
+        await require_project_roles(user, [index, index_docs], Roles.WRITER)
+    # Server admins have all roles on all projects
+    await create_server_role(email=email, role=Roles.ADMIN)
+    assert await require_project_roles(user, [index, index_docs], Roles.ADMIN) == {index: True, index_docs: True}
+    await delete_server_role(email=email)
+
+
 @pytest.mark.anyio
 async def test_guest_role(index):
     assert await get_project_guest_role(index) == Roles.NONE.name
@@ -131,6 +220,104 @@ async def test_list_users(index, user):
     assert len([p async for p in project_users]) == 2
 
 
+@pytest.mark.anyio
+async def test_project_access(index, index_name, monkeypatch):
+    await create_project_index(ProjectSettings(id=index_name, folder="sub"))
+    email = "someone@example.com"
+    assert index not in await list_index_ids(email)
+    await create_project_role("*@example.com", index, role=Roles.READER)
+    await create_project_role(email, index_name, role=Roles.METAREADER)
+    assert set(await list_index_ids(email)) == {index, index_name}
+    # Rebuilding the materialized access should not change anything
+    await rebuild_project_access()
+    assert set(await list_index_ids(email)) == {index, index_name}
+
+    # Search and folder filters
+    user = User(email=email)
+    assert [ix.id async for ix, _ in list_user_project_indices(user, folder="sub")] == [index_name]
+    assert [ix.id async for ix, _ in list_user_project_indices(user, search="unittest index")] == [index]
+
+    # Pagination
+    page, cursor = await list_user_project_indices_page(user, per_page=1)
+    assert len(page) == 1 and cursor is not None
+    page2, cursor2 = await list_user_project_indices_page(user, per_page=1, after=cursor)
+    assert {page[0][0].id, page2[0][0].id} == {index, index_name}
+    page3, cursor3 = await list_user_project_indices_page(user, per_page=1, after=cursor2)
+    assert page3 == [] and cursor3 is None
+
+    # Projects that the access filter selects but on which the user has no role are skipped, and the page is filled
+    fetch_roles = project_index.fetch_user_project_roles
+    monkeypatch.setattr(
+        project_index,
+        "fetch_user_project_roles",
+        lambda user, ids, **kwargs: fetch_roles(user, [id for id in ids if id != min(index, index_name)], **kwargs),
+    )
+    page, cursor = await list_user_project_indices_page(user, per_page=1)
+    assert [ix.id for ix, _ in page] == [max(index, index_name)] and cursor is not None
+    monkeypatch.undo()
+
+    await delete_project_role("*@example.com", index)
+    assert await list_index_ids(email) == [index_name]
+
+    # Roles on projects that are not registered (yet) do not change any project access
+    await create_project_role(email, f"{index_name}-unregistered", role=Roles.READER)
+    await delete_project_role(email, f"{index_name}-unregistered")
+    assert await list_index_ids(email) == [index_name]
+
+
+@pytest.mark.anyio
+async def test_project_overview(index_docs, admin):
+    user = User(email="someone@example.com")
+    await create_project_role("*@example.com", index_docs, Roles.READER)
+    await set_project_guest_role(index_docs, Roles.METAREADER)
+    overview = await get_project_overview(user, index_docs)
+    assert overview.settings.name == "Unittest Index with Docs"
+    assert (overview.user_role.role, overview.user_role.email) == ("READER", "*@example.com")
+    assert overview.project_role == overview.user_role
+    assert overview.guest_role == "METAREADER"
+    assert overview.fields == await list_fields(index_docs)
+    assert overview.stats.documents == 4
+    assert overview.stats.bytes > 0
+
+    # Server admins get ADMIN role, but their project role is the role on the project itself
+    overview = await get_project_overview(User(email=admin), index_docs)
+    assert overview.user_role.role == "ADMIN"
+    assert overview.project_role.role == "METAREADER"
+    assert overview.project_role == await get_user_project_role(User(email=admin), index_docs, global_admin=False)
+
+    with pytest.raises(IndexDoesNotExist):
+        await get_project_overview(user, "amcat4_unittest_doesnotexist")
+
+
+@pytest.mark.anyio
+async def test_index_stats(index_docs, index, index_name):
+    await refresh_index_stats()
+    stats = await get_index_stats([index_docs, index, index_name])
+    assert set(stats.keys()) == {index_docs, index}
+    assert (stats[index_docs].documents, stats[index].documents) == (4, 0)
+    # The documents were written through this process, so the time of the last write is known
+    assert stats[index_docs].last_write is not None
+    assert stats[index].last_write is None
+
+    # Missing indices are remembered, but not after the project is created
+    assert await get_index_stats([index_name]) == {}
+    await create_project_index(ProjectSettings(id=index_name))
+    assert (await get_index_stats([index_name]))[index_name].documents == 0
+
+    # Statistics are cached until they are refreshed
+    await upload(index_docs, [dict(title="another", text="document")])
+    assert (await get_index_stats([index_docs]))[index_docs].documents == 4
+    last_write = stats[index_docs].last_write
+    stats = await get_index_stats([index_docs], refresh=True)
+    assert stats[index_docs].documents == 5
+    new_write = stats[index_docs].last_write
+    assert last_write is not None and new_write is not None and new_write > last_write
+
+    # Deleted indices are forgotten
+    await delete_project_index(index)
+    assert await get_index_stats([index]) == {}
+
+
 @pytest.mark.anyio
 async def test_name_description(index):
     await update_project_settings(ProjectSettings(id=index, name="test", description="ooktest"))
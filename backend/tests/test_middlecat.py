@@ -3,9 +3,12 @@ from datetime import datetime
 import pytest
 from httpx import AsyncClient
 
+from amcat4.api import auth_helpers
+from amcat4.auth.sessions import ElasticSessionStore, get_session_store
 from amcat4.config import AuthOptions, get_settings
 from amcat4.models import Roles
-from tests.tools import create_session_cookie, create_token, get_json
+from amcat4.systemdata import generations
+from tests.tools import create_session_cookie, create_token, get_json, set_auth
 
 
 @pytest.mark.anyio
@@ -46,6 +49,60 @@ async def test_handler_responses(client: AsyncClient, admin):
     await test(clientId=clientId, resource="http://nee.niet", exp=now + 1000, email=admin, expected=401)
 
 
+@pytest.mark.anyio
+async def test_token_cache(admin, monkeypatch):
+    now = int(datetime.now().timestamp())
+    host = get_settings().host
+    token = create_token(clientId=host, resource=host + "/api", exp=now + 1234, email=admin)
+    expired = create_token(clientId=host, resource=host + "/api", exp=now - 1000, email=admin)
+
+    decodes = []
+    decode = auth_helpers.jwt.decode
+    monkeypatch.setattr(auth_helpers.jwt, "decode", lambda *args, **kargs: decodes.append(1) or decode(*args, **kargs))
+    # The signature of a valid token is only verified once
+    assert (await auth_helpers.verify_token(token))["email"] == admin
+    assert (await auth_helpers.verify_token(token))["email"] == admin
+    assert len(decodes) == 1
+    # Invalid tokens are not cached
+    for _ in range(2):
+        with pytest.raises(auth_helpers.InvalidToken):
+            await auth_helpers.verify_token(expired)
+    assert len(decodes) == 3
+
+
+@pytest.mark.anyio
+async def test_server_side_session(client: AsyncClient, admin):
+    now = int(datetime.now().timestamp())
+    host = get_settings().host
+    token = create_token(clientId=host, resource=host + "/api", exp=now + 1000, email=admin)
+    await get_session_store().set("test-session", {"access_token": token, "exp": now + 1000}, now + 1000)
+
+    with set_auth():
+        # The cookie only contains the session id
+        cookies = {"amcat_session": create_session_cookie({"sid": "test-session"})}
+        assert (await get_json(client, "/users/me", cookies=cookies))["email"] == admin
+
+        # Deleted sessions can no longer be used
+        await get_session_store().delete("test-session")
+        await get_json(client, "/users/me", cookies=cookies, expected=401)
+
+
+@pytest.mark.anyio
+async def test_session_revoked_on_all_workers(monkeypatch):
+    monkeypatch.setattr(generations, "GENERATION_CHECK_INTERVAL", 0)
+    # Two stores with their own cache, as in two workers
+    worker1, worker2 = ElasticSessionStore(), ElasticSessionStore()
+    expires = datetime.now().timestamp() + 1000
+    await worker1.set("test-session-2", {"user": {"email": "x@example.com"}}, expires)
+    assert await worker1.get("test-session-2") is not None
+    assert await worker2.get("test-session-2") is not None
+    # Updated sessions (e.g. with refreshed tokens) are also noticed by other workers
+    await worker1.set("test-session-2", {"user": {"email": "x@example.com"}, "exp": 1}, expires)
+    assert (await worker2.get("test-session-2") or {}).get("exp") == 1
+    await worker1.delete("test-session-2")
+    assert await worker2.get("test-session-2") is None
+
+
 @pytest.mark.anyio
 async def test_config(client: AsyncClient):
     result = await get_json(client, "/config")
@@ -2,7 +2,7 @@ from typing import List
 
 import pytest
 
-from amcat4.models import FieldSpec
+from amcat4.models import FieldSpec, SortSpec
 from amcat4.projects.query import query_documents
 
 
@@ -62,3 +62,64 @@ async def test_scroll(index_many):
     assert r is None
 
     assert {int(h["id"]) for h in allids} == {0, 2, 4, 6, 8, 10, 12, 14, 16, 18}
+
+
+@pytest.mark.anyio
+async def test_pit(index_many):
+    fields = [FieldSpec(name="id")]
+    sort = [{"id": SortSpec(order="asc")}]
+    r = await query_documents(index_many, queries={"odd": "odd"}, pit="1m", per_page=4, fields=fields, sort=sort)
+    assert r is not None
+    assert r.total_count == 10
+    assert r.page_count == 3
+    assert r.as_dict()["meta"]["cursor"] == r.cursor
+    ids = [int(h["id"]) for h in r.data]
+
+    while r.cursor is not None:
+        r = await query_documents(index_many, queries={"odd": "odd"}, cursor=r.cursor, per_page=4, fields=fields, sort=sort)
+        assert r is not None
+        assert r.total_count == 10
+        ids += [int(h["id"]) for h in r.data]
+
+    assert ids == [0, 2, 4, 6, 8, 10, 12, 14, 16, 18]
+
+    with pytest.raises(ValueError):
+        await query_documents(index_many, cursor="invalid", fields=fields)
+    with pytest.raises(ValueError):
+        await query_documents(index_many, pit=True, sort=[{"?": SortSpec()}])
+
+
+@pytest.mark.anyio
+async def test_pit_cursor_is_bound_to_query(index_many, index):
+    fields = [FieldSpec(name="id")]
+    r = await query_documents(index_many, pit=True, per_page=4, fields=fields)
+    assert r is not None and r.cursor is not None
+
+    # A cursor cannot be replayed on another index, or with other fields
+    with pytest.raises(ValueError):
+        await query_documents(index, cursor=r.cursor, per_page=4, fields=fields)
+    with pytest.raises(ValueError):
+        await query_documents(index_many, cursor=r.cursor, per_page=4, fields=[FieldSpec(name="id"), FieldSpec(name="text")])
+    # and it cannot be changed
+    payload, signature = r.cursor.split(".")
+    with pytest.raises(ValueError):
+        await query_documents(index_many, cursor=f"{payload}x.{signature}", per_page=4, fields=fields)
+    r = await query_documents(index_many, cursor=r.cursor, per_page=4, fields=fields)
+    assert r is not None and len(r.data) == 4
+
+
+@pytest.mark.anyio
+async def test_total_hits(index_many):
+    r = await query_documents(index_many, per_page=6, total_hits="exact")
+    assert r is not None
+    assert (r.total_count, r.total_count_relation) == (20, "eq")
+    assert r.as_dict()["meta"]["total_count_mode"] == "exact"
+
+    # approximate only counts as far as needed to know there is a next page
+    r = await query_documents(index_many, per_page=6, total_hits="approximate")
+    assert r is not None
+    assert (r.total_count, r.total_count_relation) == (7, "gte")
+    r = await query_documents(index_many, per_page=6, page=3, total_hits="approximate")
+    assert r is not None
+    assert (r.total_count, r.total_count_relation) == (20, "eq")
+    assert len(r.data) == 2
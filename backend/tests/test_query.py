@@ -6,10 +6,17 @@ import pytest
 from pytest import raises
 
 from amcat4.api.index_query import _standardize_filters, _standardize_queries
+from amcat4.config import get_settings
+from amcat4.connections import es
 from amcat4.models import FieldSpec, FilterSpec, FilterValue, ProjectSettings, SnippetParams
+from amcat4.projects import result_cache
+from amcat4.projects.documents import delete_documents_by_query
 from amcat4.projects.index import create_project_index, delete_project_index, refresh_index
-from amcat4.projects.query import get_task_status, query_documents, reindex
+from amcat4.projects.query import _source_fields, get_task_status, query_documents, reindex
+from amcat4.projects.result_cache import cached_result
+from amcat4.systemdata import generations
 from amcat4.systemdata.fields import list_fields
+from amcat4.systemdata.generations import bump_system_generation
 from tests.conftest import upload
 
 
@@ -57,6 +64,15 @@ async def test_snippet(index_docs):
     assert docs is not None
     assert docs.data[0]["text"] == "a"
 
+    # Snippet fields are not retrieved from _source, but other fields are
+    assert _source_fields([FieldSpec(name="cat"), FieldSpec(name="text", snippet=SnippetParams())]) == ["cat"]
+    assert _source_fields([FieldSpec(name="text", snippet=SnippetParams())]) is False
+    docs = await query_documents(
+        index_docs, fields=[FieldSpec(name="cat"), FieldSpec(name="text", snippet=SnippetParams(nomatch_chars=5))]
+    )
+    assert docs is not None
+    assert {(d["cat"], d["text"]) for d in docs.data if d["_id"] == "0"} == {("a", "this is")}
+
 
 @pytest.mark.anyio
 async def test_range_query(index_docs):
@@ -148,3 +164,60 @@ async def test_reindex(index_docs, index_name):
 
     await refresh_index(index_name)
     assert await query_ids(index_name) == {3}
+
+
+@pytest.mark.anyio
+async def test_result_cache(index_docs, monkeypatch):
+    monkeypatch.setattr(get_settings(), "result_cache_refresh_interval", 0)
+    calls = []
+
+    async def count_docs():
+        calls.append(1)
+        return len(await query_ids(index_docs))
+
+    assert await cached_result("test", [index_docs], dict(q=1), count_docs) == 4
+    assert await cached_result("test", [index_docs], dict(q=1), count_docs) == 4
+    assert len(calls) == 1
+    # A different body is cached separately
+    assert await cached_result("test", [index_docs], dict(q=2), count_docs) == 4
+    assert len(calls) == 2
+    # A write to the index makes the cached result stale
+    await delete_documents_by_query(index_docs, query={"ids": {"values": ["0"]}})
+    assert await cached_result("test", [index_docs], dict(q=1), count_docs) == 3
+    assert len(calls) == 3
+
+    # Writes by other workers are noticed through the documents generation counter of the index
+    monkeypatch.setattr(generations, "GENERATION_CHECK_INTERVAL", 0)
+    assert await cached_result("test", [index_docs], dict(q=1), count_docs) == 3
+    assert await cached_result("test", ["other"], dict(q=1), count_docs) == 3
+    assert len(calls) == 4
+    await bump_system_generation("documents", index_docs)
+    assert await cached_result("test", [index_docs], dict(q=1), count_docs) == 3
+    assert len(calls) == 5
+    # Cached results for other indices are kept
+    assert await cached_result("test", ["other"], dict(q=1), count_docs) == 3
+    assert len(calls) == 5
+
+    # Recently written indices are not cached
+    monkeypatch.setattr(get_settings(), "result_cache_refresh_interval", 3600)
+    assert await cached_result("test", [index_docs], dict(q=1), count_docs) == 3
+    assert len(calls) == 6
+
+
+@pytest.mark.anyio
+async def test_result_cache_forgets_deleted_index(index_name, monkeypatch):
+    monkeypatch.setattr(get_settings(), "result_cache_refresh_interval", 0)
+
+    async def count_docs():
+        return (await es().count(index=index_name))["count"]
+
+    await create_project_index(ProjectSettings(id=index_name))
+    await upload(index_name, [{"text": "a text"}], fields={"text": "text"})
+    assert await cached_result("test", [index_name], dict(q=1), count_docs) == 1
+    assert index_name in result_cache._WRITE_GENERATIONS
+
+    # Deleting the index drops its write generation and the cached results
+    await delete_project_index(index_name)
+    assert index_name not in result_cache._WRITE_GENERATIONS
+    await create_project_index(ProjectSettings(id=index_name))
+    assert await cached_result("test", [index_name], dict(q=1), count_docs) == 0